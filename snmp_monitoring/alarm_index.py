@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+import threading
+
+"""
+========
+OVERVIEW
+========
+
+Open alarm index shared by check_hp.py and the device checks (Cisco, Arista, blades, Brocade, Data Domain, Riverbed
+and nPulse).
+
+The checks only send a resolve to PagerDuty for an alarm that is open, and only build the detail message of a healthy
+component when the device has an open alarm it could resolve. AlarmIndex keeps the open incident keys in a set, and
+indexes each key by the device it belongs to. Every check builds its keys the same way, with the device name in the
+third part:
+
+    snmp/<check>/<host>
+    snmp/<check>/<host>/<index>
+
+except for the checks in KEY_LAYOUTS, which have one more part before the device name:
+
+    snmp/power/amps/<host>/<index>
+
+Only the device name is indexed, so a lookup by host never matches a check name or a component index. A check whose
+keys are built some other way passes its own layouts, or the host itself to add/discard. Both lookups are constant
+time. check_hp and the other device checks fill the index from the incidents open in PagerDuty; the Cisco and
+Arista checks fill it from their previous run's alarm journal.
+"""
+
+#Position of the device name in the keys of a check, by the key's first three parts. Anything else uses HOST_PART.
+HOST_PART = 2
+KEY_LAYOUTS = {"snmp/power/amps": 3, "snmp/power/volts": 3}
+
+class AlarmIndex(object):
+    """Set of open incident keys, indexed by device."""
+
+    def __init__(self, keys=(), layouts=KEY_LAYOUTS):
+        self.keys = set()
+        self.by_host = {}
+        self.layouts = layouts
+        self.lock = threading.Lock()
+        for key in keys:
+            self.add(key)
+
+    # Returns the device name in a key, None if the key is too short to have one
+    def hostOf(self, key):
+        parts = str(key).split('/')
+        position = self.layouts.get('/'.join(parts[:3]), HOST_PART)
+        if len(parts) > position:
+            return parts[position]
+        return None
+
+    def add(self, key, host=None):
+        if host is None:
+            host = self.hostOf(key)
+        with self.lock:
+            self.keys.add(key)
+            if host is not None:
+                self.by_host.setdefault(host, set()).add(key)
+
+    def discard(self, key, host=None):
+        if host is None:
+            host = self.hostOf(key)
+        with self.lock:
+            self.keys.discard(key)
+            keys = self.by_host.get(host)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.by_host[host]
+
+    def clear(self):
+        with self.lock:
+            self.keys.clear()
+            self.by_host.clear()
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __iter__(self):
+        return iter(list(self.keys))
+
+    def __len__(self):
+        return len(self.keys)
+
+    # Returns the open incident keys of a device
+    def hostAlarms(self, host):
+        return set(self.by_host.get(host, ()))
+
+    # True if a device has any open incident, so a resolve for one of its components might be sent
+    def hostHasAlarms(self, host):
+        return host in self.by_host
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+import os
+import threading
+
+"""
+========
+OVERVIEW
+========
+
+Alarm journal shared by the Cisco and Arista checks.
+
+These checks do not ask PagerDuty which incidents are open. Every alarm triggered during a run is appended to
+<name>_current, and the next run only sends a resolve for an alarm the run before it triggered. AlarmJournal keeps
+the journal open for the whole run:
+
+    open   - rotates <name>_current into <name>_previous and returns the previous run's alarms
+    record - appends a triggered alarm to <name>_current (once per alarm and run)
+    close  - marks <name>_current complete
+
+<name>_previous is written through a temporary file and a rename, so it is never half written. A journal without the
+#complete line is from a run that did not finish; its alarms are added to the ones before it, so nothing that run did
+not get to is forgotten.
+
+The journal is line buffered, so every alarm is on disk as soon as it has been triggered. A run that is killed part
+way through still leaves the alarms it triggered for the next run to resolve. Each line follows a PagerDuty request,
+so the extra write is never noticeable. The rotated file and the #complete line are flushed and synced explicitly.
+"""
+
+COMPLETE = '#complete'
+
+# Returns the alarms in a journal file, and whether the run that wrote it finished
+def readJournal(path):
+    keys = set()
+    complete = False
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            complete = (line == COMPLETE)
+            if line and line[0] != '#':
+                keys.add(line)
+    return keys, complete
+
+class AlarmJournal(object):
+    """Alarms triggered during a run, written to <name>_current as they are triggered."""
+
+    def __init__(self, name):
+        self.current = name + '_current'
+        self.previous = name + '_previous'
+        self.keys = set()
+        self.journal = None
+        self.lock = threading.Lock()
+
+    # Rotates the journal and returns the alarms of the previous run
+    def open(self):
+        previous = set()
+        if os.path.exists(self.previous):
+            previous, complete = readJournal(self.previous)
+        if os.path.exists(self.current):
+            keys, complete = readJournal(self.current)
+            if not complete:
+                keys |= previous
+            with open(self.previous + '.tmp', 'w') as f:
+                for key in sorted(keys):
+                    f.write('{0}\n'.format(key))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(self.previous + '.tmp', self.previous)
+            previous = keys
+        self.keys = set()
+        self.journal = open(self.current, 'w', 1)
+        return previous
+
+    def record(self, key):
+        with self.lock:
+            if key not in self.keys:
+                self.keys.add(key)
+                self.journal.write('{0}\n'.format(key))
+
+    # Marks the journal complete, so the next run uses it as it is
+    def close(self):
+        with self.lock:
+            self.journal.write('{0}\n'.format(COMPLETE))
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+            self.journal.close()
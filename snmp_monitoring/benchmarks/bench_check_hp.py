@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+import argparse
+import functools
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import snmp_replay
+
+"""
+========
+OVERVIEW
+========
+
+Offline benchmark for check_hp.py, run against SNMP fixtures recorded with record_fixture.py.
+
+Every fixture is checked --passes times with the unchanged queryHPServer/querySmServer code, served by
+snmp_replay.ReplaySession with --latency seconds of delay per PDU. PagerDuty is replaced with a fake that only counts.
+The report shows:
+
+    hosts/sec    - servers checked per second of wall time
+    PDUs/host    - SNMP requests per server (a walk counts one GETBULK per 40 rows)
+    CPU/host     - process CPU time per server
+    components   - calls and CPU time for each query* function
+
+CPU times are only meaningful for serial runs (the default); with --workers the totals are still correct but the time
+of each component includes the other threads.
+
+Usage: bench_check_hp.py [--passes 5] [--latency 0.0] [--workers 1] [--rollup] [--log] FIXTURE_DIR
+"""
+
+COMPONENTS = ["queryTemp","queryFans","queryPower","queryMemory","queryCPU","queryDrives","queryNics",
+              "querySensors","querySmMemory","querySmCPU","querySmRaid"]
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description='Benchmarks check_hp.py against recorded SNMP fixtures.')
+    parser.add_argument('fixtures', help='directory of fixtures written by record_fixture.py')
+    parser.add_argument('--passes', type=int, default=5, help='number of times every fixture is checked (default: 5)')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds of delay per PDU (default: 0)')
+    parser.add_argument('--workers', type=int, default=1, help='servers checked in parallel (default: 1)')
+    parser.add_argument('--rollup', action='store_true', help='run with --rollup; later passes skip healthy subsystems')
+    parser.add_argument('--log', action='store_true', help='show the check_hp log on stderr instead of discarding it')
+    parser.add_argument('--check-hp', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'check_hp.py'),
+                        help='check_hp.py to benchmark (default: the one in this repository)')
+    return parser.parse_args()
+
+# Wraps a query* function so its calls and CPU time are counted. The name is kept, so --rollup still recognizes it.
+def timeComponent(function, stats):
+    @functools.wraps(function)
+    def timed(*args):
+        start = time.clock()
+        try:
+            return function(*args)
+        finally:
+            calls, cpu = stats.get(function.__name__, (0, 0.0))
+            stats[function.__name__] = (calls + 1, cpu + (time.clock() - start))
+    return timed
+
+def main():
+    args = parseArgs()
+    #check_hp logs at INFO in production, so the log lines are still formatted; they are just not written anywhere
+    stream = sys.stderr if args.log else open(os.devnull, 'w')
+    logging.basicConfig(stream=stream, format='%(asctime)s: %(levelname)s: %(message)s', level=logging.INFO)
+    check_hp, pager = snmp_replay.setupCheckHp(args.check_hp, tempfile.mkdtemp(prefix='bench_check_hp.'))
+    check_hp.rollup_enabled = args.rollup
+
+    fixtures = snmp_replay.loadFixtures(args.fixtures)
+    if not fixtures:
+        print 'No fixtures found in {0}'.format(args.fixtures)
+        return
+    counter = snmp_replay.PduCounter()
+    check_hp.M = snmp_replay.replayManager(check_hp.M, fixtures, args.latency, counter=counter)
+
+    stats = {}
+    for name in COMPONENTS:
+        setattr(check_hp, name, timeComponent(getattr(check_hp, name), stats))
+
+    servers = [(fixture.kind, fixture.host, fixture.community, fixture.version, None, None) for fixture in fixtures.values()]
+    check_hp.loadServerMibs(servers)
+    pool = None
+    if args.workers > 1:
+        pool = check_hp.ThreadPool(args.workers)
+
+    wall_start = time.time()
+    cpu_start = time.clock()
+    for p in range(args.passes):
+        #Every pass starts from the same PagerDuty state
+        check_hp.open_alarms.clear()
+        if pool is not None:
+            results = pool.map(check_hp.pollServer, servers)
+        else:
+            results = [check_hp.pollServer(server) for server in servers]
+    wall = time.time() - wall_start
+    cpu = time.clock() - cpu_start
+    if pool is not None:
+        pool.close()
+
+    checked = len(servers) * args.passes
+    components = sum([sum(result[2].counts[0::3]) for result in results])
+    print 'Fixtures: {0}; Passes: {1}; Latency: {2} sec/PDU; Workers: {3}; Rollup: {4}'.format(len(servers), args.passes, args.latency, args.workers, args.rollup)
+    print 'Hosts/sec: {0:.1f}; PDUs/host: {1:.1f}; CPU/host: {2:.2f} ms; Components/host: {3:.1f}'.format(
+        checked / wall, counter.pdus / float(checked), cpu * 1000 / checked, components / float(len(servers)))
+    print 'PagerDuty: {0} triggers; {1} resolves'.format(pager.triggers, pager.resolves)
+    print ''
+    print '{0:<16} {1:>8} {2:>14} {3:>8}'.format('component', 'calls', 'CPU ms/call', 'CPU %')
+    for name in COMPONENTS:
+        if name in stats:
+            calls, used = stats[name]
+            print '{0:<16} {1:>8} {2:>14.3f} {3:>7.1f}%'.format(name, calls, used * 1000 / calls, (used * 100 / cpu) if cpu else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import snmp_replay
+from bench_check_hp import COMPONENTS, timeComponent
+
+"""
+========
+OVERVIEW
+========
+
+CPU cost of the OK path in the check_hp.py query functions, per component, with and without the OK detail messages.
+
+Almost every component a run reads is healthy. At INFO the OK detail message is only built when the server has an
+open incident it could resolve; at DEBUG it is always built and logged. This runs the unchanged query functions
+against fixtures recorded with record_fixture.py (through snmp_replay, the same harness as bench_check_hp.py) in four
+modes:
+
+    info     - log level INFO, no open incidents (the common case: no OK message is built)
+    info+pd  - log level INFO, every server has an open incident (every OK message is built)
+    debug    - log level DEBUG, no open incidents (every OK message is built and logged)
+    debug+pd - log level DEBUG, every server has an open incident
+
+The open incidents use a key no component has, so the OK messages are built but nothing is resolved. Log lines go
+to /dev/null. The report shows the CPU time of each query function per call, in microseconds.
+
+Usage: bench_ok_path.py [--passes 5] [--check-hp PATH] FIXTURE_DIR
+"""
+
+MODES = [("info", logging.INFO, False), ("info+pd", logging.INFO, True),
+         ("debug", logging.DEBUG, False), ("debug+pd", logging.DEBUG, True)]
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description='Benchmarks the OK path of the check_hp.py query functions.')
+    parser.add_argument('fixtures', help='directory of fixtures written by record_fixture.py')
+    parser.add_argument('--passes', type=int, default=5, help='number of times every fixture is checked in each mode (default: 5)')
+    parser.add_argument('--check-hp', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'check_hp.py'),
+                        help='check_hp.py to benchmark (default: the one in this repository)')
+    return parser.parse_args()
+
+# Checks every server --passes times in one mode. Returns the (calls, CPU seconds) of each query function.
+def runMode(check_hp, originals, servers, passes, level, alarmed):
+    logging.getLogger().setLevel(level)
+    check_hp.debug_enabled = (level <= logging.DEBUG)
+    check_hp.open_alarms.clear()
+    if alarmed:
+        for server in servers:
+            check_hp.open_alarms.add('snmp/okpath/{0}'.format(server[1]))
+    stats = {}
+    for name in COMPONENTS:
+        setattr(check_hp, name, timeComponent(originals[name], stats))
+    for p in range(passes):
+        for server in servers:
+            check_hp.pollServer(server)
+    return stats
+
+def main():
+    args = parseArgs()
+    logging.basicConfig(stream=open(os.devnull, 'w'), format='%(asctime)s: %(levelname)s: %(message)s', level=logging.INFO)
+    check_hp, pager = snmp_replay.setupCheckHp(args.check_hp, tempfile.mkdtemp(prefix='bench_ok_path.'))
+
+    fixtures = snmp_replay.loadFixtures(args.fixtures)
+    if not fixtures:
+        print 'No fixtures found in {0}'.format(args.fixtures)
+        return
+    check_hp.M = snmp_replay.replayManager(check_hp.M, fixtures)
+    servers = [(fixture.kind, fixture.host, fixture.community, fixture.version, None, None) for fixture in fixtures.values()]
+    check_hp.loadServerMibs(servers)
+    originals = dict([(name, getattr(check_hp, name)) for name in COMPONENTS])
+
+    results = []
+    for mode, level, alarmed in MODES:
+        start = time.clock()
+        results.append(runMode(check_hp, originals, servers, args.passes, level, alarmed))
+        print '{0:<9} {1:.2f} sec. CPU'.format(mode, time.clock() - start)
+    print 'Fixtures: {0}; Passes: {1}; PagerDuty: {2} triggers; {3} resolves'.format(len(servers), args.passes, pager.triggers, pager.resolves)
+    print ''
+
+    print '{0:<16}'.format('us/call') + ''.join(['{0:>10}'.format(mode) for mode, level, alarmed in MODES])
+    for name in COMPONENTS:
+        if name not in results[0]:
+            continue
+        row = []
+        for stats in results:
+            calls, used = stats.get(name, (0, 0.0))
+            row.append(used * 1e6 / calls if calls else 0.0)
+        print '{0:<16}'.format(name) + ''.join(['{0:>10.1f}'.format(x) for x in row])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import snmp_replay
+
+"""
+========
+OVERVIEW
+========
+
+Records the SNMP responses of live servers into fixtures for bench_check_hp.py.
+
+Each server is checked once with the unchanged queryHPServer/querySmServer code, with every request passed through to
+the server and its answer kept (see snmp_replay.RecordingSession). PagerDuty is replaced with a fake, so nothing is
+triggered or resolved while recording. One <hostname>.json fixture is written per server.
+
+Usage: record_fixture.py [--kind HP|SM] [--community public] [--version 2] --output DIR hostname [hostname ...]
+"""
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description='Records SNMP responses from live servers into replay fixtures.')
+    parser.add_argument('hostnames', nargs='+', help='servers to record')
+    parser.add_argument('--kind', choices=['HP','SM'], default='HP', help='server type (default: HP)')
+    parser.add_argument('--community', default='public', help='SNMP community (default: public)')
+    parser.add_argument('--version', type=int, default=2, help='SNMP version (default: 2)')
+    parser.add_argument('--output', required=True, help='directory to write the fixtures to')
+    parser.add_argument('--check-hp', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'check_hp.py'),
+                        help='check_hp.py to record with (default: the one in this repository)')
+    return parser.parse_args()
+
+def main():
+    args = parseArgs()
+    logging.basicConfig(stream=sys.stderr, format='%(asctime)s: %(levelname)s: %(message)s', level=logging.INFO)
+    check_hp, pager = snmp_replay.setupCheckHp(args.check_hp, tempfile.mkdtemp(prefix='record_fixture.'))
+    manager = check_hp.M
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+
+    for hostname in args.hostnames:
+        fixture = snmp_replay.Fixture(hostname, args.kind, args.community, args.version)
+        check_hp.M = snmp_replay.recordingManager(manager, fixture)
+        if args.kind == "HP":
+            check_hp.queryHPServer(hostname, args.community, args.version)
+        else:
+            check_hp.querySmServer(hostname, args.community, args.version)
+        path = os.path.join(args.output, '{0}.json'.format(hostname))
+        fixture.save(path)
+        print '{0}: {1} values, {2} columns, {3} errors -> {4}'.format(hostname, len(fixture.values), len(fixture.walked), len(fixture.errors), path)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,550 @@
+#!/usr/bin/env python
+
+from pyasn1.codec.ber import encoder, decoder
+from pysnmp.proto import api
+from pysnmp.proto import rfc1902
+from pysnmp.proto import rfc1905
+import argparse
+import bisect
+import errno
+import heapq
+import multiprocessing
+import os
+import random
+import resource
+import select
+import socket
+import sys
+import time
+
+"""
+========
+OVERVIEW
+========
+
+Simulated fleet of SNMP agents on the loopback interface, for load testing the pollers on a single box.
+
+Every agent is a UDP socket on its own 127.0.0.1 port that answers SNMPv1/v2c GET, GETNEXT and GETBULK requests. The
+data each agent serves is generated from the MIBs bundled with the pollers, so the checks find the same tables and
+columns they read from real devices:
+
+    hp          - HP ProLiant (CPQHLTH, cpqsinfo, cpqida, cpqnic)            check_hp.py
+    sm          - SuperMicro (spot-ssm, SUPERMICRO-HEALTH-MIB)               check_hp.py
+    cisco-ios   - Cisco IOS (CISCO-ENVMON-MIB)                              check_cisco_hw.py
+    cisco-nxos  - Cisco NX-OS (ENTITY-MIB, CISCO-ENTITY-FRU-CONTROL/SENSOR)   check_cisco_hw.py
+    cisco-asa   - Cisco ASA (CISCO-FIREWALL-MIB)                            check_cisco_hw.py
+    arista      - Arista (ENTITY-MIB, ENTITY-SENSOR-MIB)                      check_arista_hw.py
+    brocade     - Brocade (SW, FA, FCMGMT-MIB)                               check_brocade.py
+    blade       - HP Onboard Administrator (cpqrack)                        check_hp_blade.py
+
+Every table of a profile's MIBs gets --rows rows (tables with more than one index get 2 entries for each of the other
+index parts), and every column gets a value of its type. Enumerations get a healthy value ("ok", "normal", "good"...),
+and the PROFILES below set the values the checks look at more closely (sysDescr, sensor readings and limits, status
+codes). The MIBs are parsed once per profile with snimpy/libsmi, the same way the pollers load them, and the data is
+shared by all the agents of that profile.
+
+Knobs:
+    --latency / --jitter       delay before every response, in milliseconds
+    --loss                     fraction of requests that are dropped
+    --slow / --slow-latency    fraction of agents that answer with a much larger delay
+    --dead                     fraction of agents that never answer
+    --faults                   fraction of agents with one failed component (a health column set to "failed" etc.)
+
+--inventory DIR writes the agent list in each poller's own format (snmp_servers for check_hp, cisco_devices,
+arista_devices, brocade_devices and device_list), with hosts written as 127.0.0.1:<port>. Point the pollers' docroot
+files at those lists to poll the simulated fleet.
+
+Each agent needs a file descriptor; the soft limit is raised to the hard limit when needed. With --processes the
+agents are split between several processes so the simulator itself is not the bottleneck.
+
+Usage: snmp_fleet.py --agents hp=2000,sm=500,cisco-nxos=50 [--base-port 20000] [--processes 4] [--inventory DIR]
+"""
+
+MIB_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SYS_UPTIME = (1, 3, 6, 1, 2, 1, 1, 3, 0)
+SYS_NAME = (1, 3, 6, 1, 2, 1, 1, 5, 0)
+MAX_VARBINDS = 1000
+
+#Labels used for enumerations, in order of preference. The first label a column has is used.
+HEALTHY_LABELS = ["ok", "good", "normal", "nominal", "on", "up", "online", "active", "enabled", "present", "true", "other"]
+FAULT_LABELS = ["failed", "critical", "faulty", "degraded", "generalFailure", "nonRecoverable", "notFunctioning",
+                "shutdown", "warning", "down", "off"]
+
+#mibs:     MIB files to load, in load order, relative to snmp_monitoring/
+#populate: the MIB files whose tables and scalars are generated
+#values:   column or scalar name -> value, or a list of values used in turn for each row
+#faults:   extra column name -> failed value, for columns that are not enumerations
+#inventory: (file name, line format) for --inventory
+PROFILES = {
+    "hp": {
+        "mibs": ["mibs/SNMPv2-MIB", "mibs/CPQHOST.MIB", "mibs/cpqsinfo.mib", "mibs/CPQHLTH.MIB", "mibs/cpqida.mib",
+                 "mibs/cpqstdeq.mib", "mibs/cpqnic.mib"],
+        "populate": ["mibs/SNMPv2-MIB", "mibs/cpqsinfo.mib", "mibs/CPQHLTH.MIB", "mibs/cpqida.mib", "mibs/cpqnic.mib"],
+        "values": {"sysDescr": "Linux sim-hp 2.6.32-431.el6.x86_64 #1 SMP x86_64",
+                   "cpqSeMibRevMajor": 10,
+                   "cpqHeTemperatureCelsius": [38, 41, 45, 29],
+                   "cpqHeTemperatureThreshold": 85,
+                   "cpqHeResMem2ModuleSize": 16777216},
+        "faults": {},
+        "inventory": ("snmp_servers", "{host},HP,ProLiant DL360p Gen8"),
+    },
+    "sm": {
+        "mibs": ["mibs/SNMPv2-MIB", "mibs/SUPERMICRO-SMI.my", "mibs/spot-ssm.my", "mibs/SUPERMICRO-HEALTH-MIB.my"],
+        "populate": ["mibs/SNMPv2-MIB", "mibs/spot-ssm.my", "mibs/SUPERMICRO-HEALTH-MIB.my"],
+        "values": {"sysDescr": "Linux sim-sm 2.6.32-431.el6.x86_64 #1 SMP x86_64",
+                   "smHealthMonitorType": [2, 0, 1, 3],
+                   "smHealthMonitorReading": [40, 3300, 5000, 0],
+                   "smHealthMonitorHighLimit": [80, 3500, 20000, 1],
+                   "smHealthMonitorLowLimit": [0, 3100, 1000, 0],
+                   "smHealthMonitorMonitor": 1,
+                   "memDeviceStatus": 0,
+                   "cpuDeviceStatus": 0,
+                   "raidAdapterAllinoneStatus": 0,
+                   "raidPDAllinoneStatus": 0,
+                   "raidVDAllinoneStatus": 0,
+                   "raidBBUAllinoneStatus": 0},
+        "faults": {"memDeviceStatus": 1, "cpuDeviceStatus": 1, "raidPDAllinoneStatus": 1, "raidVDAllinoneStatus": 1},
+        "inventory": ("snmp_servers", "{host},Supermicro,X9DRW"),
+    },
+    "cisco-ios": {
+        "mibs": ["check_cisco/mibs/CISCO-SMI.my", "check_cisco/mibs/CISCO-TC.my", "check_cisco/mibs/ENTITY-MIB.my",
+                 "check_cisco/mibs/SNMPv2-MIB", "check_cisco/mibs/CISCO-ENVMON-MIB.my"],
+        "populate": ["check_cisco/mibs/SNMPv2-MIB", "check_cisco/mibs/CISCO-ENVMON-MIB.my"],
+        "values": {"sysDescr": "Cisco IOS Software, C3750E Software (C3750E-UNIVERSALK9-M), Version 12.2(55)SE5",
+                   "ciscoEnvMonTemperatureStatusValue": 35,
+                   "ciscoEnvMonTemperatureThreshold": 60},
+        "faults": {},
+        "inventory": ("cisco_devices", "{host}"),
+    },
+    "cisco-nxos": {
+        "mibs": ["check_cisco/mibs/CISCO-SMI.my", "check_cisco/mibs/CISCO-TC.my", "check_cisco/mibs/ENTITY-MIB.my",
+                 "check_cisco/mibs/SNMPv2-MIB", "check_cisco/mibs/CISCO-ENTITY-FRU-CONTROL-MIB.mib",
+                 "check_cisco/mibs/CISCO-ENTITY-SENSOR-MIB.mib"],
+        "populate": ["check_cisco/mibs/SNMPv2-MIB", "check_cisco/mibs/ENTITY-MIB.my",
+                     "check_cisco/mibs/CISCO-ENTITY-FRU-CONTROL-MIB.mib", "check_cisco/mibs/CISCO-ENTITY-SENSOR-MIB.mib"],
+        "values": {"sysDescr": "Cisco NX-OS(tm) n7000, Software (n7000-s2-dk9), Version 6.2(2)",
+                   "entSensorValue": 35,
+                   "entSensorThresholdValue": 75,
+                   "entSensorThresholdEvaluation": "false"},
+        "faults": {"entSensorThresholdEvaluation": "true"},
+        "inventory": ("cisco_devices", "{host}"),
+    },
+    "cisco-asa": {
+        "mibs": ["check_cisco/mibs/CISCO-SMI.my", "check_cisco/mibs/CISCO-TC.my", "check_cisco/mibs/SNMPv2-MIB",
+                 "check_cisco/mibs/CISCO-FIREWALL-MIB.my"],
+        "populate": ["check_cisco/mibs/SNMPv2-MIB", "check_cisco/mibs/CISCO-FIREWALL-MIB.my"],
+        "values": {"sysDescr": "Cisco Adaptive Security Appliance Version 9.1(5)"},
+        "faults": {},
+        "inventory": ("cisco_devices", "{host}"),
+    },
+    "arista": {
+        "mibs": ["check_arista/mibs/ENTITY-MIB.my", "check_arista/mibs/SNMPv2-MIB", "check_arista/mibs/ENTITY-SENSOR-MIB.my",
+                 "check_arista/mibs/ARISTA-SMI-MIB.mib", "check_arista/mibs/ARISTA-ENTITY-SENSOR.txt"],
+        "populate": ["check_arista/mibs/SNMPv2-MIB", "check_arista/mibs/ENTITY-MIB.my", "check_arista/mibs/ENTITY-SENSOR-MIB.my"],
+        "values": {"sysDescr": "Arista Networks EOS version 4.13.7M running on an Arista Networks DCS-7050S-64",
+                   "entPhySensorUnitsDisplay": ["Celsius", "Amperes", "Volts", "RPM"],
+                   "entPhySensorValue": [250, 2, 12, 9000]},
+        "faults": {},
+        "inventory": ("arista_devices", "{host}"),
+    },
+    "brocade": {
+        "mibs": ["check_brocade/mibs/SNMPv2-MIB", "check_brocade/mibs/RFC1155-SMI.txt", "check_brocade/mibs/BRCD_REG.mib",
+                 "check_brocade/mibs/BRCD_TC.mib", "check_brocade/mibs/FA.mib", "check_brocade/mibs/FCMGMT-MIB.mib",
+                 "check_brocade/mibs/SW.mib", "check_brocade/mibs/HA.mib"],
+        "populate": ["check_brocade/mibs/SNMPv2-MIB", "check_brocade/mibs/FCMGMT-MIB.mib", "check_brocade/mibs/SW.mib",
+                     "check_brocade/mibs/HA.mib"],
+        "values": {"sysDescr": "Fibre Channel Switch."},
+        "faults": {},
+        "inventory": ("brocade_devices", "{host}"),
+    },
+    "blade": {
+        "mibs": ["check_blades/mibs/SNMPv2-MIB", "check_blades/mibs/CPQHOST.MIB", "check_blades/mibs/cpqrack_spot.mib"],
+        "populate": ["check_blades/mibs/SNMPv2-MIB", "check_blades/mibs/cpqrack_spot.mib"],
+        "values": {"sysDescr": "HP Onboard Administrator"},
+        "faults": {},
+        "inventory": ("device_list", "{host}"),
+    },
+}
+
+class Template(object):
+    """The data served by every agent of a profile: sorted instance OIDs and their pysnmp values."""
+
+    def __init__(self, name, values, health):
+        self.name = name
+        self.values = values          # instance oid -> pysnmp value
+        self.keys = sorted(values)
+        self.health = health          # list of (column oid, [instance oids], failed pysnmp value)
+
+    # Returns the first instance after an OID, or None at the end of the MIB view
+    def next(self, oid):
+        i = bisect.bisect_right(self.keys, oid)
+        if i >= len(self.keys):
+            return None
+        return self.keys[i]
+
+#Picks the first label from a preference list that an enumeration has. Returns the integer value or None.
+def pickLabel(enum, preferred):
+    labels = dict([(str(label), value) for value, label in enum.items()])
+    for label in preferred:
+        if label in labels:
+            return labels[label]
+    return None
+
+def rangeBounds(ranges):
+    if ranges is None:
+        return None, None
+    if not isinstance(ranges, list):
+        ranges = [ranges]
+    lows = []
+    highs = []
+    for r in ranges:
+        if isinstance(r, tuple):
+            lows.append(r[0])
+            highs.append(r[1])
+        else:
+            lows.append(r)
+            highs.append(r)
+    return min(lows), max(highs)
+
+# Returns the pysnmp value for a MIB node. 'value' comes from the profile; None generates one from the node's type.
+def makeValue(node, row, value=None):
+    kind = node.type.__name__
+    enum = node.enum
+    if enum and isinstance(value, str):
+        value = pickLabel(enum, [value])
+    if kind in ("Enum", "Boolean"):
+        if value is None:
+            value = pickLabel(enum or {1: "true", 2: "false"}, HEALTHY_LABELS)
+        if value is None:
+            value = sorted(enum)[0]
+        return rfc1902.Integer32(value)
+    low, high = rangeBounds(getattr(node, "ranges", None))
+    if kind in ("Integer", "Unsigned32", "Unsigned64"):
+        if value is None:
+            value = 10
+            if (low is not None) and (value < low or value > high):
+                value = low
+        if kind == "Unsigned64":
+            return rfc1902.Counter64(value)
+        if kind == "Unsigned32":
+            return rfc1902.Gauge32(value)
+        return rfc1902.Integer32(value)
+    if kind == "Timeticks":
+        return rfc1902.TimeTicks(value or 100)
+    if kind == "IpAddress":
+        return rfc1902.IpAddress(value or "127.0.0.1")
+    if kind == "Oid":
+        return rfc1902.ObjectIdentifier(value or (1, 3, 6, 1, 4, 1, 99999, row))
+    if value is None:
+        value = "{0} {1}".format(str(node), row)
+    value = str(value)
+    if (high is not None) and (len(value) > high):
+        value = value[:high]
+    if (low is not None) and (len(value) < low):
+        value = value + ("\x00" * (low - len(value)))
+    return rfc1902.OctetString(value)
+
+# Encodes one index value of a table row as OID components, the way an agent would
+def indexOid(node, value, implied):
+    kind = node.type.__name__
+    if kind in ("Integer", "Unsigned32", "Unsigned64", "Enum", "Boolean", "Timeticks"):
+        return (int(value),)
+    if kind == "IpAddress":
+        return tuple([int(x) for x in str(value).split('.')])
+    if kind == "Oid":
+        value = tuple(value)
+        return value if implied else (len(value),) + value
+    value = [ord(c) for c in str(value)]
+    return tuple(value) if implied else (len(value),) + tuple(value)
+
+# Returns the index values to use for every row of a table
+def tableRows(table, rows):
+    indexes = [[]]
+    for position, node in enumerate(table.index):
+        count = rows if position == 0 else 2
+        low, high = rangeBounds(getattr(node, "ranges", None))
+        kind = node.type.__name__
+        if kind in ("Integer", "Unsigned32", "Unsigned64", "Enum"):
+            start = 1 if (low is None or low <= 1) else low
+            values = range(start, start + count)
+            if node.enum:
+                values = sorted(node.enum)[:count]
+        elif kind == "IpAddress":
+            values = ["10.0.0.{0}".format(i) for i in range(1, count + 1)]
+        else:
+            values = ["{0}{1}".format(str(node)[:8], i) for i in range(1, count + 1)]
+        indexes = [index + [value] for index in indexes for value in values]
+    return indexes
+
+# Parses a profile's MIBs with snimpy/libsmi and generates its data
+def buildTemplate(name, rows):
+    from snimpy import mib
+    profile = PROFILES[name]
+    modules = {}
+    for path in profile["mibs"]:
+        modules[path] = mib.load(os.path.join(MIB_ROOT, path))
+    overrides = profile["values"]
+    values = {}
+    health = []
+    for path in profile["populate"]:
+        module = modules[path]
+        for node in mib.getScalars(module):
+            values[node.oid + (0,)] = makeValue(node, 0, overrides.get(str(node)))
+        for table in mib.getTables(module):
+            implied = getattr(table, "implied", False)
+            indexes = tableRows(table, rows)
+            index_names = [str(node) for node in table.index]
+            for column in table.columns:
+                instances = []
+                for number, index in enumerate(indexes):
+                    value = overrides.get(str(column))
+                    if isinstance(value, list):
+                        value = value[number % len(value)]
+                    if str(column) in index_names:
+                        value = index[index_names.index(str(column))]
+                    suffix = ()
+                    for position, part in enumerate(index):
+                        suffix += indexOid(table.index[position], part, implied and position == len(index) - 1)
+                    try:
+                        values[column.oid + suffix] = makeValue(column, number + 1, value)
+                        instances.append(column.oid + suffix)
+                    except Exception as inst:
+                        print >> sys.stderr, '{0}: skipping {1}: {2}'.format(name, column, inst)
+                        break
+                failed = None
+                if str(column) in profile["faults"]:
+                    failed = makeValue(column, 0, profile["faults"][str(column)])
+                elif column.enum and (pickLabel(column.enum, HEALTHY_LABELS[:-1]) is not None):
+                    bad = pickLabel(column.enum, FAULT_LABELS)
+                    if bad is not None:
+                        failed = rfc1902.Integer32(bad)
+                if (failed is not None) and instances:
+                    health.append((column.oid, instances, failed))
+    return Template(name, values, health)
+
+class Agent(object):
+    """One simulated device."""
+    __slots__ = ("port", "template", "overrides", "latency", "dead", "sock", "started")
+
+    def __init__(self, port, template, latency, dead):
+        self.port = port
+        self.template = template
+        self.overrides = {SYS_NAME: rfc1902.OctetString("sim-{0}-{1}".format(template.name, port))}
+        self.latency = latency
+        self.dead = dead
+        self.sock = None
+        self.started = time.time()
+
+    def injectFault(self, rng):
+        if self.template.health:
+            column, instances, failed = rng.choice(self.template.health)
+            self.overrides[rng.choice(instances)] = failed
+
+    def lookup(self, oid):
+        if oid == SYS_UPTIME:
+            return rfc1902.TimeTicks(int((time.time() - self.started) * 100))
+        value = self.overrides.get(oid)
+        if value is None:
+            value = self.template.values.get(oid)
+        return value
+
+    # Builds the response to one request, or returns None if it is not something we answer
+    def respond(self, data):
+        try:
+            version = int(api.decodeMessageVersion(data))
+            pMod = api.protoModules[version]
+            request, rest = decoder.decode(data, asn1Spec=pMod.Message())
+        except Exception:
+            return None
+        pdu = pMod.apiMessage.getPDU(request)
+        response = pMod.apiMessage.getResponse(request)
+        rpdu = pMod.apiMessage.getPDU(response)
+        binds = []
+        error = None
+        if pdu.isSameTypeWith(pMod.GetRequestPDU()):
+            for i, (oid, v) in enumerate(pMod.apiPDU.getVarBinds(pdu)):
+                value = self.lookup(tuple(oid))
+                if value is None:
+                    if version == api.protoVersion1:
+                        error = error or (2, i + 1)
+                        value = pMod.Null('')
+                    else:
+                        value = rfc1905.noSuchInstance
+                binds.append((oid, value))
+        elif pdu.isSameTypeWith(pMod.GetNextRequestPDU()):
+            for i, (oid, v) in enumerate(pMod.apiPDU.getVarBinds(pdu)):
+                binds.append(self.nextBind(tuple(oid), version))
+                if binds[-1][1] is None:
+                    error = error or (2, i + 1)
+                    binds[-1] = (oid, pMod.Null(''))
+        elif (version != api.protoVersion1) and pdu.isSameTypeWith(pMod.GetBulkRequestPDU()):
+            nonRepeaters = int(pMod.apiBulkPDU.getNonRepeaters(pdu))
+            repetitions = int(pMod.apiBulkPDU.getMaxRepetitions(pdu))
+            oids = [tuple(oid) for oid, v in pMod.apiBulkPDU.getVarBinds(pdu)]
+            for oid in oids[:nonRepeaters]:
+                binds.append(self.nextBind(oid, version))
+            current = oids[nonRepeaters:]
+            for r in range(max(repetitions, 0)):
+                if (not current) or (len(binds) >= MAX_VARBINDS):
+                    break
+                row = [self.nextBind(oid, version) for oid in current]
+                binds.extend(row)
+                if len([1 for oid, value in row if value is rfc1905.endOfMibView]) == len(row):
+                    break
+                current = [tuple(oid) for oid, value in row]
+        else:
+            return None
+        if error is not None:
+            pMod.apiPDU.setErrorStatus(rpdu, error[0])
+            pMod.apiPDU.setErrorIndex(rpdu, error[1])
+        pMod.apiPDU.setVarBinds(rpdu, binds)
+        return encoder.encode(response)
+
+    def nextBind(self, oid, version):
+        following = self.template.next(oid)
+        if following is None:
+            if version == api.protoVersion1:
+                return (oid, None)
+            return (oid, rfc1905.endOfMibView)
+        return (following, self.lookup(following))
+
+def raiseFileLimit(needed):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        target = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+        if target < needed:
+            print >> sys.stderr, 'Only {0} file descriptors are allowed; raise the hard limit (ulimit -Hn) for {1} agents'.format(target, needed)
+
+# Serves a list of agents until interrupted. Responses that have a delay are queued and sent when they are due.
+def serve(agents, loss, jitter, seed):
+    rng = random.Random(seed)
+    raiseFileLimit(len(agents) + 64)
+    poller = select.poll()
+    by_fd = {}
+    for agent in agents:
+        agent.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        agent.sock.setblocking(0)
+        agent.sock.bind(('127.0.0.1', agent.port))
+        by_fd[agent.sock.fileno()] = agent
+        poller.register(agent.sock, select.POLLIN)
+
+    pending = []
+    sequence = 0
+    while True:
+        timeout = 1000
+        if pending:
+            timeout = max(0, int((pending[0][0] - time.time()) * 1000))
+        for fd, event in poller.poll(timeout):
+            agent = by_fd[fd]
+            while True:
+                try:
+                    data, address = agent.sock.recvfrom(65535)
+                except socket.error as inst:
+                    if inst.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        break
+                    raise
+                if agent.dead or (loss > 0 and rng.random() < loss):
+                    continue
+                response = agent.respond(data)
+                if response is None:
+                    continue
+                delay = agent.latency + (rng.random() * jitter if jitter > 0 else 0)
+                if delay <= 0:
+                    agent.sock.sendto(response, address)
+                else:
+                    sequence += 1
+                    heapq.heappush(pending, (time.time() + delay, sequence, agent.sock, response, address))
+        now = time.time()
+        while pending and pending[0][0] <= now:
+            due, n, sock, response, address = heapq.heappop(pending)
+            sock.sendto(response, address)
+
+def parseAgents(text):
+    counts = []
+    for item in text.split(','):
+        name, count = item.split('=')
+        if name not in PROFILES:
+            raise SystemExit('Unknown profile "{0}". Profiles: {1}'.format(name, ', '.join(sorted(PROFILES))))
+        counts.append((name, int(count)))
+    return counts
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description='Runs a fleet of simulated SNMP agents on 127.0.0.1.')
+    parser.add_argument('--agents', required=True, help='profile=count list, e.g. hp=2000,sm=500,cisco-nxos=50')
+    parser.add_argument('--base-port', type=int, default=20000, help='port of the first agent (default: 20000)')
+    parser.add_argument('--rows', type=int, default=8, help='rows per table (default: 8)')
+    parser.add_argument('--latency', type=float, default=0.0, help='milliseconds before every response (default: 0)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many extra milliseconds per response (default: 0)')
+    parser.add_argument('--loss', type=float, default=0.0, help='fraction of requests dropped (default: 0)')
+    parser.add_argument('--slow', type=float, default=0.0, help='fraction of agents that are slow (default: 0)')
+    parser.add_argument('--slow-latency', type=float, default=2000.0, help='milliseconds before every response from a slow agent (default: 2000)')
+    parser.add_argument('--dead', type=float, default=0.0, help='fraction of agents that never answer (default: 0)')
+    parser.add_argument('--faults', type=float, default=0.0, help='fraction of agents with a failed component (default: 0)')
+    parser.add_argument('--processes', type=int, default=1, help='processes to split the agents between (default: 1)')
+    parser.add_argument('--inventory', help='directory to write the device lists for the pollers to')
+    parser.add_argument('--seed', type=int, default=1, help='random seed, so the same fleet can be started again (default: 1)')
+    return parser.parse_args()
+
+def writeInventory(directory, agents):
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    files = {}
+    for agent in agents:
+        filename, line = PROFILES[agent.template.name]["inventory"]
+        files.setdefault(filename, []).append(line.format(host='127.0.0.1:{0}'.format(agent.port)))
+    for filename, lines in files.items():
+        with open(os.path.join(directory, filename), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        print 'Wrote {0} devices to {1}'.format(len(lines), os.path.join(directory, filename))
+
+def main():
+    args = parseArgs()
+    rng = random.Random(args.seed)
+    counts = parseAgents(args.agents)
+
+    templates = {}
+    for name, count in counts:
+        if name not in templates:
+            start = time.time()
+            templates[name] = buildTemplate(name, args.rows)
+            print 'Profile {0}: {1} values, {2} health columns, {3:.1f} sec.'.format(name, len(templates[name].values), len(templates[name].health), time.time() - start)
+
+    agents = []
+    port = args.base_port
+    dead = slow = faulty = 0
+    for name, count in counts:
+        for i in range(count):
+            agent = Agent(port, templates[name], args.latency / 1000.0, rng.random() < args.dead)
+            if rng.random() < args.slow:
+                agent.latency = args.slow_latency / 1000.0
+                slow += 1
+            if rng.random() < args.faults:
+                agent.injectFault(rng)
+                faulty += 1
+            dead += agent.dead
+            agents.append(agent)
+            port += 1
+
+    if args.inventory:
+        writeInventory(args.inventory, agents)
+    print 'Serving {0} agents on 127.0.0.1:{1}-{2} with {3} processes. Dead: {4}; Slow: {5}; Faulty: {6}'.format(
+        len(agents), args.base_port, port - 1, args.processes, dead, slow, faulty)
+
+    if args.processes <= 1:
+        serve(agents, args.loss, args.jitter / 1000.0, args.seed)
+        return
+    workers = []
+    for p in range(args.processes):
+        worker = multiprocessing.Process(target=serve, args=(agents[p::args.processes], args.loss, args.jitter / 1000.0, args.seed + p))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
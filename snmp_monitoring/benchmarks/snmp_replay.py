@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+
+from snimpy.manager import DelegatedSession
+from snimpy import snmp
+import base64
+import bisect
+import imp
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+"""
+========
+OVERVIEW
+========
+
+SNMP record/replay for measuring check_hp.py without live servers or PagerDuty.
+
+RecordingSession is a snimpy session adapter that passes every GET and walk through to a live agent and keeps the
+values (and the errors) it got back. The result is saved as a JSON fixture, one file per host:
+
+    {"host": ..., "kind": "HP" or "SM", "community": ..., "version": ..., "recorded": <time>,
+     "values": {"<oid>": [<type>, <value>]}, "walked": ["<oid>", ...], "errors": {"get|walk <oid>,<oid>": [<class>, <message>]}}
+
+ReplaySession serves the same requests from a fixture. Every request counts as one PDU (a walk counts one GETBULK per
+'bulk' rows, the way snimpy walks) and waits 'latency' seconds per PDU, so the round trips of a real network can be
+added back in. A request that failed while recording fails the same way; anything that was never recorded is answered
+with noSuchObject.
+
+loadCheckHp loads check_hp.py from the repository (its two Salt expressions are replaced with a placeholder) and
+replayManager returns a replacement for check_hp.M that connects every device to its fixture instead of the network,
+so queryHPServer and querySmServer run unchanged.
+
+check_hp.py writes to /var/log/snmp_monitoring/ when it is loaded, so this has to run where that directory exists or
+can be created.
+"""
+
+BULK = 40
+
+def encodeValue(value):
+    if value is None:
+        return ["null", None]
+    if isinstance(value, bool):
+        return ["int", int(value)]
+    if isinstance(value, (int, long)):
+        return ["int", value]
+    if isinstance(value, unicode):
+        return ["str", base64.b64encode(value.encode('utf-8'))]
+    if isinstance(value, str):
+        return ["str", base64.b64encode(value)]
+    if isinstance(value, (tuple, list)):
+        return ["oid", [int(x) for x in value]]
+    return ["str", base64.b64encode(str(value))]
+
+def decodeValue(encoded):
+    kind, value = encoded
+    if kind == "int":
+        return value
+    if kind == "str":
+        return base64.b64decode(value)
+    if kind == "oid":
+        return tuple(value)
+    return None
+
+def oidString(oid):
+    return '.'.join([str(x) for x in oid])
+
+def oidTuple(text):
+    return tuple([int(x) for x in text.split('.')])
+
+def requestKey(kind, oids):
+    return '{0} {1}'.format(kind, ','.join([oidString(oid) for oid in oids]))
+
+class Fixture(object):
+    """Recorded SNMP responses of a single host."""
+
+    def __init__(self, host, kind, community="public", version=2):
+        self.host = host
+        self.kind = kind
+        self.community = community
+        self.version = version
+        self.recorded = time.time()
+        self.values = {}    # oid tuple -> snimpy value
+        self.walked = set() # column oid tuples that were walked
+        self.errors = {}    # request key -> (exception class name, message)
+        self.order = None   # sorted oids, built on first walk
+
+    def save(self, path):
+        data = {"host": self.host,
+                "kind": self.kind,
+                "community": self.community,
+                "version": self.version,
+                "recorded": self.recorded,
+                "values": dict([(oidString(oid), encodeValue(value)) for oid, value in self.values.items()]),
+                "walked": sorted([oidString(oid) for oid in self.walked]),
+                "errors": dict([(key, list(error)) for key, error in self.errors.items()])}
+        with open(path + '.tmp', 'w') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        os.rename(path + '.tmp', path)
+
+    # Returns every (oid, value) under a column, in OID order
+    def column(self, prefix):
+        if self.order is None:
+            self.order = sorted(self.values)
+        rows = []
+        for i in range(bisect.bisect_right(self.order, prefix), len(self.order)):
+            oid = self.order[i]
+            if oid[:len(prefix)] != prefix:
+                break
+            rows.append((oid, self.values[oid]))
+        return rows
+
+def loadFixture(path):
+    with open(path, 'r') as f:
+        data = json.load(f)
+    fixture = Fixture(str(data["host"]), str(data["kind"]), str(data.get("community", "public")), int(data.get("version", 2)))
+    fixture.recorded = data.get("recorded", 0)
+    fixture.values = dict([(oidTuple(oid), decodeValue(value)) for oid, value in data["values"].items()])
+    fixture.walked = set([oidTuple(oid) for oid in data.get("walked", [])])
+    fixture.errors = dict([(str(key), (str(error[0]), error[1].encode("utf-8"))) for key, error in data.get("errors", {}).items()])
+    return fixture
+
+# Loads every *.json fixture in a directory. Returns a dictionary of hostname -> Fixture.
+def loadFixtures(directory):
+    fixtures = {}
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.json'):
+            fixture = loadFixture(os.path.join(directory, name))
+            fixtures[fixture.host] = fixture
+    return fixtures
+
+def raiseError(error):
+    name, message = error
+    raise getattr(snmp, name, snmp.SNMPException)(message)
+
+class RecordingSession(DelegatedSession):
+    """Snimpy session adapter that keeps every answer from a live agent in a Fixture."""
+
+    def __init__(self, session, fixture):
+        DelegatedSession.__init__(self, session)
+        self.fixture = fixture
+
+    def get(self, *oids):
+        try:
+            results = self._session.get(*oids)
+        except snmp.SNMPException as inst:
+            self.fixture.errors[requestKey("get", oids)] = (inst.__class__.__name__, str(inst))
+            raise
+        for oid, value in results:
+            self.fixture.values[tuple(oid)] = value
+        return results
+
+    def walk(self, *oids):
+        try:
+            results = self._session.walk(*oids)
+        except snmp.SNMPException as inst:
+            self.fixture.errors[requestKey("walk", oids)] = (inst.__class__.__name__, str(inst))
+            raise
+        for oid, value in results:
+            self.fixture.values[tuple(oid)] = value
+        for oid in oids:
+            self.fixture.walked.add(tuple(oid))
+        return results
+
+class ReplaySession(DelegatedSession):
+    """Snimpy session adapter that answers every request from a Fixture, without any network traffic."""
+
+    def __init__(self, session, fixture, latency=0.0, bulk=BULK, counter=None):
+        DelegatedSession.__init__(self, session)
+        self.fixture = fixture
+        self.latency = latency
+        self.bulk = bulk
+        self.counter = counter
+
+    def send(self, pdus):
+        if self.counter is not None:
+            self.counter.add(pdus)
+        if self.latency > 0:
+            time.sleep(self.latency * pdus)
+
+    def get(self, *oids):
+        self.send(1)
+        error = self.fixture.errors.get(requestKey("get", oids))
+        if error is not None:
+            raiseError(error)
+        results = []
+        for oid in oids:
+            oid = tuple(oid)
+            if oid not in self.fixture.values:
+                raise snmp.SNMPNoSuchObject("No such object was recorded: {0}".format(oidString(oid)))
+            results.append((oid, self.fixture.values[oid]))
+        return tuple(results)
+
+    def walk(self, *oids):
+        error = self.fixture.errors.get(requestKey("walk", oids))
+        if error is not None:
+            self.send(1)
+            raiseError(error)
+        columns = [self.fixture.column(tuple(oid)) for oid in oids]
+        self.send((max([len(rows) for rows in columns] + [0]) // self.bulk) + 1)
+        return tuple([row for rows in columns for row in rows])
+
+class PduCounter(object):
+    """Thread safe count of the PDUs sent by ReplaySessions."""
+
+    def __init__(self):
+        self.pdus = 0
+        self.lock = threading.Lock()
+
+    def add(self, pdus):
+        with self.lock:
+            self.pdus += pdus
+
+# Loads check_hp.py as the module "check_hp". The Salt expressions in the template are replaced with 'replay'.
+def loadCheckHp(path):
+    directory = os.path.dirname(os.path.abspath(path))
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+    with open(path, 'r') as f:
+        source = re.sub(r'\{\{.*?\}\}', 'replay', f.read())
+    module = imp.new_module("check_hp")
+    module.__file__ = path
+    sys.modules["check_hp"] = module
+    exec compile(source, path, 'exec') in module.__dict__
+    return module
+
+# Loads check_hp.py and points it at a work directory instead of /opt/spot/snmp_monitoring/: the MIB index is built
+# there from the repository's MIBs, the exclusion list is empty and PagerDuty is replaced with a FakePager. Returns the
+# module and the FakePager.
+def setupCheckHp(path, workdir):
+    check_hp = loadCheckHp(path)
+    if not os.path.exists(workdir):
+        os.makedirs(workdir)
+    check_hp.docroot = os.path.join(workdir, '')
+    open(check_hp.docroot + 'snmp_exclusions', 'a').close()
+    check_hp.exclusions = check_hp.ExclusionFile(check_hp.docroot + 'snmp_exclusions')
+    mib_dir = os.path.join(os.path.dirname(os.path.abspath(path)), 'mibs', '')
+    check_hp.mib_cache.initMibs(mib_dir, check_hp.mib_files, check_hp.docroot + 'snmp_mib_index.json')
+    check_hp.pager = FakePager()
+    return check_hp, check_hp.pager
+
+# Returns a replacement for check_hp.M that serves every device from its fixture. Hosts without a fixture get an
+# empty one, so every request to them fails with noSuchObject.
+def replayManager(manager, fixtures, latency=0.0, bulk=BULK, counter=None):
+    def connect(host=None, **kwargs):
+        fixture = fixtures.get(host)
+        if fixture is None:
+            fixture = Fixture(host, "unknown")
+        kwargs["host"] = "127.0.0.1"
+        device = manager(**kwargs)
+        device._session = ReplaySession(device._session, fixture, latency, bulk, counter)
+        return device
+    return connect
+
+# Returns a replacement for check_hp.M that records every answer from the live device into the given fixture
+def recordingManager(manager, fixture):
+    def connect(**kwargs):
+        device = manager(**kwargs)
+        device._session = RecordingSession(device._session, fixture)
+        return device
+    return connect
+
+class FakePager(object):
+    """Stands in for the PagerDuty client. Counts the incidents check_hp would have sent."""
+
+    def __init__(self):
+        self.triggers = 0
+        self.resolves = 0
+        self.lock = threading.Lock()
+
+    def trigger_incident(self, service_key=None, incident_key=None, description=None, details=None):
+        with self.lock:
+            self.triggers += 1
+        return {"incident_key": incident_key}
+
+    def resolve_incident(self, service_key=None, incident_key=None, description=None, details=None):
+        with self.lock:
+            self.resolves += 1
+        return {"incident_key": incident_key}
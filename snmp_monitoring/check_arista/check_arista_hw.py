@@ -9,13 +9,30 @@ import subprocess
 import datetime
 from collections import defaultdict
 import os
+import sys
 import pygerduty
 
+#Shared SNMP engine, alarm index and journal and exclusion list, installed next to check_hp.py
+sys.path.append('/opt/spot/snmp_monitoring/')
+import snmp_engine
+from alarm_index import AlarmIndex
+from alarm_journal import AlarmJournal
+from exclusion_file import ExclusionFile
+
 #SET LOGGING INFO
 if not os.path.exists('/var/log/snmp_monitoring/'):
     os.mkdir('/var/log/snmp_monitoring/')
 logging.basicConfig(filename='/var/log/snmp_monitoring/check_arista_hw.log',format='%(asctime)s: %(levelname)s: %(message)s',level=logging.INFO)
+#OK detail messages are only built when they will be logged, or when there is an alarm they could resolve
+debug_enabled = logging.getLogger().isEnabledFor(logging.DEBUG)
 docroot = "/opt/spot/snmp_monitoring/check_arista/"
+previous_alarms = AlarmIndex()
+alarm_journal = AlarmJournal(docroot+'arista_snmp_alarms')
+exclusions = ExclusionFile(docroot+'arista_snmp_exclusions')
+
+#SNMP settings, used for both the probe and the device queries
+SNMP_TIMEOUT = 5
+SNMP_RETRIES = 3
 
 #COUNTERS
 totalStats = [0,0,0,0,0,0,0,0,0,0,0,0]
@@ -40,11 +57,11 @@ def sendToPagerDuty(type,key,desc,det):
     #print 'Send to PD: {0}; {1}; {2}; {3}'.format(type,key,desc,det)
     SPOT_API_TOKEN="<Your PagerDuty API token>"
     SERVICE_API_TOKEN="Your PagerDuty service API token"
-    pager = pygerduty.PagerDuty(api_token=SPOT_API_TOKEN)
     if type == "trigger":
         if checkForExclusion(key) is False:
+            pager = pygerduty.PagerDuty(api_token=SPOT_API_TOKEN)
             incident = pager.trigger_incident(service_key=SERVICE_API_TOKEN, incident_key=key, description=desc, details=det)
-            writeToFile(key)
+            alarm_journal.record(key)
             logging.info('<Your PagerDuty domain>\tPAGER\tCreating Alarm: {0}'.format(key))
             return incident
         else:
@@ -53,37 +70,25 @@ def sendToPagerDuty(type,key,desc,det):
     elif type == "resolve":
         if checkForAlarm(key):
             logging.info('<Your PagerDuty domain>\tPAGER\tResolving Open Incident: {0}'.format(key))
+            pager = pygerduty.PagerDuty(api_token=SPOT_API_TOKEN)
             incident = pager.resolve_incident(service_key=SERVICE_API_TOKEN, incident_key=key, description=desc, details=det)
             return incident
 
-def writeToFile(key):
-    with open(docroot+'arista_snmp_alarms_current','a') as f:
-        f.write('{0}\n'.format(key))
-
 def checkForAlarm(key):
-    result = False
-    with open(docroot+'arista_snmp_alarms_previous','r') as f:
-        for line in f:
-            if line[:-1] == key:
-                result = True
-                return result
-    return result
+    return key in previous_alarms
+
+# True if the previous run left an alarm open for a device, so a resolve for one of its components might be sent
+def hostHasAlarms(host):
+    return previous_alarms.hostHasAlarms(host)
 
 def logPreviousAlarms():
-    logging.info('PREVIOUS ALARMS\tPrinting previous alarms from file')
-    with open(docroot+'arista_snmp_alarms_previous','r') as f:
-        for line in f:
-            logging.info('PREVIOUS ALARMS\t{0}'.format(line))
+    logging.info('PREVIOUS ALARMS\tPrinting previous alarms')
+    for key in sorted(previous_alarms):
+        logging.info('PREVIOUS ALARMS\t{0}'.format(key))
     logging.info('PREVIOUS ALARMS\tOutput complete')
 
 def checkForExclusion(key):
-    result = False
-    with open(docroot+'arista_snmp_exclusions','r') as f:
-        for line in f:
-            if line[:-1] == key:
-                result = True
-                return result
-    return result
+    return key in exclusions
 
 def touch(fname):
     if os.path.exists(fname):
@@ -128,9 +133,10 @@ def querySensors(device,hostname):
                 sendToPagerDuty("trigger","snmp/temperature/{0}/{1}".format(hostname,index),"Temperature issue detected on {0}".format(hostname),msg)
             else:
                 t_ok +=1
-                msg = 'OK for Temperature Sensor({0}): Value = {1} {2}; Threshold = {3}; OperStatus = {4}; ID = {5}'.format(name,value,unit,threshold,status,index)
-                logging.debug('{0}\tTEMP\t{1}'.format(hostname,msg))
-                sendToPagerDuty("resolve","snmp/temperature/{0}/{1}".format(hostname,index),"No issues detected",msg)
+                if debug_enabled or hostHasAlarms(hostname):
+                    msg = 'OK for Temperature Sensor({0}): Value = {1} {2}; Threshold = {3}; OperStatus = {4}; ID = {5}'.format(name,value,unit,threshold,status,index)
+                    logging.debug('{0}\tTEMP\t{1}'.format(hostname,msg))
+                    sendToPagerDuty("resolve","snmp/temperature/{0}/{1}".format(hostname,index),"No issues detected",msg)
         elif unit == "Amperes":
             p_total +=1
             threshold = 'UNDEFINED'
@@ -142,9 +148,10 @@ def querySensors(device,hostname):
                 sendToPagerDuty("trigger","snmp/power/amps/{0}/{1}".format(hostname,index),"Power issue detected on {0}".format(hostname),msg)
             else:
                 p_ok +=1
-                msg = 'OK for Power Sensor({0}): Value = {1} {2}; Threshold = {3}; OperStatus = {4}; ID = {5}'.format(name,value,unit,threshold,status,index)
-                logging.debug('{0}\tPSU\t{1}'.format(hostname,msg))
-                sendToPagerDuty("resolve","snmp/power/amps/{0}/{1}".format(hostname,index),"No issues detected",msg)
+                if debug_enabled or hostHasAlarms(hostname):
+                    msg = 'OK for Power Sensor({0}): Value = {1} {2}; Threshold = {3}; OperStatus = {4}; ID = {5}'.format(name,value,unit,threshold,status,index)
+                    logging.debug('{0}\tPSU\t{1}'.format(hostname,msg))
+                    sendToPagerDuty("resolve","snmp/power/amps/{0}/{1}".format(hostname,index),"No issues detected",msg)
         elif unit == "Volts":
             p_total +=1
             threshold = 'UNDEFINED'
@@ -156,9 +163,10 @@ def querySensors(device,hostname):
                 sendToPagerDuty("trigger","snmp/power/volts/{0}/{1}".format(hostname,index),"Power issue detected on {0}".format(hostname),msg)
             else:
                 p_ok +=1
-                msg = 'OK for Power Sensor({0}): Value = {1} {2}; Threshold = {3}; OperStatus = {4}; ID = {5}'.format(name,value,unit,threshold,status,index)
-                logging.debug('{0}\tPSU\t{1}'.format(hostname,msg))
-                sendToPagerDuty("resolve","snmp/power/volts/{0}/{1}".format(hostname,index),"No issues detected",msg)
+                if debug_enabled or hostHasAlarms(hostname):
+                    msg = 'OK for Power Sensor({0}): Value = {1} {2}; Threshold = {3}; OperStatus = {4}; ID = {5}'.format(name,value,unit,threshold,status,index)
+                    logging.debug('{0}\tPSU\t{1}'.format(hostname,msg))
+                    sendToPagerDuty("resolve","snmp/power/volts/{0}/{1}".format(hostname,index),"No issues detected",msg)
         elif unit == "RPM":
             f_total +=1
             threshold = 'UNDEFINED'
@@ -170,9 +178,10 @@ def querySensors(device,hostname):
                 sendToPagerDuty("trigger","snmp/fan/{0}/{1}".format(hostname,index),"Fan issue detected on {0}".format(hostname),msg)
             else:
                 f_ok +=1
-                msg = 'OK for Fan Sensor({0}): Value = {1} {2}; Threshold = {3}; OperStatus = {4}; ID = {5}'.format(name,value,unit,threshold,status,index)
-                logging.debug('{0}\tFAN\t{1}'.format(hostname,msg))
-                sendToPagerDuty("resolve","snmp/fan/{0}/{1}".format(hostname,index),"No issues detected",msg)
+                if debug_enabled or hostHasAlarms(hostname):
+                    msg = 'OK for Fan Sensor({0}): Value = {1} {2}; Threshold = {3}; OperStatus = {4}; ID = {5}'.format(name,value,unit,threshold,status,index)
+                    logging.debug('{0}\tFAN\t{1}'.format(hostname,msg))
+                    sendToPagerDuty("resolve","snmp/fan/{0}/{1}".format(hostname,index),"No issues detected",msg)
         else:
             o_total +=1
             allowed_status = ['ok(1)']
@@ -183,28 +192,33 @@ def querySensors(device,hostname):
                 sendToPagerDuty("trigger","snmp/other/{0}/{1}".format(hostname,index),"Sensor issue detected on {0}".format(hostname),msg)
             else:
                 o_ok +=1
-                msg = 'OK for Sensor({0}): Value = {1} {2}; OperStatus = {3}; ID = {4}'.format(name,value,unit,status,index)
-                logging.debug('{0}\tOTHER\t{1}'.format(hostname,msg))
-                sendToPagerDuty("resolve","snmp/other/{0}/{1}".format(hostname,index),"No issues detected",msg)
+                if debug_enabled or hostHasAlarms(hostname):
+                    msg = 'OK for Sensor({0}): Value = {1} {2}; OperStatus = {3}; ID = {4}'.format(name,value,unit,status,index)
+                    logging.debug('{0}\tOTHER\t{1}'.format(hostname,msg))
+                    sendToPagerDuty("resolve","snmp/other/{0}/{1}".format(hostname,index),"No issues detected",msg)
 
     return t_total,t_ok,t_failed,p_total,p_ok,p_failed,f_total,f_ok,f_failed,o_total,o_ok,o_failed
 
+# Logs a failed connection and sends the snmp/connect alarm (only during the day)
+def connectFailed(hostname,inst):
+    msg = 'Exception occurred while connecting to {0}. Exception = "{1}"'.format(hostname,inst)
+    logging.warning('{0}\tERROR\t{1}'.format(hostname,inst))
+    t = datetime.datetime.now().timetuple()
+    #only generate alarm during the day
+    if (t[3]>=7) and (t[3]<=19):
+        print 'sending alarm...'
+        sendToPagerDuty("trigger","snmp/connect/{0}".format(hostname),"Unable to query SNMP on {0}".format(hostname),msg)
+
 def queryDevice(hostname,comm,ver):
     global deviceCount
     #Connect to device
     try:
-        device = M(host=hostname,community=comm,version=ver,timeout=5,retries=3)
+        device = M(host=hostname,community=comm,version=ver,timeout=SNMP_TIMEOUT,retries=SNMP_RETRIES)
         desc = device.sysDescr
         msg = 'Successfully connected to {0}.'.format(hostname)
         sendToPagerDuty("resolve","snmp/connect/{0}".format(hostname),"SNMP agent is responding on {0}".format(hostname),msg)
     except Exception as inst:
-        msg = 'Exception occurred while connecting to {0}. Exception = "{1}"'.format(hostname,inst)
-        logging.warning('{0}\tERROR\t{1}'.format(hostname,inst))
-        t = datetime.datetime.now().timetuple()
-        #only generate alarm during the day
-        if (t[3]>=7) and (t[3]<=19):
-            print 'sending alarm...'
-            incident = sendToPagerDuty("trigger","snmp/connect/{0}".format(hostname),"Unable to query SNMP on {0}".format(hostname),msg)
+        connectFailed(hostname,inst)
         return
 
     deviceCount += 1
@@ -222,21 +236,16 @@ def queryDevice(hostname,comm,ver):
         totalStats[i]+=deviceResults[i]
 
 def main():
+    global previous_alarms
     logging.info('***************************************************************************')
     logging.info('Starting Script')
 
     #Prepare stats file
-    touch(docroot + 'arista_snmp_alarms_current')
     touch(docroot + 'arista_snmp_exclusions')
-    os.rename(docroot+'arista_snmp_alarms_current',docroot+'arista_snmp_alarms_previous')
-    touch(docroot + 'arista_snmp_alarms_current')
+    previous_alarms = AlarmIndex(alarm_journal.open())
 
-    #Parse previous alarms file and output to log file for debugging
-    try:
-        logPreviousAlarms()
-    except Exception as inst:
-        msg = 'Exception occurred while parsing previous alarms file. Exception: {0}'.format(inst)
-        logging.warning(msg)
+    #Output previous alarms to log file for debugging
+    logPreviousAlarms()
 
     #Load required MIBs
     load(docroot + "mibs/ENTITY-MIB.my")
@@ -250,18 +259,24 @@ def main():
         deviceFile = open(docroot+'arista_devices','r')
         comm = "public"
         ver = 2
-        for line in deviceFile:
-            if line[0:1] != "#":
-                start = time.time()
-                hostname = line[:-1]
+        hostnames = [line[:-1] for line in deviceFile if line[0:1] != "#"]
+
+        #Probe every device at once. Devices that do not answer get their connect alarm here and are not queried.
+        unreachable = snmp_engine.probeDevices(hostnames,comm,ver,SNMP_TIMEOUT,SNMP_RETRIES)
+        for hostname in hostnames:
+            start = time.time()
+            if hostname in unreachable:
+                connectFailed(hostname,unreachable[hostname])
+            else:
                 queryDevice(hostname,comm,ver)
-                end = time.time()
-                print '{0} - {1} - {2} sec. {3} total sec.'.format(deviceCount,hostname,(end-start),(end-script_start))
+            end = time.time()
+            print '{0} - {1} - {2} sec. {3} total sec.'.format(deviceCount,hostname,(end-start),(end-script_start))
     except Exception as inst:
         msg = 'Exception occurred in main function. Exception = "{0}"'.format(inst)
         logging.warning('MAIN\tERROR\t{0}'.format(msg))
 
     logging.info('TOTAL\tSTATS\t(Checked,OK,Error) || Temp({1},{2},{3}) || PSU({4},{5},{6}) || FAN({7},{8},{9}) || Other({10},{11},{12}) || Devices({0})'.format(deviceCount,*totalStats))
+    alarm_journal.close()
     logging.info('Script Complete')
 
 
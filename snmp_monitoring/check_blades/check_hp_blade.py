@@ -8,6 +8,7 @@ import logging
 import subprocess
 import pygerduty
 import os
+import sys
 import datetime
 from collections import defaultdict
 
@@ -55,12 +56,25 @@ because that would be well over PD's API rate limit.
                         If it is a new issue, a new incident will be created. Else, it will be added to the existing incident.         
 """
 
+#Shared SNMP engine, alarm index and exclusion list, installed next to check_hp.py
+sys.path.append('/opt/spot/snmp_monitoring/')
+import snmp_engine
+from alarm_index import AlarmIndex
+from exclusion_file import ExclusionFile
+
 #SET LOGGING INFO
 if not os.path.exists('/var/log/snmp_monitoring/'):
     os.mkdir('/var/log/snmp_monitoring/')
 logging.basicConfig(filename='/var/log/snmp_monitoring/check_hp_blade.log',format='%(asctime)s: %(levelname)s: %(message)s',level=logging.INFO)
+#OK detail messages are only built when they will be logged, or when there is an incident they could resolve
+debug_enabled = logging.getLogger().isEnabledFor(logging.DEBUG)
 docroot = "/opt/spot/snmp_monitoring/check_blades/"
-open_alarms = []
+open_alarms = AlarmIndex()
+exclusions = ExclusionFile(docroot+'hp_blade_snmp_exclusions')
+
+#SNMP settings, used for both the probe and the device queries
+SNMP_TIMEOUT = 30
+SNMP_RETRIES = 1
 
 #COUNTERS
 totalStats = [0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0]
@@ -70,9 +84,9 @@ def sendToPagerDuty(type,key,desc,det):
     SPOT_API_TOKEN="<Your PagerDuty API Token>"
     SERVICE_API_TOKEN="<Your PagerDuty service token>"
     try:
-        pager = pygerduty.PagerDuty(api_token=SPOT_API_TOKEN)
         if type == "trigger":
             if checkForExclusion(key) is False:
+                pager = pygerduty.PagerDuty(api_token=SPOT_API_TOKEN)
                 incident = pager.trigger_incident(service_key=SERVICE_API_TOKEN, incident_key=key, description=desc, details=det)
                 logging.info('<Your PagerDuty domain>\tPAGER\tCreating Alarm: {0}'.format(key))
                 return incident
@@ -82,6 +96,7 @@ def sendToPagerDuty(type,key,desc,det):
         elif type == "resolve":
             if checkForAlarm(key):
                 logging.info('<Your PagerDuty domain>\tPAGER\tResolving Open Incident: {0}'.format(key))
+                pager = pygerduty.PagerDuty(api_token=SPOT_API_TOKEN)
                 incident = pager.resolve_incident(service_key=SERVICE_API_TOKEN, incident_key=key, description=desc, details=det)
                 return incident
     except Exception as inst:
@@ -95,7 +110,7 @@ def getCurrentAlarms():
     SPOT_API_TOKEN="<Your PagerDuty token>"
     pager = pygerduty.PagerDuty(api_token=SPOT_API_TOKEN)
     for incident in pager.incidents.list(status="triggered,acknowledged"):
-        open_alarms.append(incident.incident_key)
+        open_alarms.add(incident.incident_key)
         logging.info('PAGER\tOPEN INCIDENTS\t{0}'.format(incident.incident_key))
 
 def checkForAlarm(key):
@@ -103,14 +118,12 @@ def checkForAlarm(key):
         return True
     return False
 
+# True if a device has any open incident, so a resolve for one of its components might be sent
+def hostHasAlarms(host):
+    return open_alarms.hostHasAlarms(host)
+
 def checkForExclusion(key):
-    result = False
-    with open(docroot+'hp_blade_snmp_exclusions','r') as f:
-        for line in f:
-            if line[:-1] == key:
-                result = True
-                return result
-    return result
+    return key in exclusions
 
 def touch(fname):
     if os.path.exists(fname):
@@ -143,9 +156,10 @@ def queryFans(device,host):
             logging.warning('{0}\t{2}\t{1}'.format(host,msg,current_check.upper()))
         else:
             ok += 1
-            msg = 'OK for {0} Sensor: Condition = {1}; Location = {2}; EnclosureSerial = {3}; Present = {4}; PartNum = {5}; SparePartNum = {6}'.format(current_check,fanCondition,fanLocation,fanEncSerial,fanPresent,fanPartNum,fanSparePartNum)
-            logging.debug('{0}\t{2}\t{1}'.format(host,msg,current_check.upper()))
-            sendToPagerDuty("resolve","snmp/{2}/{0}/{1}".format(host,index,current_check.lower()),"No {0} issues detected".format(current_check),msg)
+            if debug_enabled or hostHasAlarms(host):
+                msg = 'OK for {0} Sensor: Condition = {1}; Location = {2}; EnclosureSerial = {3}; Present = {4}; PartNum = {5}; SparePartNum = {6}'.format(current_check,fanCondition,fanLocation,fanEncSerial,fanPresent,fanPartNum,fanSparePartNum)
+                logging.debug('{0}\t{2}\t{1}'.format(host,msg,current_check.upper()))
+                sendToPagerDuty("resolve","snmp/{2}/{0}/{1}".format(host,index,current_check.lower()),"No {0} issues detected".format(current_check),msg)
         
         #print 'FAN: {0} - {1} - {2} - {3} - {4} - {5}'.format(fanCondition, fanEncSerial, fanLocation, fanPartNum, fanSparePartNum, fanPresent)
     return total,ok,failed
@@ -169,9 +183,10 @@ def queryTemp(device,host):
             logging.warning('{0}\t{2}\t{1}'.format(host,msg,current_check.upper()))
         else:
             ok += 1
-            msg = 'OK for {0} Sensor: Condition = {1}; Location = {2}; Current = {3}; Threshold = {4}; Serial = {5}'.format(current_check,tempCondition,tempLocation,tempCurrent,tempThreshold,tempSerial)
-            logging.debug('{0}\t{2}\t{1}'.format(host,msg,current_check.upper()))
-            sendToPagerDuty("resolve","snmp/{2}/{0}/{1}".format(host,index,current_check.lower()),"No {0} issues detected".format(current_check),msg)
+            if debug_enabled or hostHasAlarms(host):
+                msg = 'OK for {0} Sensor: Condition = {1}; Location = {2}; Current = {3}; Threshold = {4}; Serial = {5}'.format(current_check,tempCondition,tempLocation,tempCurrent,tempThreshold,tempSerial)
+                logging.debug('{0}\t{2}\t{1}'.format(host,msg,current_check.upper()))
+                sendToPagerDuty("resolve","snmp/{2}/{0}/{1}".format(host,index,current_check.lower()),"No {0} issues detected".format(current_check),msg)
 
         #print 'TEMP: {0} - {1} - {2} - {3} - {4}'.format(tempSerial,tempLocation,tempCurrent,tempThreshold,tempCondition)
     return total,ok,failed
@@ -201,9 +216,10 @@ def queryPower(device,host):
             logging.warning('{0}\t{2}\t{1}'.format(host,msg,current_check.upper()))
         else:
             ok += 1
-            msg = 'OK for {0} Sensor: Condition = {1}; Status = {2}; InputLineStatus = {3}; Present = {4}; EnclosureSerial = {5}; Serial = {6}; PartNumber = {7}; SparePartNumber = {8}'.format(current_check,powerCondition,powerStatus,powerInputLineStatus,powerPresent,powerEnclosureSerialNum,powerSerialNum,powerPartNumber,powerSparePartNumber)
-            logging.debug('{0}\t{2}\t{1}'.format(host,msg,current_check.upper()))
-            sendToPagerDuty("resolve","snmp/{2}/{0}/{1}".format(host,index,current_check.lower()),"No {0} issues detected".format(current_check),msg)
+            if debug_enabled or hostHasAlarms(host):
+                msg = 'OK for {0} Sensor: Condition = {1}; Status = {2}; InputLineStatus = {3}; Present = {4}; EnclosureSerial = {5}; Serial = {6}; PartNumber = {7}; SparePartNumber = {8}'.format(current_check,powerCondition,powerStatus,powerInputLineStatus,powerPresent,powerEnclosureSerialNum,powerSerialNum,powerPartNumber,powerSparePartNumber)
+                logging.debug('{0}\t{2}\t{1}'.format(host,msg,current_check.upper()))
+                sendToPagerDuty("resolve","snmp/{2}/{0}/{1}".format(host,index,current_check.lower()),"No {0} issues detected".format(current_check),msg)
 
         #print 'POWER: {0} - {1} - {2} - {3} - {4} - {5} - {6} - {7} - {8}'.format(powerPosition,powerStatus,    powerInputLineStatus,   powerPresent,   powerCondition, powerEnclosureSerialNum,    powerSerialNum, powerPartNumber,    powerSparePartNumber)
     return total,ok,failed
@@ -232,9 +248,10 @@ def queryEnclosure(device,host,any_alarm):
                 logging.warning('{0}\tNot generating Enclosure alarm because we already generated alarm for this device. This prevents creating redundant alarms for the same issue.'.format(host))
         else:
             ok += 1
-            msg = 'OK for {0} Sensor: Condition = {1}; Name = {2}; Model = {3}; Serial = {4}; PartNumber = {5}; SparePartNumber = {6}; FirmwareRev = {7}'.format(current_check,enclosureCondition,enclosureName,enclosureModel,enclosureSerialNum,enclosurePartNumber,enclosureSparePartNumber,enclosureFWRev)
-            logging.debug('{0}\t{2}\t{1}'.format(host,msg,current_check.upper()))
-            sendToPagerDuty("resolve","snmp/{2}/{0}/{1}".format(host,index,current_check.lower()),"No {0} issues detected".format(current_check),msg)
+            if debug_enabled or hostHasAlarms(host):
+                msg = 'OK for {0} Sensor: Condition = {1}; Name = {2}; Model = {3}; Serial = {4}; PartNumber = {5}; SparePartNumber = {6}; FirmwareRev = {7}'.format(current_check,enclosureCondition,enclosureName,enclosureModel,enclosureSerialNum,enclosurePartNumber,enclosureSparePartNumber,enclosureFWRev)
+                logging.debug('{0}\t{2}\t{1}'.format(host,msg,current_check.upper()))
+                sendToPagerDuty("resolve","snmp/{2}/{0}/{1}".format(host,index,current_check.lower()),"No {0} issues detected".format(current_check),msg)
         
         #print 'ENCLOSURE: {0} - {1} - {2} - {3} - {4} - {5} - {6}'.format(enclosureCondition,enclosureModel,enclosurePartNumber,enclosureSparePartNumber,enclosureSerialNum,enclosureFWRev,enclosureName)
     return total,ok,failed
@@ -263,9 +280,10 @@ def queryEnclosureManager(device,host):
             logging.warning('{0}\t{2}\t{1}'.format(host,msg,current_check.upper()))
         else:
             ok += 1
-            msg = 'OK for {0} Sensor: Condition = {1}; Role = {2}; Redundant = {3}; EnclosureSerial = {4}; Serial = {5}; PartNumber = {6}; SparePartNumber = {7}; FirmwareRev = {8}'.format(current_check,managerCondition, managerRole, managerRedundant, managerEnclosureSerialNum, managerSerialNum, managerPartNumber, managerSparePartNumber, managerFWRev)
-            logging.debug('{0}\t{2}\t{1}'.format(host,msg,current_check.upper()))
-            sendToPagerDuty("resolve","snmp/{2}/{0}/{1}".format(host,index,current_check.lower()),"No {0} issues detected".format(current_check),msg)
+            if debug_enabled or hostHasAlarms(host):
+                msg = 'OK for {0} Sensor: Condition = {1}; Role = {2}; Redundant = {3}; EnclosureSerial = {4}; Serial = {5}; PartNumber = {6}; SparePartNumber = {7}; FirmwareRev = {8}'.format(current_check,managerCondition, managerRole, managerRedundant, managerEnclosureSerialNum, managerSerialNum, managerPartNumber, managerSparePartNumber, managerFWRev)
+                logging.debug('{0}\t{2}\t{1}'.format(host,msg,current_check.upper()))
+                sendToPagerDuty("resolve","snmp/{2}/{0}/{1}".format(host,index,current_check.lower()),"No {0} issues detected".format(current_check),msg)
         
         #print 'MANAGER: {0} - {1} - {2} - {3} - {4} - {5} - {6} - {7} - {8} - {9}'.format(managerPresent,managerRedundant,managerCondition,managerEnclosureSerialNum,managerFWRev,managerEnclosureName,managerPartNumber,managerSparePartNumber,managerSerialNum,managerRole)
     return total,ok,failed
@@ -292,9 +310,10 @@ def queryPowerEnclosure(device,host,psu_alarm):
                 logging.warning('{0}\tNot generating Power Enclosure alarm because we already generated alarm for a power supply. This prevents creating redundant alarms for the same issue.'.format(host))
         else:
             ok += 1
-            msg = 'OK for {0} Sensor: Condition = {1}; Name = {2}; Redundant = {3}; LoadBalanced = {4}; MgmtBoardSerial = {5}'.format(current_check, powerEncCondition, powerEncName,powerEncRedundant, powerEncLoadBalanced, powerEncMgmtBoardSerialNum)
-            logging.debug('{0}\t{2}\t{1}'.format(host,msg,current_check.upper()))
-            sendToPagerDuty("resolve","snmp/{2}/{0}/{1}".format(host,index,current_check.lower()),"No {0} issues detected".format(current_check),msg)
+            if debug_enabled or hostHasAlarms(host):
+                msg = 'OK for {0} Sensor: Condition = {1}; Name = {2}; Redundant = {3}; LoadBalanced = {4}; MgmtBoardSerial = {5}'.format(current_check, powerEncCondition, powerEncName,powerEncRedundant, powerEncLoadBalanced, powerEncMgmtBoardSerialNum)
+                logging.debug('{0}\t{2}\t{1}'.format(host,msg,current_check.upper()))
+                sendToPagerDuty("resolve","snmp/{2}/{0}/{1}".format(host,index,current_check.lower()),"No {0} issues detected".format(current_check),msg)
        
         #print 'PWR ENCLOSURE: {0} - {1} - {2} - {3} - {4}'.format(powerEncName,powerEncMgmtBoardSerialNum,powerEncRedundant,powerEncLoadBalanced,powerEncCondition) 
     return total,ok,failed
@@ -324,29 +343,34 @@ def queryBlades(device,host):
                 logging.warning('{0}\t{2}\t{1}'.format(host,msg,current_check.upper()))
             else:
                 ok += 1
-                msg = 'OK for {0} Sensor: Status = {1}; Name = {2}; MinorFault = {3}; MajorFault = {4}; FaultDiagString = {5}; Serial = {6}; ProductId = {7}; PartNumber = {8}; SparePartNumber = {9}'.format(current_check, bladeStatus, bladeName, bladeFaultMinor, bladeFaultMajor, bladeFaultString, bladeSerial, bladeProductID, bladePartNum, bladeSparePartNum)
-                logging.debug('{0}\t{2}\t{1}'.format(host,msg,current_check.upper()))
-                sendToPagerDuty("resolve","snmp/{2}/{0}/{1}".format(host,index,current_check.lower()),"No {0} issues detected".format(current_check),msg)
+                if debug_enabled or hostHasAlarms(host):
+                    msg = 'OK for {0} Sensor: Status = {1}; Name = {2}; MinorFault = {3}; MajorFault = {4}; FaultDiagString = {5}; Serial = {6}; ProductId = {7}; PartNumber = {8}; SparePartNumber = {9}'.format(current_check, bladeStatus, bladeName, bladeFaultMinor, bladeFaultMajor, bladeFaultString, bladeSerial, bladeProductID, bladePartNum, bladeSparePartNum)
+                    logging.debug('{0}\t{2}\t{1}'.format(host,msg,current_check.upper()))
+                    sendToPagerDuty("resolve","snmp/{2}/{0}/{1}".format(host,index,current_check.lower()),"No {0} issues detected".format(current_check),msg)
             
             #print 'BLADE: {0} - {1} - {2} - {3} - {4} - {5} - {6} - {7} - {8} - {9} - {10}'.format(host,bladePresent,bladeName,bladeStatus,bladeFaultMinor,bladeFaultMajor,bladeFaultString,bladeSerial,bladeProductID,bladePartNum,bladeSparePartNum)
     return total,ok,failed
 
+# Logs a failed connection and sends the snmp/connect alarm (only during the day)
+def connectFailed(hostname,inst):
+    msg = 'Exception occurred while connecting to {0}. Exception = "{1}"'.format(hostname,inst)
+    logging.warning('{0}\tERROR\t{1}'.format(hostname,inst))
+    t = datetime.datetime.now().timetuple()
+    #only generate alarm during the day
+    if (t[3]>=7) and (t[3]<=19):
+        sendToPagerDuty("trigger","snmp/connect/{0}".format(hostname),"Unable to query SNMP on {0}".format(hostname),msg)
+
 def queryDevice(hostname,comm,ver):
     global deviceCount
 
     #Connect to device
     try:
-        device = M(host=hostname,community=comm,version=ver,timeout=30,retries=1)
+        device = M(host=hostname,community=comm,version=ver,timeout=SNMP_TIMEOUT,retries=SNMP_RETRIES)
         desc = device.sysDescr
         msg = 'Successfully connected to {0}.'.format(hostname)
         sendToPagerDuty("resolve","snmp/connect/{0}".format(hostname),"SNMP agent is responding on {0}".format(hostname),msg)
     except Exception as inst:
-        msg = 'Exception occurred while connecting to {0}. Exception = "{1}"'.format(hostname,inst)
-        logging.warning('{0}\tERROR\t{1}'.format(hostname,inst))
-        t = datetime.datetime.now().timetuple()
-        #only generate alarm during the day
-        if (t[3]>=7) and (t[3]<=19):
-            incident = sendToPagerDuty("trigger","snmp/connect/{0}".format(hostname),"Unable to query SNMP on {0}".format(hostname),msg)
+        connectFailed(hostname,inst)
         return
 
     deviceCount += 1 
@@ -444,14 +468,19 @@ def main():
         deviceFile = open(docroot+'device_list','r')
         comm = "public"
         ver = 2
-        for line in deviceFile:
-            if line[0:1] != "#":
-                deviceCount += 1
-                start = time.time()
-                hostname = line[:-1]
+        hostnames = [line[:-1] for line in deviceFile if line[0:1] != "#"]
+
+        #Probe every device at once. Devices that do not answer get their connect alarm here and are not queried.
+        unreachable = snmp_engine.probeDevices(hostnames,comm,ver,SNMP_TIMEOUT,SNMP_RETRIES)
+        for hostname in hostnames:
+            deviceCount += 1
+            start = time.time()
+            if hostname in unreachable:
+                connectFailed(hostname,unreachable[hostname])
+            else:
                 queryDevice(hostname,comm,ver)
-                end = time.time()
-                print '{0} - {1} - {2} sec. {3} total sec.'.format(deviceCount,hostname,(end-start),(end-script_start))
+            end = time.time()
+            print '{0} - {1} - {2} sec. {3} total sec.'.format(deviceCount,hostname,(end-start),(end-script_start))
     except Exception as inst:
         msg = 'Exception occurred in main function. Exception = "{0}"'.format(inst)
         logging.warning('MAIN\tERROR\t{0}'.format(msg))
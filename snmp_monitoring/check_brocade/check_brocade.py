@@ -8,6 +8,7 @@ import logging
 import subprocess
 import pygerduty
 import os
+import sys
 import datetime
 from collections import defaultdict
 
@@ -55,17 +56,27 @@ because that would be well over PD's API rate limit.
                         If it is a new issue, a new incident will be created. Else, it will be added to the existing incident.         
 """
 
+#Shared SNMP engine, alarm index and exclusion list, installed next to check_hp.py
+sys.path.append('/opt/spot/snmp_monitoring/')
+import snmp_engine
+from alarm_index import AlarmIndex
+from exclusion_file import ExclusionFile
+
 #SET LOGGING INFO
 if not os.path.exists('/var/log/snmp_monitoring/'):
     os.mkdir('/var/log/snmp_monitoring/')
 logging.basicConfig(filename='/var/log/snmp_monitoring/check_brocade.log',format='%(asctime)s: %(levelname)s: %(message)s',level=logging.DEBUG)
 docroot = "/opt/spot/snmp_monitoring/check_brocade/"
-open_alarms = []
+open_alarms = AlarmIndex()
+exclusions = ExclusionFile(docroot+'brocade_exclusions')
+
+#SNMP settings, used for both the probe and the device queries
+SNMP_TIMEOUT = 30
+SNMP_RETRIES = 3
 
 #COUNTERS
 totalStats = [0,0,0,0,0,0]
 deviceCount = 0
-open_alarms = []
 
 def sendToPagerDuty(type,key,desc,det):
     SPOT_API_TOKEN="<Your PagerDuty API>"
@@ -96,7 +107,7 @@ def getCurrentAlarms():
     SPOT_API_TOKEN="<Your PagerDuty API>"
     pager = pygerduty.PagerDuty(api_token=SPOT_API_TOKEN)
     for incident in pager.incidents.list(status="triggered,acknowledged"):
-        open_alarms.append(incident.incident_key)
+        open_alarms.add(incident.incident_key)
         logging.info('PAGER\tOPEN INCIDENTS\t{0}'.format(incident.incident_key))
 
 def checkForAlarm(key):
@@ -105,13 +116,7 @@ def checkForAlarm(key):
     return False
 
 def checkForExclusion(key):
-    result = False
-    with open(docroot+'brocade_exclusions','r') as f:
-        for line in f:
-            if line[:-1] == key:
-                result = True
-                return result
-    return result
+    return key in exclusions
 
 def touch(fname):
     if os.path.exists(fname):
@@ -194,22 +199,26 @@ def querySwSensors(device,host):
 
     return total,ok,failed
 
+# Logs a failed connection and sends the snmp/connect alarm (only during the day)
+def connectFailed(hostname,inst):
+    msg = 'Exception occurred while connecting to {0}. Exception = "{1}"'.format(hostname,inst)
+    logging.warning('{0}\tERROR\t{1}'.format(hostname,inst))
+    t = datetime.datetime.now().timetuple()
+    #only generate alarm during the day
+    if (t[3]>=7) and (t[3]<=19):
+        sendToPagerDuty("trigger","snmp/connect/{0}".format(hostname),"Unable to query SNMP on {0}".format(hostname),msg)
+
 def queryDevice(hostname,comm,ver):
     global deviceCount
 
     #Connect to device
     try:
-        device = M(host=hostname,community=comm,version=ver,timeout=30,retries=3)
+        device = M(host=hostname,community=comm,version=ver,timeout=SNMP_TIMEOUT,retries=SNMP_RETRIES)
         desc = device.sysDescr
         msg = 'Successfully connected to {0}.'.format(hostname)
         sendToPagerDuty("resolve","snmp/connect/{0}".format(hostname),"SNMP agent is responding on {0}".format(hostname),msg)
     except Exception as inst:
-        msg = 'Exception occurred while connecting to {0}. Exception = "{1}"'.format(hostname,inst)
-        logging.warning('{0}\tERROR\t{1}'.format(hostname,inst))
-        t = datetime.datetime.now().timetuple()
-        #only generate alarm during the day
-        if (t[3]>=7) and (t[3]<=19):
-            incident = sendToPagerDuty("trigger","snmp/connect/{0}".format(hostname),"Unable to query SNMP on {0}".format(hostname),msg)
+        connectFailed(hostname,inst)
         return
 
     deviceCount += 1 
@@ -265,14 +274,19 @@ def main():
         deviceFile = open(docroot+'brocade_devices','r')
         comm = "public"
         ver = 2
-        for line in deviceFile:
-            if line[0:1] != "#":
-                deviceCount += 1
-                start = time.time()
-                hostname = line[:-1]
+        hostnames = [line[:-1] for line in deviceFile if line[0:1] != "#"]
+
+        #Probe every device at once. Devices that do not answer get their connect alarm here and are not queried.
+        unreachable = snmp_engine.probeDevices(hostnames,comm,ver,SNMP_TIMEOUT,SNMP_RETRIES)
+        for hostname in hostnames:
+            deviceCount += 1
+            start = time.time()
+            if hostname in unreachable:
+                connectFailed(hostname,unreachable[hostname])
+            else:
                 queryDevice(hostname,comm,ver)
-                end = time.time()
-                print '{0} - {1} - {2} sec. {3} total sec.'.format(deviceCount,hostname,(end-start),(end-script_start))
+            end = time.time()
+            print '{0} - {1} - {2} sec. {3} total sec.'.format(deviceCount,hostname,(end-start),(end-script_start))
     except Exception as inst:
         msg = 'Exception occurred in main function. Exception = "{0}"'.format(inst)
         logging.warning('MAIN\tERROR\t{0}'.format(msg))
@@ -8,16 +8,66 @@ import logging
 import subprocess
 import pygerduty
 import os
+import sys
 import datetime
+import json
+import threading
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+
+#Shared SNMP engine, alarm index and journal and exclusion list, installed next to check_hp.py
+sys.path.append('/opt/spot/snmp_monitoring/')
+import snmp_engine
+from snmp_engine import walkRawTable,walkTableByIndex
+from alarm_index import AlarmIndex
+from alarm_journal import AlarmJournal
+from exclusion_file import ExclusionFile
 
 #SET LOGGING INFO
 if not os.path.exists('/var/log/snmp_monitoring/'):
     os.mkdir('/var/log/snmp_monitoring/')
 logging.basicConfig(filename='/var/log/snmp_monitoring/check_cisco_hw.log',format='%(asctime)s: %(levelname)s: %(message)s',level=logging.INFO)
+#OK detail messages are only built when they will be logged, or when there is an alarm they could resolve
+debug_enabled = logging.getLogger().isEnabledFor(logging.DEBUG)
 docroot = "/opt/spot/snmp_monitoring/check_cisco/"
-
-#COUNTERS
+previous_alarms = AlarmIndex()
+alarm_journal = AlarmJournal(docroot+'cisco_snmp_alarms')
+exclusions = ExclusionFile(docroot+'cisco_snmp_exclusions')
+
+#Platform of every device, from the last run: hostname -> {"type": ..., "objectid": ..., "uptime": ...}
+platforms = {}
+#MIBs each platform needs, in load order. SNMPv2-MIB is always loaded; the rest are loaded for the platforms detected in a run.
+platform_mibs = {
+    "IOS": ["CISCO-SMI.my","CISCO-TC.my","CISCO-ENVMON-MIB.my"],
+    "NXOS": ["CISCO-SMI.my","CISCO-TC.my","ENTITY-MIB.my","CISCO-ENTITY-FRU-CONTROL-MIB.mib","CISCO-ENTITY-SENSOR-MIB.mib"],
+    "ASA": ["CISCO-SMI.my","CISCO-TC.my","CISCO-FIREWALL-MIB.my"],
+    # We are using a modified version of the Tempus MIB
+    # because the original has syntax errors and cannot be loaded by snimpy
+    "PTP": ["TEMPUSLXUNISON-MIB-SPOT.txt"],
+}
+mibs_loaded = set()
+#Platforms whose MIBs could not be loaded this run. Their devices are not queried.
+mibs_failed = set()
+SYS_DESCR = (1,3,6,1,2,1,1,1,0)
+SYS_OBJECT_ID = (1,3,6,1,2,1,1,2,0)
+SYS_UPTIME = (1,3,6,1,2,1,1,3,0)
+
+#ENTITY-MIB descriptions of every NX-OS device, from the last run: hostname -> {"changed": ..., "uptime": ..., "descr": {index: descr}}
+entities = {}
+ENT_LAST_CHANGE_TIME = (1,3,6,1,2,1,47,1,4,1,0)
+
+#SNMP settings, used for both the probe and the device queries
+SNMP_TIMEOUT = 15
+SNMP_RETRIES = 2
+
+#Devices of each platform queried at the same time. Old IOS supervisors and ASAs are slow to answer and easily
+#overloaded, NX-OS handles more. The platforms are detected before any device is queried; devices whose platform
+#could not be detected are counted as UNDEFINED.
+#Change with --workers and --platform-workers.
+platform_workers = {"IOS": 2, "NXOS": 8, "ASA": 2, "PTP": 2, "UNDEFINED": 4}
+platform_slots = {}
+
+#COUNTERS. Only updated from the main thread, as results come back from the workers.
 totalStatsIOS = [0,0,0,0,0,0,0,0,0]
 totalStatsNXOS = [0,0,0,0,0,0,0,0,0,0,0,0]
 totalStatsASA = [0,0,0,0,0,0]
@@ -31,11 +81,11 @@ def sendToPagerDuty(type,key,desc,det):
     #print 'Send to PD: {0}; {1}; {2}; {3}'.format(type,key,desc,det)
     SPOT_API_TOKEN="<Your PagerDuty API token>"
     SERVICE_API_TOKEN="<Your PagerDuty service API token>"
-    pager = pygerduty.PagerDuty(api_token=SPOT_API_TOKEN)
     if type == "trigger":
         if checkForExclusion(key) is False:
+            pager = pygerduty.PagerDuty(api_token=SPOT_API_TOKEN)
             incident = pager.trigger_incident(service_key=SERVICE_API_TOKEN, incident_key=key, description=desc, details=det)
-            writeToFile(key)
+            alarm_journal.record(key)
             logging.info('<Your PagerDuty domain>\tPAGER\tCreating Alarm: {0}'.format(key))
             return incident
         else:
@@ -44,37 +94,25 @@ def sendToPagerDuty(type,key,desc,det):
     elif type == "resolve":
         if checkForAlarm(key):
             logging.info('<Your PagerDuty domain>\tPAGER\tResolving Open Incident: {0}'.format(key))
+            pager = pygerduty.PagerDuty(api_token=SPOT_API_TOKEN)
             incident = pager.resolve_incident(service_key=SERVICE_API_TOKEN, incident_key=key, description=desc, details=det)
             return incident
 
-def writeToFile(key):
-    with open(docroot+'cisco_snmp_alarms_current','a') as f:
-        f.write('{0}\n'.format(key))
-
 def checkForAlarm(key):
-    result = False
-    with open(docroot+'cisco_snmp_alarms_previous','r') as f:
-        for line in f:
-            if line[:-1] == key:
-                result = True
-                return result
-    return result
+    return key in previous_alarms
+
+# True if the previous run left an alarm open for a device, so a resolve for one of its components might be sent
+def hostHasAlarms(host):
+    return previous_alarms.hostHasAlarms(host)
 
 def logPreviousAlarms():
-    logging.info('PREVIOUS ALARMS\tPrinting previous alarms from file')
-    with open(docroot+'cisco_snmp_alarms_previous','r') as f:
-        for line in f:
-            logging.info('PREVIOUS ALARMS\t{0}'.format(line))
+    logging.info('PREVIOUS ALARMS\tPrinting previous alarms')
+    for key in sorted(previous_alarms):
+        logging.info('PREVIOUS ALARMS\t{0}'.format(key))
     logging.info('PREVIOUS ALARMS\tOutput complete')
 
 def checkForExclusion(key):
-    result = False
-    with open(docroot+'cisco_snmp_exclusions','r') as f:
-        for line in f:
-            if line[:-1] == key:
-                result = True
-                return result
-    return result
+    return key in exclusions
 
 def touch(fname):
     if os.path.exists(fname):
@@ -97,17 +135,39 @@ def queryFans(device,host):
             incident = sendToPagerDuty("trigger","snmp/fan/{0}/{1}".format(host,index),"Fan issue detected on {0}".format(host),msg)
         else:
             ok+=1
-            msg = 'OK for Fan({0}): State = {1}; Description = {2}'.format(index,fanState,fanDescr)
-            logging.debug('{0}\tFAN\t{1}'.format(host,msg))
-            sendToPagerDuty("resolve","snmp/fan/{0}/{1}".format(host,index),"No fan issues detected",msg)
+            if debug_enabled or hostHasAlarms(host):
+                msg = 'OK for Fan({0}): State = {1}; Description = {2}'.format(index,fanState,fanDescr)
+                logging.debug('{0}\tFAN\t{1}'.format(host,msg))
+                sendToPagerDuty("resolve","snmp/fan/{0}/{1}".format(host,index),"No fan issues detected",msg)
     return total,ok,failed
 
+# Loads the entPhysicalDescr column of a device into the entity cache. entLastChangeTime and sysUpTime are fetched in a
+# single GET; if the inventory has not changed and the device has not rebooted since the last run, the saved
+# descriptions are used. Otherwise the column is walked again.
+def loadEntities(device,host):
+    changed, upTime = [int(value) for oid,value in device._session.get(ENT_LAST_CHANGE_TIME,SYS_UPTIME)]
+    cached = entities.get(host)
+    if cached is not None and cached["changed"] == changed and cached["uptime"] <= upTime:
+        cached["uptime"] = upTime
+        return
+    columns,rows = walkRawTable(device,["entPhysicalDescr"])
+    descr = dict([(int(index),str(values[0])) for index,values in rows if values[0] is not None])
+    entities[host] = {"changed": changed, "uptime": upTime, "descr": descr}
+    logging.info('{0}\tENTITY\tLoaded {1} entity descriptions'.format(host,len(descr)))
+
+# Returns the entPhysicalDescr of an entity, from the entity cache if it is there
+def getEntityDescr(device,host,index):
+    cached = entities.get(host)
+    if cached is not None and int(index) in cached["descr"]:
+        return cached["descr"][int(index)]
+    return str(device.entPhysicalDescr[index])
+
 def queryFansNXOS(device,host):
     total,ok,failed = 0,0,0
     for index in device.cefcFanTrayOperStatus:
         total += 1
         allowed_status = 'up(2)'
-        fanDescr = device.entPhysicalDescr[index]
+        fanDescr = getEntityDescr(device,host,index)
         fanStatus = device.cefcFanTrayOperStatus[index]
 
         if str(fanStatus) not in allowed_status:
@@ -117,9 +177,10 @@ def queryFansNXOS(device,host):
             incident = sendToPagerDuty("trigger","snmp/fan/{0}/{1}".format(host,index),"Fan issue detected on {0}".format(host),msg)
         else:
             ok+=1
-            msg = 'OK for Fan({0}): Status = {1}; Description = {2}'.format(index,fanStatus,fanDescr)
-            logging.debug('{0}\tFAN\t{1}'.format(host,msg))
-            sendToPagerDuty("resolve","snmp/fan/{0}/{1}".format(host,index),"No fan issues detected",msg)
+            if debug_enabled or hostHasAlarms(host):
+                msg = 'OK for Fan({0}): Status = {1}; Description = {2}'.format(index,fanStatus,fanDescr)
+                logging.debug('{0}\tFAN\t{1}'.format(host,msg))
+                sendToPagerDuty("resolve","snmp/fan/{0}/{1}".format(host,index),"No fan issues detected",msg)
     return total,ok,failed
 
 def queryPowerNXOS(device,host):
@@ -129,7 +190,7 @@ def queryPowerNXOS(device,host):
         allowed_oper_status = ['on(2)']
         powerOperStatus = str(device.cefcFRUPowerOperStatus[index])
         powerAdminStatus = str(device.cefcFRUPowerAdminStatus[index])
-        powerDescr = str(device.entPhysicalDescr[index])
+        powerDescr = getEntityDescr(device,host,index)
 
         if powerOperStatus not in allowed_oper_status:
             failed+=1
@@ -138,9 +199,10 @@ def queryPowerNXOS(device,host):
             incident = sendToPagerDuty("trigger","snmp/power/{0}/{1}".format(host,index),"Power supply issue detected on {0}".format(host),msg)
         else:
             ok+=1
-            msg = 'OK for PSU({0}): OperStatus = {1}; AdminStatus = {2}; Description = {3}'.format(index,powerOperStatus,powerAdminStatus,powerDescr)
-            logging.debug('{0}\tPSU\t{1}'.format(host,msg))
-            sendToPagerDuty("resolve","snmp/power/{0}/{1}".format(host,index),"No power supply issues detected",msg)
+            if debug_enabled or hostHasAlarms(host):
+                msg = 'OK for PSU({0}): OperStatus = {1}; AdminStatus = {2}; Description = {3}'.format(index,powerOperStatus,powerAdminStatus,powerDescr)
+                logging.debug('{0}\tPSU\t{1}'.format(host,msg))
+                sendToPagerDuty("resolve","snmp/power/{0}/{1}".format(host,index),"No power supply issues detected",msg)
     return total,ok,failed
 
 def queryModuleNXOS(device,host):
@@ -150,7 +212,7 @@ def queryModuleNXOS(device,host):
         allowed_oper_status = ['ok(2)']
         operStatus = str(device.cefcModuleOperStatus[index])
         adminStatus = str(device.cefcModuleAdminStatus[index])
-        descr = str(device.entPhysicalDescr[index])
+        descr = getEntityDescr(device,host,index)
 
         if operStatus not in allowed_oper_status:
             failed+=1
@@ -159,32 +221,38 @@ def queryModuleNXOS(device,host):
             incident = sendToPagerDuty("trigger","snmp/module/{0}/{1}".format(host,index),"Module issue detected on {0}".format(host),msg)
         else:
             ok+=1
-            msg = 'OK for Module({0}): OperStatus = {1}; AdminStatus = {2}; Description = {3}'.format(index,operStatus,adminStatus,descr)
-            logging.debug('{0}\tMODULE\t{1}'.format(host,msg))
-            sendToPagerDuty("resolve","snmp/module/{0}/{1}".format(host,index),"No fan issues detected",msg)
+            if debug_enabled or hostHasAlarms(host):
+                msg = 'OK for Module({0}): OperStatus = {1}; AdminStatus = {2}; Description = {3}'.format(index,operStatus,adminStatus,descr)
+                logging.debug('{0}\tMODULE\t{1}'.format(host,msg))
+                sendToPagerDuty("resolve","snmp/module/{0}/{1}".format(host,index),"No fan issues detected",msg)
     return total,ok,failed
 
 def querySensorNXOS(device,host):
     total,ok,failed = 0,0,0
+    #Thresholds and sensor values are each fetched in a GETBULK walk and joined here, descriptions come from the entity cache
+    thresholds = walkTableByIndex(device,["entSensorThresholdSeverity","entSensorThresholdValue","entSensorThresholdEvaluation"])
+    sensors = walkTableByIndex(device,["entSensorValue","entSensorStatus","entSensorType"])
     ids = defaultdict(list)
-    for index in device.entSensorThresholdSeverity:
+    for index in thresholds:
         id = index[0]
         instance = index[1]
         ids[id].append(instance)
 
-    for x in ids.items():
-        sensor = x[0]
-        thresholds = x[1]
-        descr = str(device.entPhysicalDescr[sensor]).replace('\n',' ')
-        value = str(device.entSensorValue[sensor])
-        status = str(device.entSensorStatus[sensor])
-        unit = str(device.entSensorType[sensor])
-        for t in thresholds:
+    for sensor in sorted(ids):
+        thresholds_of_sensor = ids[sensor]
+        descr = getEntityDescr(device,host,sensor).replace('\n',' ')
+        row = sensors.get(sensor)
+        if row is None:
+            row = {"entSensorValue": device.entSensorValue[sensor], "entSensorStatus": device.entSensorStatus[sensor], "entSensorType": device.entSensorType[sensor]}
+        value = str(row["entSensorValue"])
+        status = str(row["entSensorStatus"])
+        unit = str(row["entSensorType"])
+        for t in thresholds_of_sensor:
             total+=1
-            z = (int(sensor),int(t))
-            severity = str(device.entSensorThresholdSeverity[z])
-            threshold = str(device.entSensorThresholdValue[z])
-            breached = str(device.entSensorThresholdEvaluation[z])
+            z = (sensor,t)
+            severity = str(thresholds[z]["entSensorThresholdSeverity"])
+            threshold = str(thresholds[z]["entSensorThresholdValue"])
+            breached = str(thresholds[z]["entSensorThresholdEvaluation"])
             if breached == 'true(1)':
                 failed+=1
                 msg = 'Error for Sensor({0}): Desc = {1}; Value = {2} {3}; Threshold = {4}; Breached = {5}; Severity = {6}; Status = {7}'.format(sensor,descr,value,unit,threshold,breached,severity,status)
@@ -192,9 +260,10 @@ def querySensorNXOS(device,host):
                 incident = sendToPagerDuty("trigger","snmp/sensor/{0}/{1}".format(host,sensor),"Sensor issue detected on {0}".format(host),msg)
             else:
                 ok+=1
-                msg = 'OK for Sensor({0}): Desc = {1}; Value = {2} {3}; Threshold = {4}; Breached = {5}; Severity = {6}; Status = {7}'.format(sensor,descr,value,unit,threshold,breached,severity,status)
-                logging.debug('{0}\tSENSOR\t{1}'.format(host,msg))
-                sendToPagerDuty("resolve","snmp/sensor/{0}/{1}".format(host,sensor),"No sensor issues detected",msg)
+                if debug_enabled or hostHasAlarms(host):
+                    msg = 'OK for Sensor({0}): Desc = {1}; Value = {2} {3}; Threshold = {4}; Breached = {5}; Severity = {6}; Status = {7}'.format(sensor,descr,value,unit,threshold,breached,severity,status)
+                    logging.debug('{0}\tSENSOR\t{1}'.format(host,msg))
+                    sendToPagerDuty("resolve","snmp/sensor/{0}/{1}".format(host,sensor),"No sensor issues detected",msg)
     return total,ok,failed
 
 def queryTemp(device,host):
@@ -214,9 +283,10 @@ def queryTemp(device,host):
             incident = sendToPagerDuty("trigger","snmp/temperature/{0}/{1}".format(host,index),"Temperature issue detected on {0}".format(host),msg)
         else:
             ok+=1
-            msg = 'OK for Temperature Sensor({0}): State = {1}; Current = {2}; Threshold = {3}; Description = {4}'.format(index,tempState,tempStatus,tempThreshold,tempDescr)
-            logging.debug('{0}\tTEMP\t{1}'.format(host,msg))
-            sendToPagerDuty("resolve","snmp/temperature/{0}/{1}".format(host,index),"No temperature issues detected",msg)
+            if debug_enabled or hostHasAlarms(host):
+                msg = 'OK for Temperature Sensor({0}): State = {1}; Current = {2}; Threshold = {3}; Description = {4}'.format(index,tempState,tempStatus,tempThreshold,tempDescr)
+                logging.debug('{0}\tTEMP\t{1}'.format(host,msg))
+                sendToPagerDuty("resolve","snmp/temperature/{0}/{1}".format(host,index),"No temperature issues detected",msg)
     return total,ok,failed
 
 def queryPower(device,host):
@@ -234,9 +304,10 @@ def queryPower(device,host):
             incident = sendToPagerDuty("trigger","snmp/power/{0}/{1}".format(host,index),"Power Supply issue detected on {0}".format(host),msg)
         else:
             ok+=1
-            msg = 'OK for Power Supply({0}): State = {1}; Description = {2}'.format(index,psuState,psuDescr)
-            logging.debug('{0}\tPSU\t{1}'.format(host,msg))
-            sendToPagerDuty("resolve","snmp/power/{0}/{1}".format(host,index),"No power issues detected",msg)
+            if debug_enabled or hostHasAlarms(host):
+                msg = 'OK for Power Supply({0}): State = {1}; Description = {2}'.format(index,psuState,psuDescr)
+                logging.debug('{0}\tPSU\t{1}'.format(host,msg))
+                sendToPagerDuty("resolve","snmp/power/{0}/{1}".format(host,index),"No power issues detected",msg)
 
     return total,ok,failed
 
@@ -261,9 +332,10 @@ def queryASA(device,host):
             logging.warning('{0}\t{2}\t{1}'.format(host,msg,current_check.upper()))
         else:
             h_ok += 1
-            msg = 'OK: {0} Check: {1}'.format(current_check, details)
-            logging.debug('{0}\t{2}\t{1}'.format(host,msg,current_check.upper()))
-            sendToPagerDuty("resolve","snmp/{2}/{0}/{1}".format(host,index,current_check.lower()),"No {0} issues detected".format(current_check),msg)
+            if debug_enabled or hostHasAlarms(host):
+                msg = 'OK: {0} Check: {1}'.format(current_check, details)
+                logging.debug('{0}\t{2}\t{1}'.format(host,msg,current_check.upper()))
+                sendToPagerDuty("resolve","snmp/{2}/{0}/{1}".format(host,index,current_check.lower()),"No {0} issues detected".format(current_check),msg)
 
     for index in device.cfwConnectionStatDescription:
         connDesc = device.cfwConnectionStatDescription[index]
@@ -282,9 +354,10 @@ def queryASA(device,host):
                 logging.warning('{0}\t{2}\t{1}'.format(host,msg,current_check.upper()))
             else:
                 c_ok += 1
-                msg = 'OK: {0} Check: {1}'.format(current_check, details)
-                logging.debug('{0}\t{2}\t{1}'.format(host,msg,current_check.upper()))
-                sendToPagerDuty("resolve","snmp/{2}/{0}/{1}".format(host,index,current_check.lower()),"No {0} issues detected".format(current_check),msg)
+                if debug_enabled or hostHasAlarms(host):
+                    msg = 'OK: {0} Check: {1}'.format(current_check, details)
+                    logging.debug('{0}\t{2}\t{1}'.format(host,msg,current_check.upper()))
+                    sendToPagerDuty("resolve","snmp/{2}/{0}/{1}".format(host,index,current_check.lower()),"No {0} issues detected".format(current_check),msg)
     return h_total, h_ok, h_failed, c_total, c_ok, c_failed
 
 # The Time Figure of Merit (TFOM) value ranges from 6 to 9 and indicates the current estimate of the worst case time error. 
@@ -350,49 +423,162 @@ def queryTimeServer(device,host):
             logging.warning('{0}\t{1}\t{2}'.format(host,'PTP',msg))
         else:
             ok += 1
-            msg = 'OK: PTP clock accuracy is OK. Current {0} = {1} on {2}'.format(index["current_check"], index["current_value"], host)
-            logging.debug('{0}\t{1}\t{2}'.format(host,'PTP',msg))
-            sendToPagerDuty("resolve","snmp/{0}/{1}".format(index["current_check"],host),msg,msg) 
+            if debug_enabled or hostHasAlarms(host):
+                msg = 'OK: PTP clock accuracy is OK. Current {0} = {1} on {2}'.format(index["current_check"], index["current_value"], host)
+                logging.debug('{0}\t{1}\t{2}'.format(host,'PTP',msg))
+                sendToPagerDuty("resolve","snmp/{0}/{1}".format(index["current_check"],host),msg,msg) 
 
     return total, ok, failed
 
-def queryDevice(hostname,comm,ver):
-    global nxosCount, iosCount, asaCount, ptpCount
-    #adjust creds as needed
+#adjust creds as needed
+def getCommunity(hostname,comm):
     if hostname in ['<Your hostname>']: comm = "<Your comment>"
     if hostname in ['<Your hostname>','<Your hostname>','<Your hostname>','<Your hostname>']: comm = "<Your comment>"
     if hostname in ['<Your hostname>','<Your hostname>']: comm = "<Your comment>"
-
-    #Connect to device
+    return comm
+
+# Loads the MIBs of a platform. libsmi is not thread safe, and snimpy goes through it for every lookup, so this is only
+# called from the main thread, once the platforms are detected and before any device is queried.
+def loadPlatformMibs(devType):
+    for name in platform_mibs.get(devType,[]):
+        if name not in mibs_loaded:
+            load(docroot + "mibs/" + name)
+            mibs_loaded.add(name)
+
+# Reads one of the caches kept between runs. A missing or unreadable file is an empty cache.
+def loadCache(name):
     try:
-        device = M(host=hostname,community=comm,version=ver,timeout=15,retries=2)
-        desc = device.sysDescr
-        msg = 'Successfully connected to {0}.'.format(hostname)
-        sendToPagerDuty("resolve","snmp/connect/{0}".format(hostname),"SNMP agent is responding on {0}".format(hostname),msg)
+        with open(docroot+name,'r') as f:
+            return json.load(f)
     except Exception as inst:
-        msg = 'Exception occurred while connecting to {0}. Exception = "{1}"'.format(hostname,inst)
-        logging.warning('{0}\tERROR\t{1}'.format(hostname,inst))
-        t = datetime.datetime.now().timetuple()
-        #only generate alarm during the day
-        if (t[3]>=7) and (t[3]<=19):
-            incident = sendToPagerDuty("trigger","snmp/connect/{0}".format(hostname),"Unable to query SNMP on {0}".format(hostname),msg)
-        return
+        logging.info('CACHE\tStarting with an empty {0}. Exception = "{1}"'.format(name,inst))
+        return {}
 
+def saveCache(name,data):
+    try:
+        with open(docroot+name+'.tmp','w') as f:
+            json.dump(data,f)
+        os.rename(docroot+name+'.tmp',docroot+name)
+    except Exception as inst:
+        logging.warning('CACHE\tERROR\tException occurred while saving {0}. Exception = "{1}"'.format(name,inst))
+
+def loadPlatforms():
+    global platforms
+    platforms = loadCache('cisco_platforms')
+
+def savePlatforms():
+    saveCache('cisco_platforms',platforms)
+
+# entPhysicalDescr is an octet string and is not always valid UTF-8, which json cannot save. The descriptions are saved
+# as latin-1, which maps every byte to one character, so they are read back exactly as the device sent them.
+def loadEntityCache():
+    global entities
+    entities = {}
+    for host,cached in loadCache('cisco_entities').items():
+        if cached.get("encoding") != "latin-1":
+            #Saved before the descriptions were encoded; walked again on the next query
+            continue
+        #JSON keys are always strings
+        cached["descr"] = dict([(int(index),descr.encode("latin-1")) for index,descr in cached["descr"].items()])
+        entities[host] = cached
+
+def saveEntityCache():
+    data = {}
+    for host,cached in entities.items():
+        descr = dict([(index,descr.decode("latin-1")) for index,descr in cached["descr"].items()])
+        data[host] = {"changed": cached["changed"], "uptime": cached["uptime"], "encoding": "latin-1", "descr": descr}
+    saveCache('cisco_entities',data)
+
+def detectPlatform(desc):
     if 'Cisco IOS Software' in desc:
-        devType = 'IOS'
+        return 'IOS'
     elif 'Cisco Internetwork Operating System Software' in desc:
-        devType = 'IOS'
+        return 'IOS'
     elif 'Cisco NX-OS' in desc:
-        devType = 'NXOS'
+        return 'NXOS'
     elif 'Cisco Adaptive Security Appliance' in desc:
-        devType = 'ASA'
+        return 'ASA'
     elif 'Linux' in desc:
-        devType = 'PTP'
-    else:
-        devType = 'UNDEFINED'
+        return 'PTP'
+    return 'UNDEFINED'
+
+# Works out the platform of every device that answered the probe, before any device is queried, so each device is
+# queried under its own platform's limit. The probe fetched sysObjectID and sysUpTime; if a device is the same model and
+# has not rebooted (so it cannot have been upgraded) since the last run, the saved platform is used. sysDescr is fetched
+# from all the others in a single round and matched again. Devices that stop answering are added to unreachable.
+# Returns a dictionary of hostname -> platform.
+def detectPlatforms(hostnames,comm,ver,answers,unreachable):
+    devTypes = {}
+    unknown = []
+    for hostname in hostnames:
+        values = answers.get(hostname,{})
+        try:
+            objectId = '.'.join([str(x) for x in values[SYS_OBJECT_ID]])
+            upTime = int(values[SYS_UPTIME])
+        except Exception:
+            #Not in the probe answer, so the saved platform cannot be checked
+            objectId,upTime = None,0
+        cached = platforms.get(hostname)
+        if objectId is not None and cached is not None and cached["objectid"] == objectId and cached["uptime"] <= upTime:
+            devTypes[hostname] = cached["type"]
+            cached["uptime"] = upTime
+        else:
+            unknown.append((hostname,objectId,upTime))
+    if not unknown:
+        return devTypes
+
+    try:
+        results = snmp_engine.getHosts([(hostname,getCommunity(hostname,comm),ver,SNMP_TIMEOUT,SNMP_RETRIES) for hostname in [x[0] for x in unknown]],[SYS_DESCR])
+    except Exception as inst:
+        msg = 'Exception occurred while fetching sysDescr, the saved platforms will be used; Exception = "{0}"'.format(inst)
+        logging.warning('PLATFORM\tERROR\t{0}'.format(msg))
+        for hostname,objectId,upTime in unknown:
+            devTypes[hostname] = platforms[hostname]["type"] if hostname in platforms else 'UNDEFINED'
+        return devTypes
+
+    for hostname,objectId,upTime in unknown:
+        error,values = results[hostname]
+        if error is not None:
+            unreachable[hostname] = error
+            continue
+        devType = detectPlatform(str(values.get(SYS_DESCR,'')))
+        logging.info('{0}\tPLATFORM\tDetected {1}; sysObjectID = {2}'.format(hostname,devType,objectId))
+        devTypes[hostname] = devType
+        if devType == 'UNDEFINED' or objectId is None:
+            platforms.pop(hostname,None)
+        else:
+            platforms[hostname] = {"type": devType, "objectid": objectId, "uptime": upTime}
+    return devTypes
+
+# Logs a failed connection and sends the snmp/connect alarm (only during the day)
+def connectFailed(hostname,inst):
+    msg = 'Exception occurred while connecting to {0}. Exception = "{1}"'.format(hostname,inst)
+    logging.warning('{0}\tERROR\t{1}'.format(hostname,inst))
+    t = datetime.datetime.now().timetuple()
+    #only generate alarm during the day
+    if (t[3]>=7) and (t[3]<=19):
+        sendToPagerDuty("trigger","snmp/connect/{0}".format(hostname),"Unable to query SNMP on {0}".format(hostname),msg)
+
+# Queries a single device of a detected platform. Returns the platform and the device's results, or None,None if the
+# device could not be checked. The totals are not touched here, since devices are queried from several threads.
+def queryDevice(hostname,comm,ver,devType):
+    comm = getCommunity(hostname,comm)
+
+    #Connect to device. It has already answered the probe.
+    try:
+        device = M(host=hostname,community=comm,version=ver,timeout=SNMP_TIMEOUT,retries=SNMP_RETRIES)
+        msg = 'Successfully connected to {0}.'.format(hostname)
+        sendToPagerDuty("resolve","snmp/connect/{0}".format(hostname),"SNMP agent is responding on {0}".format(hostname),msg)
+    except Exception as inst:
+        connectFailed(hostname,inst)
+        return None,None
+
+    if devType in mibs_failed:
+        msg = 'The {0} MIBs could not be loaded, device not checked'.format(devType)
+        logging.warning('{0}\tERROR\t{1}'.format(hostname,msg))
+        return None,None
 
     if devType == 'IOS':
-        iosCount += 1
         deviceResults = [0,0,0,0,0,0,0,0,0]
         #Perform checks, load results into list
         next_check = "queryFans"
@@ -416,12 +602,15 @@ def queryDevice(hostname,comm,ver):
             msg = 'Exception occurred while running "{0}"; Exception = "{1}"'.format(next_check,inst)
             logging.warning('{0}\tERROR\t{1}'.format(hostname,msg))
 
-        for i in range(len(totalStatsIOS)):
-            totalStatsIOS[i]+=deviceResults[i]
         logging.info('{0}\tSTATS\tIOS\t(Checked,OK,Error) || Fan({1},{2},{3}) || Temp({4},{5},{6}) || PSU({7},{8},{9}))'.format(hostname,*deviceResults))
     elif devType == 'NXOS':
-        nxosCount += 1
         deviceResults = [0,0,0,0,0,0,0,0,0,0,0,0]
+        try:
+            loadEntities(device,hostname)
+        except Exception as inst:
+            entities.pop(hostname,None)
+            msg = 'Exception occurred while loading the entity table, descriptions will be queried one at a time; Exception = "{0}"'.format(inst)
+            logging.warning('{0}\tERROR\t{1}'.format(hostname,msg))
         next_check = "queryFansNXOS"
         try:
             deviceResults[0:3] = queryFansNXOS(device,hostname)
@@ -450,11 +639,8 @@ def queryDevice(hostname,comm,ver):
             msg = 'Exception occurred while running "{0}"; Exception = "{1}"'.format(next_check,inst)
             logging.warning('{0}\tERROR\t{1}'.format(hostname,msg))
 
-        for i in range(len(totalStatsNXOS)):
-            totalStatsNXOS[i]+=deviceResults[i]
         logging.info('{0}\tSTATS\tNXOS\t(Checked,OK,Error) || Fan({1},{2},{3}) || PSU({4},{5},{6}) || Module({7},{8},{9}) || Sensor({10},{11},{12})'.format(hostname,*deviceResults))
     elif devType == 'ASA':
-        asaCount += 1
         deviceResults = [0,0,0,0,0,0]
         next_check = "queryASA"
         try:
@@ -463,11 +649,8 @@ def queryDevice(hostname,comm,ver):
             msg = 'Exception occurred while running "{0}"; Exception = "{1}"'.format(next_check,inst)
             logging.warning('{0}\tERROR\t{1}'.format(hostname,msg))
         
-        for i in range(len(totalStatsASA)):
-            totalStatsASA[i]+=deviceResults[i]
         logging.info('{0}\tSTATS\tASA\t(Checked,OK,Error) || HW({1},{2},{3}) || Conn({4},{5},{6})'.format(hostname,*deviceResults))
     elif devType == 'PTP':
-        ptpCount += 1
         deviceResults = [0,0,0]
         next_check = "queryTimeServer"
         try:
@@ -476,62 +659,142 @@ def queryDevice(hostname,comm,ver):
             msg = 'Exception occurred while running "{0}"; Exception = "{1}"'.format(next_check,inst)
             logging.warning('{0}\tERROR\t{1}'.format(hostname,msg))
 
-        for i in range(len(totalStatsPTP)):
-            totalStatsPTP[i]+=deviceResults[i]
         logging.info('{0}\tSTATS\tPTP\t(Checked,OK,Error) || PTP({1},{2},{3})'.format(hostname,*deviceResults))
+    else:
+        return None,None
+    return devType,deviceResults
+
+# Queries a device from the device list, once one of its platform's slots is free. Used by the worker pool.
+# Returns the hostname, platform, results and number of seconds it took.
+def pollDevice(task):
+    hostname,comm,ver,devType,error = task
+    start = time.time()
+    deviceResults = None
+    with platform_slots.get(devType,platform_slots["UNDEFINED"]):
+        if error is not None:
+            #Did not answer the probe
+            connectFailed(hostname,error)
+        else:
+            try:
+                devType,deviceResults = queryDevice(hostname,comm,ver,devType)
+            except Exception as inst:
+                msg = 'Exception occurred while querying device. Exception = "{0}"'.format(inst)
+                logging.warning('{0}\tERROR\t{1}'.format(hostname,msg))
+    return hostname,devType,deviceResults,(time.time()-start)
+
+# Orders the devices so that each platform's devices are spread through the list. Workers then do not all end up
+# waiting for the same platform's slots while other platforms have free ones.
+def interleaveDevices(hostnames,devTypes):
+    groups = {}
+    for hostname in hostnames:
+        groups.setdefault(devTypes.get(hostname,"UNDEFINED"),[]).append(hostname)
+    ordered = []
+    queues = [list(group) for name,group in sorted(groups.items())]
+    while queues:
+        for queue in queues:
+            ordered.append(queue.pop(0))
+        queues = [queue for queue in queues if queue]
+    return ordered
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description='Monitor Cisco hardware via SNMP.')
+    parser.add_argument('--workers', type=int, default=8, help='Number of devices to query in parallel (default: 8, 1 queries one device at a time)')
+    parser.add_argument('--platform-workers', default='', help='Limit the devices of a platform queried in parallel, e.g. IOS=1,NXOS=12 (defaults: {0})'.format(
+        ','.join(['{0}={1}'.format(name,count) for name,count in sorted(platform_workers.items())])))
+    return parser.parse_args()
 
 def main():
+    global iosCount, nxosCount, asaCount, ptpCount, previous_alarms
+    args = parseArgs()
+    for item in [x for x in args.platform_workers.split(',') if x]:
+        name,count = item.split('=')
+        platform_workers[name.upper()] = int(count)
+    for name,count in platform_workers.items():
+        platform_slots[name] = threading.BoundedSemaphore(max(min(count,args.workers),1))
+
     logging.info('***************************************************************************')
     logging.info('Starting Script')
     deviceCount = 0
 
     #Prepare stats file
-    touch(docroot + 'cisco_snmp_alarms_current')
     touch(docroot + 'cisco_snmp_exclusions')
-    os.rename(docroot+'cisco_snmp_alarms_current',docroot+'cisco_snmp_alarms_previous')
-    touch(docroot + 'cisco_snmp_alarms_current')
+    previous_alarms = AlarmIndex(alarm_journal.open())
 
-    #Parse previous alarms file and output to log file for debugging
-    try:
-        logPreviousAlarms()
-    except Exception as inst:
-        msg = 'Exception occurred while parsing previous alarms file. Exception: {0}'.format(inst)
-        logging.warning(msg)
+    #Output previous alarms to log file for debugging
+    logPreviousAlarms()
 
-    #Load required MIBs
-    load(docroot + "mibs/CISCO-SMI.my")
-    load(docroot + "mibs/CISCO-TC.my")
-    load(docroot + "mibs/ENTITY-MIB.my")
+    #Load required MIBs. Platform MIBs are loaded once the platforms of the devices have been detected.
     load(docroot + "mibs/SNMPv2-MIB")
-    load(docroot + "mibs/CISCO-ENVMON-MIB.my")
-    load(docroot + "mibs/CISCO-ENTITY-FRU-CONTROL-MIB.mib")
-    load(docroot + "mibs/CISCO-ENTITY-SENSOR-MIB.mib")
-    load(docroot + "mibs/CISCO-FIREWALL-MIB.my")
-    # We are using a modified version of the Tempus MIB
-    # because the original has syntax errors and cannot be loaded by snimpy
-    load(docroot + "mibs/TEMPUSLXUNISON-MIB-SPOT.txt")
+    loadPlatforms()
+    loadEntityCache()
+
+    pool = None
+    if args.workers > 1:
+        pool = ThreadPool(args.workers)
 
     script_start = time.time()
     try:
         deviceFile = open(docroot+'cisco_devices','r')
         comm = "public"
         ver = 2
-        for line in deviceFile:
-            if line[0:1] != "#":
-                deviceCount += 1
-                start = time.time()
-                hostname = line[:-1]              
-                queryDevice(hostname,comm,ver)
-                end = time.time()
-                print '{0} - {1} - {2} sec. {3} total sec.'.format(deviceCount,hostname,(end-start),(end-script_start))
+        hostnames = [line[:-1] for line in deviceFile if line[0:1] != "#"]
+
+        #Probe every device at once and detect the platforms of the ones that answer. Devices that do not answer get
+        #their connect alarm from the workers and are not queried.
+        answers = {}
+        unreachable = snmp_engine.probeDevices(hostnames,lambda hostname: getCommunity(hostname,comm),ver,SNMP_TIMEOUT,SNMP_RETRIES,[SYS_OBJECT_ID,SYS_UPTIME],answers)
+        devTypes = detectPlatforms([hostname for hostname in hostnames if hostname not in unreachable],comm,ver,answers,unreachable)
+
+        #Load the MIBs of every detected platform here, before the workers start. The workers never load a MIB.
+        for devType in set(devTypes.values()):
+            try:
+                loadPlatformMibs(devType)
+            except Exception as inst:
+                mibs_failed.add(devType)
+                msg = 'Exception occurred while loading the {0} MIBs; Exception = "{1}"'.format(devType,inst)
+                logging.warning('MAIN\tERROR\t{0}'.format(msg))
+
+        tasks = [(hostname,comm,ver,devTypes.get(hostname,"UNDEFINED"),unreachable.get(hostname)) for hostname in interleaveDevices(hostnames,devTypes)]
+        if pool is not None:
+            logging.info('POLLER\tQuerying {0} devices with {1} workers. Per platform: {2}'.format(len(tasks),args.workers,platform_workers))
+            results = pool.imap_unordered(pollDevice,tasks)
+        else:
+            results = (pollDevice(task) for task in tasks)
+
+        #Results are added up here in the main thread, so the totals are only ever updated from one place
+        for hostname,devType,deviceResults,elapsed in results:
+            deviceCount += 1
+            if devType == 'IOS':
+                iosCount += 1
+                totalStats = totalStatsIOS
+            elif devType == 'NXOS':
+                nxosCount += 1
+                totalStats = totalStatsNXOS
+            elif devType == 'ASA':
+                asaCount += 1
+                totalStats = totalStatsASA
+            elif devType == 'PTP':
+                ptpCount += 1
+                totalStats = totalStatsPTP
+            else:
+                totalStats = []
+            for i in range(len(totalStats)):
+                totalStats[i]+=deviceResults[i]
+            print '{0} - {1} - {2} sec. {3} total sec.'.format(deviceCount,hostname,elapsed,(time.time()-script_start))
     except Exception as inst:
         msg = 'Exception occurred in main function. Exception = "{0}"'.format(inst)
         logging.warning('MAIN\tERROR\t{0}'.format(msg))
+    if pool is not None:
+        pool.close()
+        pool.join()
+    savePlatforms()
+    saveEntityCache()
 
     logging.info('TOTAL\tSTATS\tIOS\t(Checked,OK,Error) || Fan({1},{2},{3}) || Temp({4},{5},{6}) || PSU({7},{8},{9}) || Devices({0})'.format(iosCount,*totalStatsIOS))
     logging.info('TOTAL\tSTATS\tNXOS\t(Checked,OK,Error) || Fan({1},{2},{3}) || PSU({4},{5},{6}) || Module({7},{8},{9}) || Sensor({10},{11},{12}) || Devices({0})'.format(nxosCount,*totalStatsNXOS))
     logging.info('TOTAL\tSTATS\tASA\t(Checked,OK,Error) || HW({1},{2},{3}) || Conn({4},{5},{6}) || Devices({0})'.format(asaCount,*totalStatsASA))
     logging.info('TOTAL\tSTATS\tPTP\t(Checked,OK,Error) || PTP({1},{2},{3}) || Devices({0})'.format(ptpCount,*totalStatsPTP))
+    alarm_journal.close()
     logging.info('Script Complete')
 
 
@@ -1,21 +1,31 @@
 #!/usr/bin/env python
 
-from snimpy.manager import Manager as M
-from snimpy.manager import load
+from snimpy import snmp
 import argparse
 import socket
 import time
 import logging
-import subprocess
 import pygerduty
 import os
 import re, sys
-import shlex
-from subprocess import PIPE
 import datetime
 import random
 import requests
 import json
+import csv
+import itertools
+import array
+import operator
+import fcntl
+import threading
+from multiprocessing.pool import ThreadPool
+import snmp_engine
+from snmp_engine import walkRawTable,walkTable
+import host_timing
+import mib_cache
+from alarm_index import AlarmIndex
+from exclusion_file import ExclusionFile
+from mib_cache import Manager as M
 
 """
 ========
@@ -44,7 +54,13 @@ then add that to ZK.
 
 2. Load MIBs: This script uses the Snimpy module for all SNMP processing. This module requires 
 that you first load all required MIBs before you start querying devices. The mibs are all located 
-in the 'mibs' directory.
+in the 'mibs' directory. To keep startup fast, a precompiled index of the MIBs is kept in snmp_mib_index.json
+(see mib_cache.py) and only the MIBs of the server types in the server list are parsed, just before the servers
+are queried (libsmi is not thread safe, so this is never done from the worker threads). The index is
+rebuilt automatically whenever a MIB file changes, or manually with --compile-mibs.
+The SNMP response times of every host are also loaded here (see host_timing.py). Hosts with enough history get a
+timeout and retry count based on how fast they actually answer, instead of the defaults in hostSettings. Retries are
+only cut back once a host has gone several runs in a row without a timeout.
 
 3. Check PagerDuty for open incidents: The pygerduty module is used to connect to PagerDuty's API
 and pull the list of all open incidents. This list is used to ensure "resolve" commands are only sent to
@@ -55,7 +71,8 @@ because that would be well over PD's API rate limit.
 along with their manufacturer and model. This ensures that the script always has an accurate list of 
 servers to query each time it runs. This eliminates the need for any type of manual configuration when
 servers are added or removed from the environment. The script should automatically monitor all physical servers
-as long as Salt is working correctly.
+as long as Salt is working correctly. Salt is queried through its REST API (SaltClient); jobs are polled until every
+targeted minion has returned or SALT_JOB_TIMEOUT is reached.
 
 5. Query Servers: The script loops through the list returned from Salt and goes through the following process:
     Determine Manufacturer:
@@ -75,25 +92,240 @@ as long as Salt is working correctly.
             If not OK:
                 Call sendToPagerDuty("trigger"...) This will use pygerduty to send a "trigger" to PD. 
                 If it is a new issue, a new incident will be created. Else, it will be added to the existing incident.         
+    By default servers are queried one at a time. Use --workers N to query up to N servers in parallel; the per-server
+    STATS lines are unchanged and the TOTAL STATS are summed once every server has been queried.
+    Before any server is queried, every server is probed at once with a single sysUpTime GET (--probe, see
+    snmp_engine.probeHosts). Servers that do not answer get their connect alarm straight away and are not queried.
+    With --rollup, HP servers are asked for their subsystem rollup conditions (cpqHeMibCondition, cpqSeMibCondition,
+    cpqDaMibCondition, cpqNicMibCondition) in one GET first. A subsystem's tables are only walked when its rollup is not
+    ok, has changed since the last run, has open incidents on the host, or has not been walked for ROLLUP_MAX_AGE.
+    Skipped subsystems report the counts from their last check. The state is kept in snmp_rollup_state.json.
+    Use --prefetch N to collect the SNMP data for up to N servers at a time with the asynchronous engine in 
+    snmp_engine.py. The checks then run against the collected data instead of making their own requests.
+
+With --daemon the script keeps running and checks every server each --interval seconds instead of being started by
+cron for every run. MIBs, the Salt token and the PagerDuty/ZooKeeper sessions stay loaded between checks. Exclusions,
+open incidents and the server list are refreshed when their DAEMON_*_TTL expires, and triggers and resolves sent by
+the script keep the open incident list current in between. A lock on check_hp.pid stops a second daemon from starting,
+so cron can start the daemon every few minutes to restart it if it exits. A refresh that fails is logged and the
+previous exclusions, incidents or server list are kept. MIBs cannot be reloaded in a running daemon: when the server list
+is refreshed, the MIB files are also checked, and if any of them changed the daemon exits so the next one loads them.
 """
 
 #SET LOGGING AND FILE INFO
 if not os.path.exists('/var/log/snmp_monitoring/'):
     os.mkdir('/var/log/snmp_monitoring/')
 logging.basicConfig(filename='/var/log/snmp_monitoring/check_hp.log',format='%(asctime)s: %(levelname)s: %(message)s',level=logging.INFO)
+#OK detail messages are only built when they will be logged, or when there is an incident they could resolve
+debug_enabled = logging.getLogger().isEnabledFor(logging.DEBUG)
 docroot = "/opt/spot/snmp_monitoring/"
-open_alarms = []
+open_alarms = AlarmIndex()
+exclusions = ExclusionFile(docroot+'snmp_exclusions')
+
+#PagerDuty client, created on first use and shared by the whole run
+SPOT_API_TOKEN="<your PagerDuty token>"
+SERVICE_API_TOKEN="<your PagerDuty service API>"
+pager = None
+pager_lock = threading.Lock()
+pager_pool_size = 1
+
+#Salt API clients, one per Salt master, created on first use
+SALT_USERNAME = '<Salt username>'
+SALT_PASSWORD = '<Salt password>'
+SALT_REQUEST_TIMEOUT = 30
+SALT_JOB_TIMEOUT = 60
+SALT_POLL_INTERVAL = 2
+salt_clients = {}
+salt_lock = threading.Lock()
+
+#Exhibitor (ZooKeeper) REST API, used to pull the exclusions list
+EXHIBITOR_AUTH = ('<Exhibitor username>','Exhibitor password')
+EXHIBITOR_TIMEOUT = 10
+EXHIBITOR_WORKERS = 16
+exhibitor_session = None
+exhibitor_health = {}
+
+#How long each piece of state is kept in --daemon mode before it is refreshed, in seconds
+DAEMON_EXCLUSIONS_TTL = 300
+DAEMON_ALARMS_TTL = 900
+DAEMON_SERVERS_TTL = 3600
+
+#MIBs required by this script, in load order
+mib_files = ["SNMPv2-MIB","CPQHOST.MIB","cpqsinfo.mib","CPQHLTH.MIB","cpqida.mib","cpqstdeq.mib","cpqnic.mib",
+             "SUPERMICRO-SMI.my","spot-ssm.my","SUPERMICRO-HEALTH-MIB.my"]
+#MIBs each server type is queried with. The MIB index adds any of our MIBs they import from.
+server_mib_files = {
+    "HP": ["SNMPv2-MIB","CPQHOST.MIB","cpqsinfo.mib","CPQHLTH.MIB","cpqida.mib","cpqstdeq.mib","cpqnic.mib"],
+    "SM": ["SNMPv2-MIB","SUPERMICRO-SMI.my","spot-ssm.my","SUPERMICRO-HEALTH-MIB.my"],
+}
+
+#Values requested by the connect/agent probes and the columns read by the query* functions. Used to plan the
+#asynchronous prefetch. Keep these in sync with the query* functions; anything missing is still read directly.
+prefetch_objects = {
+    "HP": ([("sysName",None),("cpqSeMibRevMajor",None)],
+           ["cpqHeTemperatureIndex","cpqHeTemperatureCondition","cpqHeTemperatureCelsius","cpqHeTemperatureLocale","cpqHeTemperatureThreshold",
+            "cpqHeFltTolFanIndex","cpqHeFltTolFanLocale","cpqHeFltTolFanCondition",
+            "cpqHeFltTolPowerSupplyBay","cpqHeFltTolPowerSupplyCondition","cpqHeFltTolPowerSupplyCapacityUsed","cpqHeFltTolPowerSupplyCapacityMaximum",
+            "cpqHeFltTolPowerSupplyChassis","cpqHeFltTolPowerSupplySerialNumber",
+            "cpqHeResMem2Module","cpqHeResMem2ModuleStatus","cpqHeResMem2ModuleCondition","cpqHeResMem2ModuleSize",
+            "cpqSeCpuUnitIndex","cpqSeCpuSlot","cpqSeCpuStatus","cpqSeCpuName",
+            "cpqDaCntlrIndex","cpqDaCntlrModel","cpqDaCntlrBoardStatus","cpqDaCntlrBoardCondition","cpqDaCntlrCondition","cpqDaCntlrSerialNumber","cpqDaCntlrHwLocation",
+            "cpqDaPhyDrvIndex","cpqDaPhyDrvLocationString","cpqDaPhyDrvStatus","cpqDaPhyDrvCondition","cpqDaPhyDrvSmartStatus","cpqDaPhyDrvSerialNum",
+            "cpqDaAccelCntlrIndex","cpqDaAccelStatus","cpqDaAccelCondition","cpqDaAccelBattery","cpqDaAccelSerialNumber",
+            "cpqNicIfPhysAdapterIndex","cpqNicIfPhysAdapterCondition","cpqNicIfPhysAdapterState","cpqNicIfPhysAdapterStatus","cpqNicIfPhysAdapterName"]),
+    "SM": ([("sysDescr",None),("sd5Version",1)],
+           ["smHealthMonitorName","smHealthMonitorType","smHealthMonitorReading","smHealthMonitorMonitor","smHealthMonitorHighLimit","smHealthMonitorLowLimit",
+            "memTag","memDescription","memDeviceStatus","memLabeledBank","memDeviceLocator","memManufacturer","memPartNumber","memSerialNumber","memCapacity",
+            "cpuIndex","cpuName","cpuDescription","cpuManufacturer","cpuDeviceStatus","cpuMaxSpeed","cpuCurrentSpeed","cpuCoreEnabled","cpuCoreCount",
+            "cpuThreadCount","cpuSocketDesignation","cpuDeviceVersion","cpuDeviceID",
+            "raidAdapterIndex","raidAdapterGroup","raidAdapterProductName","raidIsBBUAbsent","raidIsBBUAbsentIgnored","raidAdapterAllinoneStatus","raidAdapterAllinoneMsg",
+            "raidPDIndex","raidPDSlotNumber","raidPDFirmwareState","raidPDMediaErrorCount","raidPDOtherErrorCount","raidPDPredFailCount","raidPDInquiryData",
+            "raidPDDeviceSpeed","raidPDMediaType","raidPDAllinoneStatus","raidPDAllinoneMsg",
+            "raidVDId","raidVDRaidLevel","raidVDSize","raidVDNumDrives","raidVDBadBlocksExist","raidVDState","raidVDAllinoneStatus","raidVDAllinoneMsg",
+            "raidBBUIndex","raidBBUStatus","raidBBUAllinoneStatus","raidBBUAllinoneMsg"]),
+}
+prefetch_plans = {}
+
+#Check rules evaluated by runRule. Each rule reads the columns of one table (the first column drives the rows) and
+#names them for the messages. A row is skipped if any "skip" test matches, and fails if a "require" column is not one
+#of its allowed values or a "fail" column is one of its values. Values are enum labels or plain integers; labels are
+#turned into integers once, from the MIB index. "row" is the table index and "hostname" the server in the templates.
+#Adding a component check is a new rule and a query* function that calls runRule with it.
+check_rules = {
+    "queryTemp": {
+        "tag": "TEMP",
+        "columns": [("index","cpqHeTemperatureIndex"),("condition","cpqHeTemperatureCondition"),("celsius","cpqHeTemperatureCelsius"),
+                    ("location","cpqHeTemperatureLocale"),("threshold","cpqHeTemperatureThreshold")],
+        "require": [("condition",["ok"])],
+        "message": 'Temperature Sensor({index}): Condition = {condition}; Celsius = {celsius}; Threshold = {threshold}; Location = {location}',
+        "key": "snmp/temperature/{hostname}/{row}",
+        "trigger": "Temperature issue detected on {hostname}",
+        "resolve": "No temperature issues detected",
+    },
+    "queryFans": {
+        "tag": "FAN",
+        "columns": [("index","cpqHeFltTolFanIndex"),("location","cpqHeFltTolFanLocale"),("condition","cpqHeFltTolFanCondition")],
+        "require": [("condition",["ok","other"])],
+        "message": 'Fan({index}): Condition = {condition}; Location = {location}',
+        "key": "snmp/fan/{hostname}/{index}",
+        "trigger": "Fan issue detected on {hostname}",
+        "resolve": "No fan issues detected",
+    },
+    "queryNics": {
+        "tag": "NIC",
+        "columns": [("index","cpqNicIfPhysAdapterIndex"),("condition","cpqNicIfPhysAdapterCondition"),("state","cpqNicIfPhysAdapterState"),
+                    ("status","cpqNicIfPhysAdapterStatus"),("name","cpqNicIfPhysAdapterName")],
+        "fail": [("status",["generalFailure"])],
+        "message": 'NIC({row}): Status = {status}; Condition = {condition}; State = {state} Name = {name}',
+        "key": "snmp/nic/{hostname}/{row}",
+        "trigger": "NIC issue detected on {hostname}",
+        "resolve": "No NIC issues detected",
+    },
+    "queryMemory": {
+        "tag": "MEMORY",
+        "columns": [("module","cpqHeResMem2Module"),("status","cpqHeResMem2ModuleStatus"),("condition","cpqHeResMem2ModuleCondition"),
+                    ("size","cpqHeResMem2ModuleSize")],
+        "skip": [("status",["notPresent"])],
+        "require": [("status",["good"]),("condition",["ok"])],
+        "message": 'memory module({row}): Status = {status}; Condition = {condition}; Size = {size}',
+        "key": "snmp/memory/{hostname}/{row}",
+        "trigger": "Memory issue detected on {hostname}",
+        "resolve": "No memory issues detected",
+    },
+    "queryCPU": {
+        "tag": "CPU",
+        "columns": [("index","cpqSeCpuUnitIndex"),("slot","cpqSeCpuSlot"),("status","cpqSeCpuStatus"),("name","cpqSeCpuName")],
+        "require": [("status",["ok"])],
+        "message": 'CPU({row}): Status = {status}; Name = {name}; Slot = {slot}',
+        "key": "snmp/cpu/{hostname}/{row}",
+        "trigger": "CPU issue detected on {hostname}",
+        "resolve": "No CPU issues detected",
+    },
+    "queryPower": {
+        "tag": "POWER",
+        "columns": [("bay","cpqHeFltTolPowerSupplyBay"),("condition","cpqHeFltTolPowerSupplyCondition"),("used","cpqHeFltTolPowerSupplyCapacityUsed"),
+                    ("capacity","cpqHeFltTolPowerSupplyCapacityMaximum"),("chassis","cpqHeFltTolPowerSupplyChassis"),("serial","cpqHeFltTolPowerSupplySerialNumber")],
+        "require": [("condition",["ok"])],
+        "message": 'Power Supply: Condition = {condition}; Chassis = {chassis}; Bay = {bay}; Used = {used}; Capacity = {capacity}; Serial = {serial}',
+        "key": "snmp/power/{hostname}/{row}",
+        "trigger": "Power Supply issue detected on {hostname}",
+        "resolve": "No power issues detected",
+    },
+    "querySmMemory": {
+        "tag": "MEMORY",
+        "columns": [("tag","memTag"),("status","memDeviceStatus"),("bank","memLabeledBank"),("manufacturer","memManufacturer"),
+                    ("part","memPartNumber"),("serial","memSerialNumber"),("capacity","memCapacity")],
+        "require": [("status",[0])],
+        "message": 'Memory: Status = {status}; Location = {bank}; Manufacturer = {manufacturer}; PartNum = {part}; Serial = {serial}; Capacity = {capacity}',
+        "key": "snmp/memory/{hostname}/{row}",
+        "trigger": "Memory issue detected on {hostname}",
+        "resolve": "No Memory issues detected",
+    },
+    "querySmCPU": {
+        "tag": "CPU",
+        "columns": [("index","cpuIndex"),("name","cpuName"),("status","cpuDeviceStatus"),("socket","cpuSocketDesignation")],
+        "require": [("status",[0])],
+        "message": 'CPU: Status = {status}; Location = {name}; Name = {socket}',
+        "key": "snmp/cpu/{hostname}/{row}",
+        "trigger": "CPU issue detected on {hostname}",
+        "resolve": "No CPU issues detected",
+    },
+}
+compiled_rules = {}
+compiled_rules_lock = threading.Lock()
+
+#HP subsystem rollup conditions read by --rollup. Each one covers some of the query* functions, and the incident key
+#types those functions use: a subsystem with open incidents on the host is always checked, so its resolves are sent.
+rollup_subsystems = {
+    "cpqHeMibCondition": (["queryTemp","queryFans","queryPower","queryMemory"],["temperature","fan","power","memory"]),
+    "cpqSeMibCondition": (["queryCPU"],["cpu"]),
+    "cpqDaMibCondition": (["queryDrives"],["hdd","controller","accelerator"]),
+    "cpqNicMibCondition": (["queryNics"],["nic"]),
+}
+ROLLUP_MAX_AGE = 86400
+rollup_enabled = False
+rollup_state = {}
+rollup_lock = threading.Lock()
+
+# pygerduty client that sends every request over one keep-alive requests session instead of opening
+# a new HTTPS connection through urllib2 for each call.
+class PooledPagerDuty(pygerduty.PagerDuty):
+    def __init__(self, *args, **kwargs):
+        pygerduty.PagerDuty.__init__(self, *args, **kwargs)
+        self.session = requests.Session()
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=max(pager_pool_size,1)))
+
+    def execute_request(self, request):
+        response = self.session.request(request.get_method(), request.get_full_url(), data=request.get_data(),
+                                        headers=dict(request.header_items()), timeout=self.timeout)
+        if response.status_code / 100 != 2:
+            if response.status_code == 400:
+                raise pygerduty.BadRequest(response.json())
+            elif response.status_code == 404:
+                raise pygerduty.NotFound("URL (%s) Not Found." % request.get_full_url())
+            response.raise_for_status()
+        try:
+            return response.json()
+        except ValueError:
+            return None
+
+# Returns the PagerDuty client for this run, creating it the first time it is needed.
+def getPager():
+    global pager
+    if pager is None:
+        with pager_lock:
+            if pager is None:
+                pager = PooledPagerDuty(api_token=SPOT_API_TOKEN)
+    return pager
 
 # Uses pygerduty to send "resolves" and "triggers" to PD. Only sends "resolves" for currently open incidents.
 def sendToPagerDuty(type,key,desc,det):
-    SPOT_API_TOKEN="<your PagerDuty token>"
-    SERVICE_API_TOKEN="<your PagerDuty service API>"
     try:
-        pager = pygerduty.PagerDuty(api_token=SPOT_API_TOKEN)
         if type == "trigger":
             if checkForExclusion(key) is False:
                 det = det + " ***** HP Dispatch: 800-633-3600 ***** "
-                incident = pager.trigger_incident(service_key=SERVICE_API_TOKEN, incident_key=key, description=desc, details=det)
+                incident = getPager().trigger_incident(service_key=SERVICE_API_TOKEN, incident_key=key, description=desc, details=det)
+                open_alarms.add(key)
                 logging.info('<your pagerduty domain>\tPAGER\tCreating Alarm: {0}'.format(key))
                 return incident
             else:
@@ -102,95 +334,115 @@ def sendToPagerDuty(type,key,desc,det):
         elif type == "resolve":
             if checkForAlarm(key):
                 logging.info('<your pagerduty domain>\tPAGER\tResolving Open Incident: {0}'.format(key))
-                incident = pager.resolve_incident(service_key=SERVICE_API_TOKEN, incident_key=key, description=desc, details=det)
+                incident = getPager().resolve_incident(service_key=SERVICE_API_TOKEN, incident_key=key, description=desc, details=det)
+                open_alarms.discard(key)
                 return incident
     except Exception as inst:
         msg = 'Exception occurred while sending incident to PagerDuty; Exception = "{0}"'.format(inst)
         logging.warning('PAGER\t\tERROR\t{0}'.format(msg))
         return 'exception'
 
+# Client for the Salt REST API (rest_cherrypy). Keeps one keep-alive session per Salt master and reuses the
+# login token until it expires, instead of shelling out to curl and logging in again for every job.
+class SaltClient(object):
+    def __init__(self, url, username, password, eauth='pam'):
+        self.url = url
+        self.username = username
+        self.password = password
+        self.eauth = eauth
+        self.session = requests.Session()
+        self.session.headers.update({'Accept': 'application/json'})
+        self.token = None
+        self.expire = 0
+        self.lock = threading.Lock()
+
+    # Returns a valid token, logging in again when the cached one is about to expire
+    def getToken(self):
+        with self.lock:
+            if (self.token is None) or (time.time() > self.expire - 60):
+                r = self.session.post(self.url + '/login', data={'username': self.username, 'password': self.password, 'eauth': self.eauth}, timeout=SALT_REQUEST_TIMEOUT)
+                r.raise_for_status()
+                login = r.json()['return'][0]
+                self.token = login['token']
+                self.expire = float(login.get('expire', time.time() + 3600))
+            return self.token
+
+    def request(self, method, path, data=None):
+        token = self.getToken()
+        r = self.session.request(method, self.url + path, data=data, headers={'X-Auth-Token': token}, timeout=SALT_REQUEST_TIMEOUT)
+        if r.status_code == 401:
+            #Token was revoked or the master was restarted. Log in again once.
+            with self.lock:
+                if self.token == token:
+                    self.token = None
+            token = self.getToken()
+            r = self.session.request(method, self.url + path, data=data, headers={'X-Auth-Token': token}, timeout=SALT_REQUEST_TIMEOUT)
+        r.raise_for_status()
+        return r.json()
+
+    # Submits a job. Returns the job id and the list of minions it was sent to.
+    def submit(self, lowstate):
+        job = self.request('POST', '/minions', lowstate)['return'][0]
+        return job['jid'], job.get('minions', [])
+
+    # Polls a job until every targeted minion has returned, or until the timeout. Returns a dictionary of minion -> return.
+    def wait(self, jid, minions, timeout=None):
+        if timeout is None:
+            timeout = SALT_JOB_TIMEOUT
+        deadline = time.time() + timeout
+        while True:
+            returns = (self.request('GET', '/jobs/' + jid).get('return') or [{}])[0] or {}
+            if set(minions) <= set(returns):
+                return returns
+            if time.time() >= deadline:
+                logging.warning('SALT\t\tERROR\tJob {0} timed out after {1} sec. Minions that did not return: {2}'.format(jid,timeout,len(set(minions) - set(returns))))
+                return returns
+            time.sleep(SALT_POLL_INTERVAL)
+
+    def run(self, lowstate, timeout=None):
+        jid, minions = self.submit(lowstate)
+        return self.wait(jid, minions, timeout)
+
+def getSalt(env):
+    with salt_lock:
+        if env not in salt_clients:
+            salt_clients[env] = SaltClient('http://salt{0}:8000'.format(env), SALT_USERNAME, SALT_PASSWORD)
+        return salt_clients[env]
+
+# Grain values can contain anything, commas included, so the server list is written and read with the csv module.
+# Unicode values from the Salt API are written as UTF-8.
+def serverRow(fields):
+    return [field.encode('utf-8') if isinstance(field,unicode) else str(field) for field in fields]
+
+# Returns [hostname, manufacturer, productname] for every physical Linux minion
 def walker(env):
-    command="curl -si salt%s:8000/login -H 'Accept: application/json' -d username='<Salt username>' -d password='<Salt password>' -d eauth='pam'" % env
-    login_cmd = shlex.split(command)
-    token = subprocess.Popen(login_cmd,stdout=PIPE).communicate()[0]
-    string_token = str(token)
-    start = string_token.find('token')
-    end = string_token.find(',',start)
-    semi_token = token[start:end]
-    valid = semi_token.split(':')[1].replace('"', '').lstrip().strip()
-    cmd="curl -sS salt%s:8000/minions -H 'Accept: application/json' -H 'X-Auth-Token: %s' -d client='local' -d tgt='* and G@kernel:Linux and G@virtual:physical' -d expr_form='compound' -d fun='grains.item' -d arg='manufacturer' -d arg='host' -d arg='productname' " % (env,valid)
-    command = shlex.split(cmd)
-    output = subprocess.Popen(command,stdout=PIPE).communicate()[0]
-    output = output.split(':')
-    temp_out = output[5]
-    jid = output[5].split(',')[0].replace('"', '').lstrip(' ')
-    com = "curl -sS salt%s:8000/jobs/%s -H 'Accept: application/json' -H 'X-Auth-Token: %s'" %(env,jid, valid)
-    comm = shlex.split(com)
-    result = subprocess.Popen(comm, stdout=PIPE).communicate()[0]    
-    host = []
-    man = []
-    prod = []
-    result = result.split(',')
-    result[0] = result[0].split('[')[1].replace('{','').lstrip()
-    for i in result:
+    returns = getSalt(env).run([('client','local'),('tgt','* and G@kernel:Linux and G@virtual:physical'),('expr_form','compound'),
+                                ('fun','grains.item'),('arg','manufacturer'),('arg','host'),('arg','productname')])
+    joined = []
+    for minion, grains in returns.items():
         try:
-            if re.search(r'\bhost\b',i):
-                h = i.split(':')[0]
-                h2 = re.sub('["\{}\[\]]','',h)
-                host.append(h2.lstrip())
-            if re.search(r'\bmanufacturer\b', i):
-                temp = i.split(':')[1]
-                val = re.sub('["\]\}]','',temp)
-                man.append(val.lstrip())
-            elif re.search(r'\bproductname\b',i):
-                prod.append(i.split(':')[1].replace('"','').lstrip())
+            joined.append(serverRow([minion,grains['manufacturer'],grains['productname']]))
         except Exception as inst:
             msg = 'Exception occurred while querying Salt minion. Server will be skipped; Exception = "{0}"'.format(inst)
             logging.warning('SALT\t\tERROR\t{0}'.format(msg))
-    combined = zip(host,man,prod)
-    joined = []
-    for i in sorted(combined):
-        temp = ','.join(i)
-        joined.append(temp) 
-    return joined 
+    return sorted(joined)
 
+# Returns [hostname, manufacturer, model] for every physical Windows minion
 def physical_checker(env):
-    command="curl -si salt%s:8000/login -H 'Accept: application/json' -d username='<salt username>' -d password='<salt password>' -d eauth='pam'" % env
-    login_cmd = shlex.split(command)
-    token = subprocess.Popen(login_cmd,stdout=PIPE).communicate()[0]
-    string_token = str(token)
-    start = string_token.find('token')
-    end = string_token.find(',',start)
-    semi_token = token[start:end]
-    valid = semi_token.split(':')[1].replace('"', '').lstrip().strip()
-    cmd="curl -sS salt%s:8000/minions -H 'Accept: application/json' -H 'X-Auth-Token: %s' -d client='local' -d tgt='G@kernel:Windows and not G@localhost:CHIV*' -d expr_form='compound' -d fun='cmd.run' -d arg='wmic computersystem get model, manufacturer' " % (env,valid)
-    command = shlex.split(cmd)
-    output = subprocess.Popen(command,stdout=PIPE).communicate()[0]
-    output = output.split(':')
-    temp_out = output[5]
-    jid = output[5].split(',')[0].replace('"', '').lstrip(' ')
-    com = "curl -sS salt%s:8000/jobs/%s -H 'Accept: application/json' -H 'X-Auth-Token: %s'" %(env,jid, valid)
-    comm = shlex.split(com)
-    result = subprocess.Popen(comm, stdout=PIPE).communicate()[0]
-    result = result.split('[')[1].split('",') 
-    hosts=[] 
-    man_model = []
-    for i in result:
+    returns = getSalt(env).run([('client','local'),('tgt','G@kernel:Windows and not G@localhost:CHIV*'),('expr_form','compound'),
+                                ('fun','cmd.run'),('arg','wmic computersystem get model, manufacturer')])
+    joined = []
+    for minion, output in returns.items():
         try:
-            thost = i.split(':')[0].replace('"','').replace('{','').lstrip()
-            both = i.split('\\r\\r\\n')
-            tman = both[1]
+            #wmic prints a header line, then the values. Ex: "HP  ProLiant DL380 G7  "
+            lines = [line for line in re.split(r'[\r\n]+',output) if line.strip()]
+            tman = lines[1]
             if not re.search('VMware', tman):
-                hosts.append(thost)
-                man_model.append(tman)
+                #wmic separates the columns with runs of spaces
+                joined.append(serverRow([minion] + [field for field in re.split(r'\s{2,}',tman.strip()) if field]))
         except Exception as inst:
             msg = 'Exception occurred while querying Salt minion. Server will be skipped; Exception = "{0}"'.format(inst)
             logging.warning('SALT\t\tERROR\t{0}'.format(msg))
-    combined = zip(hosts, man_model)
-    joined = []
-    for i in combined:
-        temp=','.join(i)
-        joined.append(temp)
     return joined
 
 # Query Salt for list of currently active physical servers. Returns hostname, manufacturer, and model.
@@ -198,25 +450,59 @@ def querySalt(env):
     if env == 'master':
         env = 'Production'
     filename = 'snmp_servers_temp'
-    physical = physical_checker(env)
-    result = walker(env)
-    total_list = []
-    for i in sorted(physical):
-        output = re.sub(r'\s{2,}',',' ,i)
-        total_list.append(output)
-    for j in sorted(result):
-        total_list.append(j)
-
-    f = open(docroot+filename, 'w')
-    if env == 'Production':
-        f.write('<server notin Salt>,<server model>\n')
-        f.write('<server not in Salt>,<server model>\n')
-    for j in sorted(total_list):
-        f.write(j)
-        f.write('\n')
-    f.close()
+    #The Windows and Linux discoveries are separate Salt jobs, so they are run (and waited on) at the same time
+    pool = ThreadPool(2)
+    try:
+        physical_job = pool.apply_async(physical_checker,(env,))
+        walker_job = pool.apply_async(walker,(env,))
+        physical = physical_job.get()
+        result = walker_job.get()
+    finally:
+        pool.close()
+    total_list = physical + result
+
+    with open(docroot+filename, 'wb') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        if env == 'Production':
+            writer.writerow(['<server notin Salt>','<server model>'])
+            writer.writerow(['<server not in Salt>','<server model>'])
+        for row in sorted(total_list):
+            writer.writerow(row)
     logging.info('SALT\tSuccessfully queried Salt for server list. Environment: {0}; Servers: {1}'.format(env,len(total_list)))
 
+def getExhibitorSession():
+    global exhibitor_session
+    if exhibitor_session is None:
+        exhibitor_session = requests.Session()
+        exhibitor_session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=5, pool_maxsize=EXHIBITOR_WORKERS))
+    return exhibitor_session
+
+# Picks the Exhibitor server to query: fewest recent failures first, then lowest response time. Servers that have not
+# been tried yet count as the fastest, and ties are broken at random. The server that was just tried is never picked
+# again unless it is the only one.
+def pickExhibitor(server_pool, last):
+    candidates = [server for server in server_pool if server != last] or list(server_pool)
+    random.shuffle(candidates)
+    return min(candidates, key=lambda server: exhibitor_health.get(server,(0,0.0)))
+
+# Records the outcome of a request to an Exhibitor server. elapsed is None when the request failed.
+def recordExhibitor(server, elapsed):
+    if server is None:
+        return
+    failures, rtt = exhibitor_health.get(server,(0,0.0))
+    if elapsed is None:
+        exhibitor_health[server] = (failures + 1, rtt)
+    elif rtt:
+        exhibitor_health[server] = (0, (0.7 * rtt) + (0.3 * elapsed))
+    else:
+        exhibitor_health[server] = (0, elapsed)
+
+def getExhibitorNode(server, value):
+    host_node = 'http://{0}:8080/exhibitor/v1/explorer/node-data?key=/SNMPExceptions/{1}'.format(server,value)
+    req = getExhibitorSession().get(host_node, auth=EXHIBITOR_AUTH, timeout=EXHIBITOR_TIMEOUT)
+    req.raise_for_status()
+    return req.json()["str"]
+
 def populateExclusions(env):
     if env == "Staging":
         server_pool = ['<Staging zookeeper node 1>','<Staging zookeeper node 2>','<Staging zookeeper node 3>','<Staging zookeeper node 4>','<Staging zookeeper node 5>']
@@ -225,43 +511,57 @@ def populateExclusions(env):
     elif env == "master":
         server_pool = ['<Production zookeeper node 1>','<Production zookeeper node 2>','<Production zookeeper node 3>','<Production zookeeper node 4>','<Production zookeeper node 5>']
 
+    session = getExhibitorSession()
+    pool = ThreadPool(EXHIBITOR_WORKERS)
     run = True
     retry_count = 0
-    while run == True:
-        try:
-            excludes = []
-            server = random.choice(server_pool)
-            host = 'http://{0}:8080/exhibitor/v1/explorer/node?key=/SNMPExceptions'.format(server)
-            r = requests.get(host, auth=('<Exhibitor username>','Exhibitor password'))
-            data = r.json()
-            for item in data:
-                value = item["title"]
-                host_node = 'http://{0}:8080/exhibitor/v1/explorer/node-data?key=/SNMPExceptions/{1}'.format(server,value)
-                req = requests.get(host_node, auth=('<Exhibitor username>','Exhibitor password'))
-                node_data = req.json()
-                excludes.append(node_data["str"])
-            with open(docroot+'snmp_exclusions','w') as f:
-                for x in excludes:
-                    f.write('{0}\n'.format(x))
-            logging.info('ZOOKEEPER\tSuccessfully queried ZooKeeper for exclusions list. Host: {0}; Exclusions: {1}'.format(host,len(excludes)))
-            run = False
-        except Exception as inst:
-            logging.error('ZOOKEEPER\tError querying host {0}. Exception: {1}'.format(host,inst))
-            retry_count += 1
-            if (retry_count == 5):
-                logging.error('ZOOKEEPER\tUnable to connect to any ZooKeeper hosts after {0} retry attempts. Exiting script.'.format(retry_count))
+    server = None
+    host = None
+    try:
+        while run == True:
+            try:
+                server = pickExhibitor(server_pool,server)
+                host = 'http://{0}:8080/exhibitor/v1/explorer/node?key=/SNMPExceptions'.format(server)
+                start = time.time()
+                r = session.get(host, auth=EXHIBITOR_AUTH, timeout=EXHIBITOR_TIMEOUT)
+                r.raise_for_status()
+                recordExhibitor(server,time.time() - start)
+                data = r.json()
+                #Fetch the data for every exclusion node at the same time, over the pooled session
+                excludes = pool.map(lambda value: getExhibitorNode(server,value), [item["title"] for item in data])
+                with open(docroot+'snmp_exclusions','w') as f:
+                    for x in excludes:
+                        f.write('{0}\n'.format(x))
+                logging.info('ZOOKEEPER\tSuccessfully queried ZooKeeper for exclusions list. Host: {0}; Exclusions: {1}'.format(host,len(excludes)))
                 run = False
-            else:
-                logging.info('ZOOKEEPER\tRetry attempt {0}'.format(retry_count))
+            except Exception as inst:
+                recordExhibitor(server,None)
+                logging.error('ZOOKEEPER\tError querying host {0}. Exception: {1}'.format(host,inst))
+                retry_count += 1
+                if (retry_count == 5):
+                    logging.error('ZOOKEEPER\tUnable to connect to any ZooKeeper hosts after {0} retry attempts. Exiting script.'.format(retry_count))
+                    run = False
+                else:
+                    logging.info('ZOOKEEPER\tRetry attempt {0}'.format(retry_count))
+    finally:
+        pool.close()
 
 # Uses pygerduty to get current list of all open incidents for PD. We need this information
 # to decide when "resolve" messages are needed.
 def getCurrentAlarms():
-    SPOT_API_TOKEN="<your PagerDuty API token>"
-    pager = pygerduty.PagerDuty(api_token=SPOT_API_TOKEN)
-    for incident in pager.incidents.list(status="triggered,acknowledged"):
-        open_alarms.append(incident.incident_key)
-        logging.info('PAGER\tOPEN INCIDENTS\t{0}'.format(incident.incident_key))
+    keys = [incident.incident_key for incident in getPager().incidents.list(status="triggered,acknowledged")]
+    open_alarms.clear()
+    for key in keys:
+        open_alarms.add(key)
+        logging.info('PAGER\tOPEN INCIDENTS\t{0}'.format(key))
+
+# Returns the set of open incident keys for a host
+def getHostAlarms(hostname):
+    return open_alarms.hostAlarms(hostname)
+
+# True if a host has any open incident, so a resolve for one of its components might be sent
+def hostHasAlarms(hostname):
+    return open_alarms.hostHasAlarms(hostname)
 
 def checkForAlarm(key):
     if key in open_alarms:
@@ -269,13 +569,7 @@ def checkForAlarm(key):
     return False
 
 def checkForExclusion(key):
-    result = False
-    with open(docroot+'snmp_exclusions','r') as f:
-        for line in f:
-            if line[:-1] == key:
-                result = True
-                return result
-    return result
+    return key in exclusions
 
 def touch(fname):
     if os.path.exists(fname):
@@ -284,148 +578,115 @@ def touch(fname):
         open(fname, 'a').close()
 
 
-# Most query* functions follow the same format. They use snimpy to request a list of all hw components (such as HDDs) on the device, then 
-# loop through that list and grab all relevant info (such as condition, SMART status, serial #) for each component. Those results are 
-# then compared against a list of acceptable values (make sure status is 'ok'). If any non-acceptable results are found 
-# (status = "predictive failure"), the relevant information is added to a message and sent to PagerDuty (via sendToPagerDuty()).
-# If things are OK, sendToPagerDuty() is still used, but only to determine if a "resolve" needs to be sent to PD. 
-def queryTemp(device,hostname):
+# Reads several scalars with a single GET. Returns the values in the same order as the names.
+def getScalars(device,names):
+    scalars = [device._locate(name)[1] for name in names]
+    results = device._session.get(*[scalar.oid + (0,) for scalar in scalars])
+    return [scalars[i].type(scalars[i],results[i][1]) for i in range(len(scalars))]
+
+# Turns the labels of a rule's tests into a set of integer values per column. Integers are used as they are.
+def compileTests(names,aliases,tests):
+    compiled = []
+    for alias,allowed in tests:
+        name = names[aliases.index(alias)]
+        enum = None
+        values = set()
+        for value in allowed:
+            if isinstance(value,int):
+                values.add(value)
+                continue
+            if enum is None:
+                enum = mib_cache.resolveEnum(name)
+            if value not in enum:
+                raise ValueError('"{0}" is not a value of {1}'.format(value,name))
+            values.add(enum[value])
+        compiled.append((aliases.index(alias),frozenset(values)))
+    return compiled
+
+# Compiles a rule from check_rules the first time it is used. The MIB index must be loaded first.
+def getCompiledRule(name):
+    if name not in compiled_rules:
+        with compiled_rules_lock:
+            if name not in compiled_rules:
+                rule = check_rules[name]
+                aliases = [alias for alias,column in rule["columns"]]
+                names = [column for alias,column in rule["columns"]]
+                compiled_rules[name] = {"names": names,
+                                        "aliases": aliases,
+                                        "skip": compileTests(names,aliases,rule.get("skip",[])),
+                                        "require": compileTests(names,aliases,rule.get("require",[])),
+                                        "fail": compileTests(names,aliases,rule.get("fail",[]))}
+    return compiled_rules[name]
+
+# Evaluates a rule from check_rules against every row of its table. The table is walked once and the tests compare
+# plain integers; snimpy values are only built for the messages that are actually sent or logged.
+def runRule(name,device,hostname):
+    rule = check_rules[name]
+    compiled = getCompiledRule(name)
     total,ok,failed = 0,0,0
-    for index in device.cpqHeTemperatureIndex:
+    columns,rows = walkRawTable(device,compiled["names"])
+    for index,values in rows:
+        converted = {}
+        for i in range(len(values)):
+            if values[i] is None:
+                #Not in the walk. Request it individually, so a missing value fails the same way a direct lookup would.
+                converted[i] = getattr(device,compiled["names"][i])[index]
+                values[i] = converted[i]
+
+        if [i for i,allowed in compiled["skip"] if int(values[i]) in allowed]:
+            continue
         total += 1
-        expected = 'ok(2)'
-        tempCondition = device.cpqHeTemperatureCondition[index]
-        tempCelsius = device.cpqHeTemperatureCelsius[index]
-        tempLocale = device.cpqHeTemperatureLocale[index]
-        tempThreshold = device.cpqHeTemperatureThreshold[index]
-        tempIndex = device.cpqHeTemperatureIndex[index]
-
-        if str(tempCondition) != expected:
-            failed+=1
-            msg = 'Error for Temperature Sensor({0}): Condition = {1}; Celsius = {2}; Threshold = {3}; Location = {4}'.format(tempIndex,tempCondition,tempCelsius,tempThreshold,tempLocale)
-            logging.warning('{0}\tTEMP\t{1}'.format(hostname,msg))
-            incident = sendToPagerDuty("trigger","snmp/temperature/{0}/{1}".format(hostname,index),"Temperature issue detected on {0}".format(hostname),msg)
+        error = [i for i,allowed in compiled["require"] if int(values[i]) not in allowed] or \
+                [i for i,allowed in compiled["fail"] if int(values[i]) in allowed]
+        if not error:
+            ok += 1
+            if not (debug_enabled or hostHasAlarms(hostname)):
+                continue
+
+        fields = {"hostname": hostname, "row": index}
+        for i in range(len(values)):
+            if i not in converted:
+                converted[i] = columns[i].type(columns[i],values[i])
+            fields[compiled["aliases"][i]] = converted[i]
+        key = rule["key"].format(**fields)
+        if error:
+            failed += 1
+            msg = 'Error for ' + rule["message"].format(**fields)
+            logging.warning('{0}\t{2}\t{1}'.format(hostname,msg,rule["tag"]))
+            incident = sendToPagerDuty("trigger",key,rule["trigger"].format(**fields),msg)
         else:
-            ok+=1
-            msg = 'OK for Temperature Sensor({0}): Condition = {1}; Celsius = {2}; Threshold = {3}; Location = {4}'.format(tempIndex,tempCondition,tempCelsius,tempThreshold,tempLocale)
-            logging.debug('{0}\tTEMP\t{1}'.format(hostname,msg))
-            sendToPagerDuty("resolve","snmp/temperature/{0}/{1}".format(hostname,index),"No temperature issues detected",msg)
+            msg = 'OK for ' + rule["message"].format(**fields)
+            logging.debug('{0}\t{2}\t{1}'.format(hostname,msg,rule["tag"]))
+            sendToPagerDuty("resolve",key,rule["resolve"].format(**fields),msg)
     return total,ok,failed
 
+# Most query* functions follow the same format. They request a list of all hw components (such as fans) on the device,
+# then compare the relevant info (such as condition) for each component against a list of acceptable values. If any
+# non-acceptable results are found (condition = "failed"), the relevant information is added to a message and sent to
+# PagerDuty (via sendToPagerDuty()). If things are OK, sendToPagerDuty() is still used, but only to determine if a
+# "resolve" needs to be sent to PD. The simple ones are described in check_rules and evaluated by runRule().
+def queryTemp(device,hostname):
+    return runRule("queryTemp",device,hostname)
+
 def queryFans(device,hostname):
-    total,ok,failed = 0,0,0
-    for index in device.cpqHeFltTolFanIndex:
-        total += 1
-        expected = 'ok(2)'
-        expected_other = 'other(1)'
-        fanLocale = device.cpqHeFltTolFanLocale[index]
-        fanCondition = device.cpqHeFltTolFanCondition[index]
-        fanIndex = device.cpqHeFltTolFanIndex[index]
-
-        if (str(fanCondition) != expected) and (str(fanCondition) != expected_other):
-            failed+=1
-            msg = 'Error for Fan({0}): Condition = {1}; Location = {2}'.format(fanIndex,fanCondition,fanLocale)
-            logging.warning('{0}\tFAN\t{1}'.format(hostname,msg))
-            incident = sendToPagerDuty("trigger","snmp/fan/{0}/{1}".format(hostname,fanIndex),"Fan issue detected on {0}".format(hostname),msg)
-        else:
-            ok+=1
-            msg = 'OK for Fan({0}): Condition = {1}; Location = {2}'.format(fanIndex,fanCondition,fanLocale)
-            logging.debug('{0}\tFAN\t{1}'.format(hostname,msg))
-            sendToPagerDuty("resolve","snmp/fan/{0}/{1}".format(hostname,fanIndex),"No fan issues detected",msg)
-    return total,ok,failed
+    return runRule("queryFans",device,hostname)
 
 def queryNics(device,hostname):
-    total,ok,failed = 0,0,0
-    for index in device.cpqNicIfPhysAdapterIndex:
-        total += 1
-        nicCondition = device.cpqNicIfPhysAdapterCondition[index]
-        nicState = device.cpqNicIfPhysAdapterState[index]
-        nicStatus = device.cpqNicIfPhysAdapterStatus[index]
-        nicName = device.cpqNicIfPhysAdapterName[index]
-
-        if str(nicStatus) == "generalFailure(3)":
-            failed+=1
-            msg = 'Error for NIC({0}): Status = {1}; Condition = {2}; State = {3} Name = {4}'.format(index,nicStatus,nicCondition,nicState,nicName)
-            logging.warning('{0}\tNIC\t{1}'.format(hostname,msg))
-            incident = sendToPagerDuty("trigger","snmp/nic/{0}/{1}".format(hostname,index),"NIC issue detected on {0}".format(hostname),msg)
-        else:
-            ok+=1
-            msg = 'OK for NIC({0}): Status = {1}; Condition = {2}; State = {3} Name = {4}'.format(index,nicStatus,nicCondition,nicState,nicName)
-            logging.debug('{0}\tNIC\t{1}'.format(hostname,msg))
-            sendToPagerDuty("resolve","snmp/nic/{0}/{1}".format(hostname,index),"No NIC issues detected",msg)
-    return total,ok,failed
+    return runRule("queryNics",device,hostname)
 
 def queryMemory(device,hostname):
-    total,ok,failed = 0,0,0
-    for index in device.cpqHeResMem2Module:
-        expected = 'ok(2)'
-        expected_status = 'good(4)'
-
-        memStatus = device.cpqHeResMem2ModuleStatus[index]
-        memCondition = device.cpqHeResMem2ModuleCondition[index]
-        memSize = device.cpqHeResMem2ModuleSize[index]
-
-        if str(memStatus) != "notPresent(2)":
-            total+=1
-            if (str(memStatus) != expected_status) or (str(memCondition) != expected):
-                failed+=1
-                msg = 'Error for memory module({0}): Status = {1}; Condition = {2}; Size = {3}'.format(index,memStatus,memCondition,memSize)
-                logging.warning('{0}	MEMORY	{1}'.format(hostname,msg))
-                incident = sendToPagerDuty("trigger","snmp/memory/{0}/{1}".format(hostname,index),"Memory issue detected on {0}".format(hostname),msg)
-            else:
-                ok+=1
-                msg = 'OK for memory module({0}): Status = {1}; Condition = {2}; Size = {3}'.format(index,memStatus,memCondition,memSize)
-                logging.debug('{0}	MEMORY	{1}'.format(hostname,msg))
-                sendToPagerDuty("resolve","snmp/memory/{0}/{1}".format(hostname,index),"No memory issues detected",msg)
-    return total,ok,failed
+    return runRule("queryMemory",device,hostname)
 
 def queryCPU(device,hostname):
-    total,ok,failed = 0,0,0
-    for index in device.cpqSeCpuUnitIndex:
-        total += 1
-        expected = 'ok(2)'
-        cpuSlot = device.cpqSeCpuSlot[index]
-        cpuStatus = device.cpqSeCpuStatus[index]
-        cpuName = device.cpqSeCpuName[index]
-        if str(cpuStatus) != expected:
-            failed+=1
-            msg = 'Error for CPU({0}): Status = {1}; Name = {2}; Slot = {3}'.format(index,cpuStatus,cpuName,cpuSlot)
-            logging.warning('{0}	CPU	{1}'.format(hostname,msg))
-            incident = sendToPagerDuty("trigger","snmp/cpu/{0}/{1}".format(hostname,index),"CPU issue detected on {0}".format(hostname),msg)
-        else:
-            ok+=1
-            msg = 'OK for CPU({0}): Status = {1}; Name = {2}; Slot = {3}'.format(index,cpuStatus,cpuName,cpuSlot)
-            logging.debug('{0}	CPU	{1}'.format(hostname,msg))
-            sendToPagerDuty("resolve","snmp/cpu/{0}/{1}".format(hostname,index),"No CPU issues detected",msg)
-    return total,ok,failed
+    return runRule("queryCPU",device,hostname)
 
 def queryPower(device,hostname):
-    total,ok,failed = 0,0,0
-    for index in device.cpqHeFltTolPowerSupplyBay:
-        total += 1
-        expected = 'ok(2)'
-        psuCondition = device.cpqHeFltTolPowerSupplyCondition[index]
-        psuUsed = device.cpqHeFltTolPowerSupplyCapacityUsed[index]
-        psuMax = device.cpqHeFltTolPowerSupplyCapacityMaximum[index]
-        psuChassis = device.cpqHeFltTolPowerSupplyChassis[index]
-        psuBay = device.cpqHeFltTolPowerSupplyBay[index]
-        psuSerial = device.cpqHeFltTolPowerSupplySerialNumber[index]
-        if str(psuCondition) != expected:
-            failed+=1
-            msg = 'Error for Power Supply: Condition = {1}; Chassis = {2}; Bay = {3}; Used = {4}; Capacity = {5}; Serial = {6}'.format(index,psuCondition,psuChassis,psuBay,psuUsed,psuMax,psuSerial)
-            logging.warning('{0}	POWER	{1}'.format(hostname,msg))
-            incident = sendToPagerDuty("trigger","snmp/power/{0}/{1}".format(hostname,index),"Power Supply issue detected on {0}".format(hostname),msg)
-        else:
-            ok+=1
-            msg = 'OK for Power Supply: Condition = {1}; Chassis = {2}; Bay = {3}; Used = {4}; Capacity = {5}; Serial = {6}'.format(index,psuCondition,psuChassis,psuBay,psuUsed,psuMax,psuSerial)
-            logging.debug('{0}	POWER	{1}'.format(hostname,msg))
-            sendToPagerDuty("resolve","snmp/power/{0}/{1}".format(hostname,index),"No power issues detected",msg)
-    return total,ok,failed
+    return runRule("queryPower",device,hostname)
 
 # This is a bit different than the other query* functions. It checks HDDs, accelerators, and controllers in a single function.
 # This allows us to be smarter about the alarms we send. For example, we know that the controller status will always be 
 # degraded if there is an accelerator error. Therefore, we suppress the controller error in that scenario to prevent having 
-# two incidents for the same issue in PD. 
+# two incidents for the same issue in PD. Each table is fetched once with walkTable() and evaluated from memory.
 def queryDrives(device,hostname):
     d_total,d_ok,d_failed = 0,0,0
     c_total,c_ok,c_failed = 0,0,0
@@ -433,19 +694,21 @@ def queryDrives(device,hostname):
     hdd_or_accel_error = False
     controller_models = []
 
-    for index in device.cpqDaCntlrIndex:
-        controller_models.append(str(device.cpqDaCntlrModel[index]))
+    controllers = walkTable(device,["cpqDaCntlrIndex","cpqDaCntlrModel","cpqDaCntlrBoardStatus","cpqDaCntlrBoardCondition","cpqDaCntlrCondition","cpqDaCntlrSerialNumber","cpqDaCntlrHwLocation"])
+    for index,row in controllers:
+        controller_models.append(str(row["cpqDaCntlrModel"]))
 
-    for index in device.cpqDaPhyDrvIndex:
+    drives = walkTable(device,["cpqDaPhyDrvIndex","cpqDaPhyDrvLocationString","cpqDaPhyDrvStatus","cpqDaPhyDrvCondition","cpqDaPhyDrvSmartStatus","cpqDaPhyDrvSerialNum"])
+    for index,row in drives:
         d_total += 1
         allowed_status = ['ok(2)']
         allowed_condition = ['ok(2)']
         allowed_SMART = ['other(1)','ok(2)']
-        drvLocation = device.cpqDaPhyDrvLocationString[index]
-        drvStatus = device.cpqDaPhyDrvStatus[index]
-        drvCondition = device.cpqDaPhyDrvCondition[index]
-        drvSMART = device.cpqDaPhyDrvSmartStatus[index]
-        drvSerial = device.cpqDaPhyDrvSerialNum[index]
+        drvLocation = row["cpqDaPhyDrvLocationString"]
+        drvStatus = row["cpqDaPhyDrvStatus"]
+        drvCondition = row["cpqDaPhyDrvCondition"]
+        drvSMART = row["cpqDaPhyDrvSmartStatus"]
+        drvSerial = row["cpqDaPhyDrvSerialNum"]
         if (str(drvStatus) not in allowed_status) or (str(drvCondition) not in allowed_condition) or (str(drvSMART) not in allowed_SMART):
             d_failed+=1
             msg = 'Error for HDD: Location = {0}; Status = {1}; Condition = {2}; SMART = {3}; Serial = {4}'.format(drvLocation,drvStatus,drvCondition,drvSMART,drvSerial)
@@ -454,19 +717,21 @@ def queryDrives(device,hostname):
             hdd_or_accel_error = True
         else:
             d_ok+=1
-            msg = 'OK for HDD: Location = {0}; Status = {1}; Condition = {2}; SMART = {3}; Serial = {4}'.format(drvLocation,drvStatus,drvCondition,drvSMART,drvSerial)
-            logging.debug('{0}	HDD	{1}'.format(hostname,msg))
-            sendToPagerDuty("resolve","snmp/hdd/{0}/{1}".format(hostname,index),"No hard drive issues detected",msg)
+            if debug_enabled or hostHasAlarms(hostname):
+                msg = 'OK for HDD: Location = {0}; Status = {1}; Condition = {2}; SMART = {3}; Serial = {4}'.format(drvLocation,drvStatus,drvCondition,drvSMART,drvSerial)
+                logging.debug('{0}	HDD	{1}'.format(hostname,msg))
+                sendToPagerDuty("resolve","snmp/hdd/{0}/{1}".format(hostname,index),"No hard drive issues detected",msg)
 
-    for index in device.cpqDaAccelCntlrIndex:
+    accelerators = walkTable(device,["cpqDaAccelCntlrIndex","cpqDaAccelStatus","cpqDaAccelCondition","cpqDaAccelBattery","cpqDaAccelSerialNumber"])
+    for index,row in accelerators:
         a_total += 1
         allowed_status = ['enabled(3)','invalid(2)']
         allowed_condition = ['ok(2)','other(1)']
         allowed_battery = ['ok(2)','notPresent(6)']
-        accelStatus = device.cpqDaAccelStatus[index]
-        accelCondition = device.cpqDaAccelCondition[index]
-        accelBattery = device.cpqDaAccelBattery[index]
-        accelSerial = device.cpqDaAccelSerialNumber[index]
+        accelStatus = row["cpqDaAccelStatus"]
+        accelCondition = row["cpqDaAccelCondition"]
+        accelBattery = row["cpqDaAccelBattery"]
+        accelSerial = row["cpqDaAccelSerialNumber"]
 
         if (str(accelStatus) not in allowed_status) or (str(accelCondition) not in allowed_condition) or (str(accelBattery) not in allowed_battery):
             a_failed+=1
@@ -479,20 +744,21 @@ def queryDrives(device,hostname):
             hdd_or_accel_error = True
         else:
             a_ok+=1
-            msg = 'OK for Array Accelerator({0}): Status = {1}; Condition = {2}; Battery = {3}; Serial = {4}'.format(index,accelStatus,accelCondition,accelBattery,accelSerial)
-            logging.debug('{0}\tACCEL\t{1}'.format(hostname,msg))
-            sendToPagerDuty("resolve","snmp/accelerator/{0}/{1}".format(hostname,index),"No accelerator issues detected",msg)
+            if debug_enabled or hostHasAlarms(hostname):
+                msg = 'OK for Array Accelerator({0}): Status = {1}; Condition = {2}; Battery = {3}; Serial = {4}'.format(index,accelStatus,accelCondition,accelBattery,accelSerial)
+                logging.debug('{0}\tACCEL\t{1}'.format(hostname,msg))
+                sendToPagerDuty("resolve","snmp/accelerator/{0}/{1}".format(hostname,index),"No accelerator issues detected",msg)
 
-    for index in device.cpqDaCntlrIndex:
+    for index,row in controllers:
         c_total += 1
         allowed_status = ['ok(2)']
         allowed_condition = ['ok(2)']
-        ctrStatus = device.cpqDaCntlrBoardStatus[index]
-        ctrBoardCondition = device.cpqDaCntlrBoardCondition[index]
-        ctrCondition = device.cpqDaCntlrCondition[index]
-        ctrSerial = device.cpqDaCntlrSerialNumber[index]
-        ctrModel = device.cpqDaCntlrModel[index]
-        ctrLocation = device.cpqDaCntlrHwLocation[index]
+        ctrStatus = row["cpqDaCntlrBoardStatus"]
+        ctrBoardCondition = row["cpqDaCntlrBoardCondition"]
+        ctrCondition = row["cpqDaCntlrCondition"]
+        ctrSerial = row["cpqDaCntlrSerialNumber"]
+        ctrModel = row["cpqDaCntlrModel"]
+        ctrLocation = row["cpqDaCntlrHwLocation"]
         if (str(ctrStatus) not in allowed_status) or (str(ctrCondition) not in allowed_condition):
             c_failed+=1
             msg = 'Error for Controller: Location = {0}; Status = {1}; Condition = {2}; Model = {3}; Serial = {4}'.format(ctrLocation,ctrStatus,ctrCondition,ctrModel,ctrSerial)
@@ -501,9 +767,10 @@ def queryDrives(device,hostname):
                 incident = sendToPagerDuty("trigger","snmp/controller/{0}/{1}".format(hostname,index),"Controller issue detected on {0}".format(hostname),msg)
         else:
             c_ok+=1
-            msg = 'OK for Controller: Location = {0}; Status = {1}; Condition = {2}; Model = {3}; Serial = {4}'.format(ctrLocation,ctrStatus,ctrCondition,ctrModel,ctrSerial)
-            logging.debug('{0}	CTRLR	{1}'.format(hostname,msg))
-            sendToPagerDuty("resolve","snmp/controller/{0}/{1}".format(hostname,index),"No controller issues detected",msg)
+            if debug_enabled or hostHasAlarms(hostname):
+                msg = 'OK for Controller: Location = {0}; Status = {1}; Condition = {2}; Model = {3}; Serial = {4}'.format(ctrLocation,ctrStatus,ctrCondition,ctrModel,ctrSerial)
+                logging.debug('{0}	CTRLR	{1}'.format(hostname,msg))
+                sendToPagerDuty("resolve","snmp/controller/{0}/{1}".format(hostname,index),"No controller issues detected",msg)
 
     return d_total,d_ok,d_failed,c_total,c_ok,c_failed,a_total,a_ok,a_failed
 
@@ -548,9 +815,10 @@ def querySensors(device,hostname):
                 logging.warning('{0}\t{2}\t{1}'.format(hostname,msg,current_check.upper()))
             else:
                 f_ok += 1
-                msg = 'OK for {4} Sensor({0}): Value = {1} {5}; High Threshold = {2} {5}; Low Threshold = {3} {5}'.format(name,reading,highlimit,lowlimit,current_check,current_unit)
-                logging.debug('{0}\t{2}\t{1}'.format(hostname,msg,current_check.upper()))
-                sendToPagerDuty("resolve","snmp/{2}/{0}/{1}".format(hostname,index,current_check.lower()),"No {0} issues detected".format(current_check),msg)
+                if debug_enabled or hostHasAlarms(hostname):
+                    msg = 'OK for {4} Sensor({0}): Value = {1} {5}; High Threshold = {2} {5}; Low Threshold = {3} {5}'.format(name,reading,highlimit,lowlimit,current_check,current_unit)
+                    logging.debug('{0}\t{2}\t{1}'.format(hostname,msg,current_check.upper()))
+                    sendToPagerDuty("resolve","snmp/{2}/{0}/{1}".format(hostname,index,current_check.lower()),"No {0} issues detected".format(current_check),msg)
         #Voltage
         elif type == "1":
             current_check = "Voltage"
@@ -563,9 +831,10 @@ def querySensors(device,hostname):
                 logging.warning('{0}\t{2}\t{1}'.format(hostname,msg,current_check.upper()))
             else:
                 p_ok += 1
-                msg = 'OK for {4} Sensor({0}): Value = {1} {5}; High Threshold = {2} {5}; Low Threshold = {3} {5}'.format(name,reading,highlimit,lowlimit,current_check,current_unit)
-                logging.debug('{0}\t{2}\t{1}'.format(hostname,msg,current_check.upper()))
-                sendToPagerDuty("resolve","snmp/{2}/{0}/{1}".format(hostname,index,current_check.lower()),"No {0} issues detected".format(current_check),msg)
+                if debug_enabled or hostHasAlarms(hostname):
+                    msg = 'OK for {4} Sensor({0}): Value = {1} {5}; High Threshold = {2} {5}; Low Threshold = {3} {5}'.format(name,reading,highlimit,lowlimit,current_check,current_unit)
+                    logging.debug('{0}\t{2}\t{1}'.format(hostname,msg,current_check.upper()))
+                    sendToPagerDuty("resolve","snmp/{2}/{0}/{1}".format(hostname,index,current_check.lower()),"No {0} issues detected".format(current_check),msg)
         #Temperature
         elif type == "2":
             current_check = "Temperature"
@@ -578,9 +847,10 @@ def querySensors(device,hostname):
                 logging.warning('{0}\t{2}\t{1}'.format(hostname,msg,current_check.upper()))
             else:
                 t_ok += 1
-                msg = 'OK for {4} Sensor({0}): Value = {1} {5}; High Threshold = {2} {5}; Low Threshold = {3} {5}'.format(name,reading,highlimit,lowlimit,current_check,current_unit)
-                logging.debug('{0}\t{2}\t{1}'.format(hostname,msg,current_check.upper()))
-                sendToPagerDuty("resolve","snmp/{2}/{0}/{1}".format(hostname,index,current_check.lower()),"No {0} issues detected".format(current_check),msg)
+                if debug_enabled or hostHasAlarms(hostname):
+                    msg = 'OK for {4} Sensor({0}): Value = {1} {5}; High Threshold = {2} {5}; Low Threshold = {3} {5}'.format(name,reading,highlimit,lowlimit,current_check,current_unit)
+                    logging.debug('{0}\t{2}\t{1}'.format(hostname,msg,current_check.upper()))
+                    sendToPagerDuty("resolve","snmp/{2}/{0}/{1}".format(hostname,index,current_check.lower()),"No {0} issues detected".format(current_check),msg)
         #Status (0:good, 1:bad)
         elif type == "3":
             current_check = "Status"
@@ -593,9 +863,10 @@ def querySensors(device,hostname):
                 logging.warning('{0}\t{2}\t{1}'.format(hostname,msg,current_check.upper()))
             else:
                 s_ok += 1
-                msg = 'OK for Status Sensor({0}): Value = {1}; (0 = OK)'.format(name,reading)
-                logging.debug('{0}\t{2}\t{1}'.format(hostname,msg,current_check.upper()))
-                sendToPagerDuty("resolve","snmp/{2}/{0}/{1}".format(hostname,index,current_check.lower()),"No {0} issues detected".format(current_check),msg)
+                if debug_enabled or hostHasAlarms(hostname):
+                    msg = 'OK for Status Sensor({0}): Value = {1}; (0 = OK)'.format(name,reading)
+                    logging.debug('{0}\t{2}\t{1}'.format(hostname,msg,current_check.upper()))
+                    sendToPagerDuty("resolve","snmp/{2}/{0}/{1}".format(hostname,index,current_check.lower()),"No {0} issues detected".format(current_check),msg)
         #Current
         elif type == "7":
             current_check = "Current"
@@ -608,9 +879,10 @@ def querySensors(device,hostname):
                 logging.warning('{0}\t{2}\t{1}'.format(hostname,msg,current_check.upper()))
             else:
                 p_ok += 1
-                msg = 'OK for {4} Sensor({0}): Value = {1} {5}; High Threshold = {2} {5}; Low Threshold = {3} {5}'.format(name,reading,highlimit,lowlimit,current_check,current_unit)
-                logging.debug('{0}\t{2}\t{1}'.format(hostname,msg,current_check.upper()))
-                sendToPagerDuty("resolve","snmp/{2}/{0}/{1}".format(hostname,index,current_check.lower()),"No {0} issues detected".format(current_check),msg)
+                if debug_enabled or hostHasAlarms(hostname):
+                    msg = 'OK for {4} Sensor({0}): Value = {1} {5}; High Threshold = {2} {5}; Low Threshold = {3} {5}'.format(name,reading,highlimit,lowlimit,current_check,current_unit)
+                    logging.debug('{0}\t{2}\t{1}'.format(hostname,msg,current_check.upper()))
+                    sendToPagerDuty("resolve","snmp/{2}/{0}/{1}".format(hostname,index,current_check.lower()),"No {0} issues detected".format(current_check),msg)
         #Power
         elif type == "8":
             current_check = "Power"
@@ -623,9 +895,10 @@ def querySensors(device,hostname):
                 logging.warning('{0}\t{2}\t{1}'.format(hostname,msg,current_check.upper()))
             else:
                 p_ok += 1
-                msg = 'OK for {4} Sensor({0}): Value = {1} {5}; High Threshold = {2} {5}; Low Threshold = {3} {5}'.format(name,reading,highlimit,lowlimit,current_check,current_unit)
-                logging.debug('{0}\t{2}\t{1}'.format(hostname,msg,current_check.upper()))
-                sendToPagerDuty("resolve","snmp/{2}/{0}/{1}".format(hostname,index,current_check.lower()),"No {0} issues detected".format(current_check),msg)
+                if debug_enabled or hostHasAlarms(hostname):
+                    msg = 'OK for {4} Sensor({0}): Value = {1} {5}; High Threshold = {2} {5}; Low Threshold = {3} {5}'.format(name,reading,highlimit,lowlimit,current_check,current_unit)
+                    logging.debug('{0}\t{2}\t{1}'.format(hostname,msg,current_check.upper()))
+                    sendToPagerDuty("resolve","snmp/{2}/{0}/{1}".format(hostname,index,current_check.lower()),"No {0} issues detected".format(current_check),msg)
         else:
             o_total+=1
             logging.warning('Other Sensor({0}): Type = {4}; Value = {1}; High Threshold = {2}; Low Threshold = {3}'.format(name,reading,highlimit,lowlimit,type))
@@ -634,62 +907,10 @@ def querySensors(device,hostname):
     return t_total,t_ok,t_failed,p_total,p_ok,p_failed,f_total,f_ok,f_failed,o_total,o_ok,o_failed,s_total,s_ok,s_failed
 
 def querySmMemory(device,hostname):
-    total,ok,failed = 0,0,0
-    current_check = "Memory"
-    for index in device.memTag:
-        total += 1
-        allowed_status = ["0"]
-        memTag = device.memTag[index]
-        memDescription = device.memDescription[index]
-        memDeviceStatus = device.memDeviceStatus[index]
-        memLabeledBank = device.memLabeledBank[index]
-        memDeviceLocator = device.memDeviceLocator[index]
-        memManufacturer = device.memManufacturer[index]
-        memPartNumber = device.memPartNumber[index]
-        memSerialNumber = device.memSerialNumber[index]
-        memCapacity = device.memCapacity[index]
-        if str(memDeviceStatus) not in allowed_status:
-            failed += 1
-            msg = 'Error for {0}: Status = {1}; Location = {2}; Manufacturer = {3}; PartNum = {4}; Serial = {5}; Capacity = {6}'.format(current_check, memDeviceStatus, memLabeledBank, memManufacturer, memPartNumber, memSerialNumber, memCapacity)
-            incident = sendToPagerDuty("trigger","snmp/{2}/{0}/{1}".format(hostname,index,current_check.lower()),"{1} issue detected on {0}".format(hostname,current_check),msg)
-            logging.warning('{0}\t{2}\t{1}'.format(hostname,msg,current_check.upper()))
-        else:
-            ok += 1
-            msg = 'OK for {0}: Status = {1}; Location = {2}; Manufacturer = {3}; PartNum = {4}; Serial = {5}; Capacity = {6}'.format(current_check, memDeviceStatus, memLabeledBank, memManufacturer, memPartNumber, memSerialNumber, memCapacity)
-            logging.debug('{0}\t{2}\t{1}'.format(hostname,msg,current_check.upper()))
-            sendToPagerDuty("resolve","snmp/{2}/{0}/{1}".format(hostname,index,current_check.lower()),"No {0} issues detected".format(current_check),msg)
-    return total,ok,failed
+    return runRule("querySmMemory",device,hostname)
 
 def querySmCPU(device,hostname):
-    total,ok,failed = 0,0,0
-    current_check = "CPU"
-    for index in device.cpuIndex:
-        total += 1
-        allowed_status = ["0"]
-        cpuIndex = device.cpuIndex[index]
-        cpuName = device.cpuName[index]
-        cpuDescription = device.cpuDescription[index]
-        cpuManufacturer = device.cpuManufacturer[index]
-        cpuDeviceStatus = device.cpuDeviceStatus[index]
-        cpuMaxSpeed = device.cpuMaxSpeed[index]
-        cpuCurrentSpeed = device.cpuCurrentSpeed[index]
-        cpuCoreEnabled = device.cpuCoreEnabled[index]
-        cpuCoreCount = device.cpuCoreCount[index]
-        cpuThreadCount = device.cpuThreadCount[index]
-        cpuSocketDesignation = device.cpuSocketDesignation[index]
-        cpuDeviceVersion = device.cpuDeviceVersion[index]
-        cpuDeviceID = device.cpuDeviceID[index]
-        if str(cpuDeviceStatus) not in allowed_status:
-            failed += 1
-            msg = 'Error for {0}: Status = {1}; Location = {2}; Name = {3}'.format(current_check, cpuDeviceStatus, cpuName, cpuSocketDesignation)
-            incident = sendToPagerDuty("trigger","snmp/{2}/{0}/{1}".format(hostname,index,current_check.lower()),"{1} issue detected on {0}".format(hostname,current_check),msg)
-            logging.warning('{0}\t{2}\t{1}'.format(hostname,msg,current_check.upper()))
-        else:
-            ok += 1
-            msg = 'OK for {0}: Status = {1}; Location = {2}; Name = {3}'.format(current_check, cpuDeviceStatus, cpuName, cpuSocketDesignation)
-            logging.debug('{0}\t{2}\t{1}'.format(hostname,msg,current_check.upper()))
-            sendToPagerDuty("resolve","snmp/{2}/{0}/{1}".format(hostname,index,current_check.lower()),"No {0} issues detected".format(current_check),msg)
-    return total,ok,failed
+    return runRule("querySmCPU",device,hostname)
 
 def querySmRaid(device,hostname):
     # Check all disk related metrics. Consolidate all errors into a single PD alarm per server.
@@ -717,8 +938,9 @@ def querySmRaid(device,hostname):
             logging.warning('{0}\t{2}\t{1}'.format(hostname,msg,current_check.upper()))
         else:
             a_ok += 1
-            msg = 'OK for {0}: Status = {1}; Msg = {2}; Model = {3};'.format(current_check, raidStatus, raidMsg, raidProductName)
-            logging.debug('{0}\t{2}\t{1}'.format(hostname,msg,current_check.upper()))
+            if debug_enabled:
+                msg = 'OK for {0}: Status = {1}; Msg = {2}; Model = {3};'.format(current_check, raidStatus, raidMsg, raidProductName)
+                logging.debug('{0}\t{2}\t{1}'.format(hostname,msg,current_check.upper()))
 
     current_check = "PhysicalDisk"
     for index in device.raidPDIndex:
@@ -741,8 +963,9 @@ def querySmRaid(device,hostname):
             logging.warning('{0}\t{2}\t{1}'.format(hostname,msg,current_check.upper()))
         else:
             p_ok += 1
-            msg = 'OK for {0}: Status = {1}; Msg = {2}; MediaError = {3}; OtherError = {4}; PredictiveFail = {5}; Type = {6}; Info = {7}'.format(current_check, physDiskStatus, physDiskMessage, physDiskMediaError, physDiskOtherError, physDiskPredFail, physDiskType, physDiskInfo)
-            logging.debug('{0}\t{2}\t{1}'.format(hostname,msg,current_check.upper()))
+            if debug_enabled:
+                msg = 'OK for {0}: Status = {1}; Msg = {2}; MediaError = {3}; OtherError = {4}; PredictiveFail = {5}; Type = {6}; Info = {7}'.format(current_check, physDiskStatus, physDiskMessage, physDiskMediaError, physDiskOtherError, physDiskPredFail, physDiskType, physDiskInfo)
+                logging.debug('{0}\t{2}\t{1}'.format(hostname,msg,current_check.upper()))
       
     current_check = "VirtualDisk"
     for index in device.raidVDId:
@@ -762,8 +985,9 @@ def querySmRaid(device,hostname):
             logging.warning('{0}\t{2}\t{1}'.format(hostname,msg,current_check.upper()))
         else:
             v_ok += 1
-            msg = 'OK for {0}: Status = {1}; Msg = {2}; State = {3}; Level = {4}; Size = {5}; NumDrives = {6}'.format(current_check, virtDiskStatus, virtDiskMsg, virtDiskState, virtDiskRaidLevel, virtDiskSize, virtDiskNumDrives)
-            logging.debug('{0}\t{2}\t{1}'.format(hostname,msg,current_check.upper()))    
+            if debug_enabled:
+                msg = 'OK for {0}: Status = {1}; Msg = {2}; State = {3}; Level = {4}; Size = {5}; NumDrives = {6}'.format(current_check, virtDiskStatus, virtDiskMsg, virtDiskState, virtDiskRaidLevel, virtDiskSize, virtDiskNumDrives)
+                logging.debug('{0}\t{2}\t{1}'.format(hostname,msg,current_check.upper()))    
 
     current_check = "ArrayBattery"
     for index in device.raidBBUIndex:
@@ -779,8 +1003,9 @@ def querySmRaid(device,hostname):
             logging.warning('{0}\t{2}\t{1}'.format(hostname,msg,current_check.upper()))
         else:
             b_ok += 1
-            msg = 'OK for {0}: Status = {1}; Msg = {2}; State = {3};'.format(current_check, bbuAllInOneStatus, bbuMsg, bbuStatus)
-            logging.debug('{0}\t{2}\t{1}'.format(hostname,msg,current_check.upper()))
+            if debug_enabled:
+                msg = 'OK for {0}: Status = {1}; Msg = {2}; State = {3};'.format(current_check, bbuAllInOneStatus, bbuMsg, bbuStatus)
+                logging.debug('{0}\t{2}\t{1}'.format(hostname,msg,current_check.upper()))
 
     # if error_msg is not empty: send alarm...
     if error_msg != "":
@@ -791,12 +1016,208 @@ def querySmRaid(device,hostname):
     return a_total, a_ok, a_failed, p_total, p_ok, p_failed, v_total, v_ok, v_failed, b_total, b_ok, b_failed
 
 
+# Returns the community, timeout and retry values to use for a server. Used by the query*Server functions and the
+# asynchronous prefetch so both talk to the server the same way.
+def hostSettings(kind,hostname,comm):
+    if kind == "HP":
+        #Set default timeout and retry values
+        timeout_value = 5
+        retries_value = 3
+
+        #Adjust Community String as needed
+        if hostname in ['<Server not in Salt>','<Server not in Salt>']: comm = '<Your comment>'
+    else:
+        #Set default timeout and retry values
+        timeout_value = 15
+        retries_value = 2
+
+        #Apply any custom timeout and retry values
+        if "<Server name>" in hostname.upper():
+            timeout_value = 30
+            retries_value = 3
+
+    #Hosts with enough response time history get a timeout and retry count based on it instead
+    timeout_value,retries_value = host_timing.adaptSettings(hostname,timeout_value,retries_value)
+    return comm,timeout_value,retries_value
+
+# Resolves the prefetch_objects for a server type into OIDs. The MIB index must be loaded first.
+def getPrefetchPlan(kind):
+    if kind not in prefetch_plans:
+        scalars,columns = prefetch_objects[kind]
+        probes = []
+        for name,index in scalars:
+            if index is None:
+                probes.append(mib_cache.resolveOid(name) + (0,))
+            else:
+                probes.append(mib_cache.resolveOid(name) + (index,))
+        prefetch_plans[kind] = (probes,[mib_cache.resolveOid(name) for name in columns])
+    return prefetch_plans[kind]
+
+# Probes every server at once with a single GET. Returns a dictionary of hostname -> error for the servers that did not answer.
+def probeServers(servers,window):
+    targets = []
+    for kind,hostname,comm,ver in servers:
+        comm,timeout_value,retries_value = hostSettings(kind,hostname,comm)
+        targets.append((hostname,comm,ver,timeout_value,retries_value))
+    start = time.time()
+    results = snmp_engine.probeHosts(targets,window)
+    unreachable = dict([(hostname,error) for hostname,error in results.items() if error is not None])
+    logging.info('POLLER\tProbed {0} servers in {1} sec. Not responding: {2}'.format(len(targets),(time.time()-start),len(unreachable)))
+    return unreachable
+
+# Logs a failed connection and sends the snmp/connect alarm (only during the day)
+def connectFailed(hostname,inst):
+    msg = 'Exception occurred while connecting to {0}. Exception = "{1}"'.format(hostname,inst)
+    logging.warning('{0}\tERROR\t{1}'.format(hostname,msg))
+    t = datetime.datetime.now().timetuple()
+    #only generate alarm during the day
+    if (t[3]>=7) and (t[3]<=19):
+        sendToPagerDuty("trigger","snmp/connect/{0}".format(hostname),"Unable to query SNMP on {0}".format(hostname),msg)
+
+# Collects the SNMP data for a list of servers with the asynchronous engine. Returns a dictionary of hostname -> snapshot.
+def prefetchServers(servers,window):
+    targets = []
+    for kind,hostname,comm,ver in servers:
+        comm,timeout_value,retries_value = hostSettings(kind,hostname,comm)
+        probes,columns = getPrefetchPlan(kind)
+        targets.append((hostname,comm,ver,timeout_value,retries_value,probes,columns))
+    timeouts = dict([(target[0],target[3]) for target in targets])
+    start = time.time()
+    snapshots = snmp_engine.prefetch(targets,window)
+    for hostname,snapshot in snapshots.items():
+        for rtt in snapshot.rtts:
+            host_timing.recordResponse(hostname,rtt,timeouts[hostname])
+        for rtt in snapshot.walk_rtts:
+            host_timing.recordWalk(hostname,rtt,timeouts[hostname])
+        if snapshot.error is not None:
+            host_timing.recordTimeout(hostname)
+    failed = len([x for x in snapshots.values() if x.error is not None])
+    requests = sum([x.requests for x in snapshots.values()])
+    logging.info('POLLER\tPrefetched SNMP data for {0} servers in {1} sec. Requests: {2}; Not responding: {3}'.format(len(targets),(time.time()-start),requests,failed))
+    return snapshots
+
+def loadRollupState(path):
+    global rollup_state
+    try:
+        with open(path,'r') as f:
+            rollup_state = json.load(f)
+    except Exception as inst:
+        logging.info('ROLLUP\tUnable to read rollup state from {0}. All subsystems will be checked; Exception = "{1}"'.format(path,inst))
+        rollup_state = {}
+
+def saveRollupState(path):
+    with rollup_lock:
+        data = json.dumps(rollup_state)
+    with open(path + '.tmp','w') as f:
+        f.write(data)
+    os.rename(path + '.tmp',path)
+
+# Reads the subsystem rollup conditions of an HP server in one GET. A subsystem is skipped when its rollup is ok, was
+# also ok last time, it was last checked less than ROLLUP_MAX_AGE ago, and the host has no open incidents of its types.
+# Returns a dictionary of query* function name -> counts from the last run, for every function that can be skipped.
+def getRollupSkips(device,hostname):
+    names = sorted(rollup_subsystems)
+    try:
+        conditions = [int(x) for x in getScalars(device,names)]
+    except Exception:
+        #At least one of the rollups is missing. Read them one at a time; missing ones are never skipped.
+        conditions = []
+        for name in names:
+            try:
+                conditions.append(int(getScalars(device,[name])[0]))
+            except Exception:
+                conditions.append(None)
+
+    now = time.time()
+    open_types = set([str(key).split('/')[1] for key in getHostAlarms(hostname) if str(key).count('/') >= 2])
+    skips = {}
+    with rollup_lock:
+        state = rollup_state.setdefault(hostname,{})
+        for name,condition in zip(names,conditions):
+            functions,types = rollup_subsystems[name]
+            last = state.get(name,{})
+            counts = last.get("counts",{})
+            if (condition == 2) and (last.get("condition") == 2) and (now - last.get("checked",0) < ROLLUP_MAX_AGE) and \
+               (not open_types.intersection(types)) and (len([f for f in functions if f in counts]) == len(functions)):
+                for f in functions:
+                    skips[f] = counts[f]
+            else:
+                #Checked this time. The counts are filled in by runQuery as each function completes.
+                state[name] = {"condition": condition, "checked": now, "counts": {}}
+    if skips:
+        logging.info('{0}\tROLLUP\tHealthy and unchanged, not checked: {1}'.format(hostname,','.join(sorted(skips))))
+    return skips
+
+# Runs a query* function, unless --rollup found its subsystem healthy and unchanged. In that case the counts from the
+# last run are returned instead.
+def runQuery(function,device,hostname,skips):
+    name = function.__name__
+    if name in skips:
+        return tuple(skips[name])
+    result = function(device,hostname)
+    if rollup_enabled:
+        with rollup_lock:
+            for subsystem,(functions,types) in rollup_subsystems.items():
+                if name in functions:
+                    rollup_state.setdefault(hostname,{}).setdefault(subsystem,{}).setdefault("counts",{})[name] = list(result)
+    return result
+
+#Components counted for each server type, in the order of the STATS log lines. Every component has a
+#(Checked,OK,Error) counter.
+result_components = {
+    "HP": ["temp","fan","power","memory","cpu","disk","controller","accelerator","nic"],
+    "SM": ["temp","power","fan","other","status","memory","cpu","raid_adapter","phys_disk","virt_disk","raid_battery"],
+}
+result_offsets = dict([(kind,dict([(name,i*3) for i,name in enumerate(names)])) for kind,names in result_components.items()])
+
+# Component counts for one server, kept in a flat array of (Checked,OK,Error) triples so a record is small and
+# can be passed back from a worker as is.
+class ServerResults(object):
+    __slots__ = ("kind","counts")
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.counts = array.array('l',[0]) * (len(result_components[kind]) * 3)
+
+    # Stores the counts returned by a query* function, starting at the given component. Functions that check
+    # several components (queryDrives, querySensors, querySmRaid) return one triple per component, in order.
+    def set(self, component, values):
+        start = result_offsets[self.kind][component]
+        if (len(values) % 3 != 0) or (start + len(values) > len(self.counts)):
+            raise ValueError('{0} counts do not fit at component "{1}"'.format(len(values),component))
+        self.counts[start:start+len(values)] = array.array('l',values)
+
+    # Returns the (Checked,OK,Error) counts of a component
+    def get(self, component):
+        start = result_offsets[self.kind][component]
+        return tuple(self.counts[start:start+3])
+
+    def total(self):
+        return sum(self.counts)
+
+# Totals of the ServerResults for one server type across the fleet
+class FleetResults(object):
+    __slots__ = ("kind","servers","counts")
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.servers = 0
+        self.counts = array.array('l',[0]) * (len(result_components[kind]) * 3)
+
+    def add(self, results):
+        self.servers += 1
+        self.counts = array.array('l',map(operator.add,self.counts,results.counts))
+
+    def get(self, component):
+        start = result_offsets[self.kind][component]
+        return tuple(self.counts[start:start+3])
+
 # The main monitoring function for HP servers. It verifies it can connect, makes sure the HP agent is working correctly, 
 # then calls the relevant query* functions from above. It returns a count of all components it queried and their 
 # statuses. 
-def queryHPServer(hostname,comm,ver):
-    #Create results list
-    serverResults = [0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0]
+def queryHPServer(hostname,comm,ver,snapshot=None):
+    #Create results record
+    serverResults = ServerResults("HP")
 
     """
     #Ping device
@@ -811,33 +1232,32 @@ def queryHPServer(hostname,comm,ver):
         logging.warning('{0}\tERROR\t{1}'.format(hostname,msg))
     """
 
-    #Set default timeout and retry values
-    timeout_value = 5
-    retries_value = 3
+    #Set timeout, retry and community values
+    comm,timeout_value,retries_value = hostSettings("HP",hostname,comm)
 
-    #Apply any custom timeout and retry values
-
-    #Adjust Community String as needed
-    if hostname in ['<Server not in Salt>','<Server not in Salt>']: comm = '<Your comment>'
-
-    #Connect to device
+    #Connect to device. sysName and the HP agent probe are requested together; if either one is missing from the agent,
+    #they are checked one at a time below so the right alarm is sent.
+    agent_checked = False
     try:
         device = M(host=hostname,community=comm,version=ver,timeout=timeout_value,retries=retries_value)
-        device_name =  device.sysName #to make sure we actually connected
+        device._session = host_timing.TimingSession(device._session,hostname,timeout_value)
+        if snapshot is not None:
+            device._session = snmp_engine.SnapshotSession(device._session,snapshot)
+        try:
+            device_name,device_mib = getScalars(device,["sysName","cpqSeMibRevMajor"])
+            agent_checked = True
+        except (snmp.SNMPNoSuchObject,snmp.SNMPNoSuchInstance,snmp.SNMPNoSuchName):
+            device_name =  device.sysName #to make sure we actually connected
         msg = 'Successfully connected to {0}.'.format(hostname)
         sendToPagerDuty("resolve","snmp/connect/{0}".format(hostname),"SNMP is responding on {0}".format(hostname),msg)
     except Exception as inst:
-        msg = 'Exception occurred while connecting to {0}. Exception = "{1}"'.format(hostname,inst)
-        logging.warning('{0}\tERROR\t{1}'.format(hostname,msg))
-        t = datetime.datetime.now().timetuple()
-        #only generate alarm during the day
-        if (t[3]>=7) and (t[3]<=19):
-            incident = sendToPagerDuty("trigger","snmp/connect/{0}".format(hostname),"Unable to query SNMP on {0}".format(hostname),msg)
-        return [0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0]
+        connectFailed(hostname,inst)
+        return ServerResults("HP")
 
     #Make sure HP SNMP agent is responding
     try:
-        device_mib = device.cpqSeMibRevMajor
+        if not agent_checked:
+            device_mib = device.cpqSeMibRevMajor
         msg = 'Successfully queried HP SNMP agent on {0}.'.format(hostname)
         sendToPagerDuty("resolve","snmp/hp_agent/{0}".format(hostname),"HP SNMP agent is responding on {0}".format(hostname),msg)
     except Exception as inst:
@@ -847,54 +1267,63 @@ def queryHPServer(hostname,comm,ver):
         t = datetime.datetime.now().timetuple()
         if (t[3]>=7) and (t[3]<=19):
             incident = sendToPagerDuty("trigger","snmp/hp_agent/{0}".format(hostname),"HP SNMP agent is not responding on {0}".format(hostname),msg)
-        return [0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0]
+        return ServerResults("HP")
+
+    #With --rollup, read the subsystem rollup conditions first so healthy, unchanged subsystems can be skipped
+    skips = {}
+    if rollup_enabled:
+        try:
+            skips = getRollupSkips(device,hostname)
+        except Exception as inst:
+            msg = 'Exception occurred while reading rollup conditions. All subsystems will be checked; Exception = "{0}"'.format(inst)
+            logging.warning('{0}\tERROR\t{1}'.format(hostname,msg))
 
-    #Perform checks, load results into list
+    #Perform checks, load results into the record
     next_check = "queryTemp"
     try:
-        serverResults[0:2] = queryTemp(device,hostname)
+        serverResults.set("temp",runQuery(queryTemp,device,hostname,skips))
     except Exception as inst:
         msg = 'Exception occurred while running "{0}"; Exception = "{1}"'.format(next_check,inst)
         logging.warning('{0}	ERROR	{1}'.format(hostname,msg))
 
     next_check = "queryFans"
     try:
-        serverResults[3:5] = queryFans(device,hostname)
+        serverResults.set("fan",runQuery(queryFans,device,hostname,skips))
     except Exception as inst:
         msg = 'Exception occurred while running "{0}"; Exception = "{1}"'.format(next_check,inst)
         logging.warning('{0}	ERROR	{1}'.format(hostname,msg))
 
     next_check = "queryPower"
     try:
-        serverResults[6:8] = queryPower(device,hostname)
+        serverResults.set("power",runQuery(queryPower,device,hostname,skips))
     except Exception as inst:
         msg = 'Exception occurred while running "{0}"; Exception = "{1}"'.format(next_check,inst)
         logging.warning('{0}	ERROR	{1}'.format(hostname,msg))
 
     next_check = "queryMemory"
     try:
-        serverResults[9:11] = queryMemory(device,hostname)
+        serverResults.set("memory",runQuery(queryMemory,device,hostname,skips))
     except Exception as inst:
         msg = 'Exception occurred while running "{0}"; Exception = "{1}"'.format(next_check,inst)
         logging.warning('{0}	ERROR	{1}'.format(hostname,msg))
 
     next_check = "queryCPU"
     try:
-        serverResults[12:14] = queryCPU(device,hostname)
+        serverResults.set("cpu",runQuery(queryCPU,device,hostname,skips))
     except Exception as inst:
         msg = 'Exception occurred while running "{0}"; Exception = "{1}"'.format(next_check,inst)
         logging.warning('{0}	ERROR	{1}'.format(hostname,msg))
 
     next_check = "queryDrives"
     try:
-        serverResults[15:23] = queryDrives(device,hostname)
+        serverResults.set("disk",runQuery(queryDrives,device,hostname,skips))
     except Exception as inst:
         msg = 'Exception occurred while running "{0}"; Exception = "{1}"'.format(next_check,inst)
         logging.warning('{0}	ERROR	{1}'.format(hostname,msg))
 
     next_check = "queryNICs"
     try:
-        serverResults[24:26] = queryNics(device,hostname)
+        serverResults.set("nic",runQuery(queryNics,device,hostname,skips))
     except Exception as inst:
         msg = 'Exception occurred while running "{0}"; Exception = "{1}"'.format(next_check,inst)
         logging.warning('{0}    ERROR   {1}'.format(hostname,msg))
@@ -902,7 +1331,7 @@ def queryHPServer(hostname,comm,ver):
     #Generate an alarm if script could not find anything to monitor
     next_check = "resultsCheck"
     try:
-        if sum(serverResults) == 0:
+        if serverResults.total() == 0:
             msg = 'Did not find any hardware components to monitor'
             logging.warning('{0}\tERROR\t{1}'.format(hostname,msg))
             incident = sendToPagerDuty("trigger","snmp/components/{0}".format(hostname),"Unable to monitor any values on {0}. Make sure snmdpd and the HP SNMP agent are working correctly.".format(hostname),msg)
@@ -911,35 +1340,27 @@ def queryHPServer(hostname,comm,ver):
         logging.warning('{0}    ERROR   {1}'.format(hostname,msg))
 
     #Print and return stats
-    logging.info('{0}\tSTATS\t(Checked,OK,Error) || Temp({1},{2},{3}) || Fan({4},{5},{6}) || PSU({7},{8},{9}) || Mem({10},{11},{12}) || CPU({13},{14},{15}) || Disk({16},{17},{18}) || CTRLR({19},{20},{21}) || Accel({22},{23},{24}) || NIC({25},{26},{27})'.format(hostname,*serverResults))
+    logging.info('{0}\tSTATS\t(Checked,OK,Error) || Temp({1},{2},{3}) || Fan({4},{5},{6}) || PSU({7},{8},{9}) || Mem({10},{11},{12}) || CPU({13},{14},{15}) || Disk({16},{17},{18}) || CTRLR({19},{20},{21}) || Accel({22},{23},{24}) || NIC({25},{26},{27})'.format(hostname,*serverResults.counts))
     #print '{0} complete; Checks: {2}; Stats: {1}'.format(hostname,serverResults,(sum(serverResults)/2))
     return serverResults
 
 # Main monitoring function for SuperMicro servers. Same logic as queryHPServer()
-def querySmServer(hostname,comm,ver):
-    #Set default timeout and retry values
-    timeout_value = 15
-    retries_value = 2
-
-    #Apply any custom timeout and retry values
-    if "<Server name>" in hostname.upper():
-        timeout_value = 30
-        retries_value = 3
+def querySmServer(hostname,comm,ver,snapshot=None):
+    #Set timeout, retry and community values
+    comm,timeout_value,retries_value = hostSettings("SM",hostname,comm)
 
     #Connect to device
     try:
         device = M(host=hostname,community=comm,version=ver,timeout=timeout_value,retries=retries_value)
+        device._session = host_timing.TimingSession(device._session,hostname,timeout_value)
+        if snapshot is not None:
+            device._session = snmp_engine.SnapshotSession(device._session,snapshot)
         desc = device.sysDescr
         msg = 'Successfully connected to {0}.'.format(hostname)
         sendToPagerDuty("resolve","snmp/connect/{0}".format(hostname),"SNMP agent is responding on {0}".format(hostname),msg)
     except Exception as inst:
-        msg = 'Exception occurred while connecting to {0}. Exception = "{1}"'.format(hostname,inst)
-        logging.warning('{0}\tERROR\t{1}'.format(hostname,inst))
-        t = datetime.datetime.now().timetuple()
-        #only generate alarm during the day
-        if (t[3]>=7) and (t[3]<=19):
-            incident = sendToPagerDuty("trigger","snmp/connect/{0}".format(hostname),"Unable to query SNMP on {0}".format(hostname),msg)
-        return [0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0]
+        connectFailed(hostname,inst)
+        return ServerResults("SM")
 
     #Make sure SuperMicro SNMP agent is responding
     try:
@@ -953,35 +1374,35 @@ def querySmServer(hostname,comm,ver):
         t = datetime.datetime.now().timetuple()
         if (t[3]>=7) and (t[3]<=19):
             incident = sendToPagerDuty("trigger","snmp/sm_agent/{0}".format(hostname),"SuperMicro SNMP agent is not responding on {0}".format(hostname),msg)
-        return [0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0]
+        return ServerResults("SM")
 
-    SmServerResults = [0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0]
+    SmServerResults = ServerResults("SM")
     
-    #Perform checks, load results into list
+    #Perform checks, load results into the record
     next_check = "querySensors"
     try:
-        SmServerResults[0:15] = querySensors(device,hostname)
+        SmServerResults.set("temp",querySensors(device,hostname))
     except Exception as inst:
         msg = 'Exception occurred while running "{0}"; Exception = "{1}"'.format(next_check,inst)
         logging.warning('{0}\tERROR\t{1}'.format(hostname,msg))
     
     next_check = "querySmMemory"
     try:
-        SmServerResults[15:18] = querySmMemory(device,hostname)
+        SmServerResults.set("memory",querySmMemory(device,hostname))
     except Exception as inst:
         msg = 'Exception occurred while running "{0}"; Exception = "{1}"'.format(next_check,inst)
         logging.warning('{0}\tERROR\t{1}'.format(hostname,msg))
 
     next_check = "querySmCPU"
     try:
-        SmServerResults[18:21] = querySmCPU(device,hostname)
+        SmServerResults.set("cpu",querySmCPU(device,hostname))
     except Exception as inst:
         msg = 'Exception occurred while running "{0}"; Exception = "{1}"'.format(next_check,inst)
         logging.warning('{0}\tERROR\t{1}'.format(hostname,msg))
     
     next_check = "queryRaid"
     try:
-        SmServerResults[21:33] = querySmRaid(device,hostname)
+        SmServerResults.set("raid_adapter",querySmRaid(device,hostname))
     except Exception as inst:
          msg = 'Exception occurred while running "{0}"; Exception = "{1}"'.format(next_check,inst)
          logging.warning('{0}\tERROR\t{1}'.format(hostname,msg))
@@ -989,7 +1410,7 @@ def querySmServer(hostname,comm,ver):
     #Generate an alarm if script could not find anything to monitor
     next_check = "resultsCheck"
     try:
-        if sum(SmServerResults) == 0:
+        if SmServerResults.total() == 0:
             msg = 'Did not find any hardware components to monitor'
             logging.warning('{0}\tERROR\t{1}'.format(hostname,msg))
             incident = sendToPagerDuty("trigger","snmp/components/{0}".format(hostname),"Unable to monitor any values on {0}. Make sure snmpd and the SuperMicro SNMP agent are working correctly.".format(hostname),msg)
@@ -997,50 +1418,51 @@ def querySmServer(hostname,comm,ver):
         msg = 'Exception occurred while running "{0}"; Exception = "{1}"'.format(next_check,inst)
         logging.warning('{0}\tERROR\t{1}'.format(hostname,msg))
 
-    logging.info('{0}\tSTATS\t(Checked,OK,Error) || Temp({1},{2},{3}) || PSU({4},{5},{6}) || Fan({7},{8},{9}) || Other({10},{11},{12}) || Status({13},{14},{15}) || Memory({16},{17},{18}) || CPU({19},{20},{21}) || RaidAdap({22},{23},{24}) || PhysDisk ({25},{26},{27}) || VirtDisk ({28},{29},{30}) || RaidBattery ({31},{32},{33})'.format(hostname,*SmServerResults))
+    logging.info('{0}\tSTATS\t(Checked,OK,Error) || Temp({1},{2},{3}) || PSU({4},{5},{6}) || Fan({7},{8},{9}) || Other({10},{11},{12}) || Status({13},{14},{15}) || Memory({16},{17},{18}) || CPU({19},{20},{21}) || RaidAdap({22},{23},{24}) || PhysDisk ({25},{26},{27}) || VirtDisk ({28},{29},{30}) || RaidBattery ({31},{32},{33})'.format(hostname,*SmServerResults.counts))
 
     return SmServerResults
 
-# Checks exclusions, loads mibs, checks PD for open incidents, gets device list from Salt, 
-# loops through devices and calls appropriate function based on HP vs SuperMicro.
-def main():
-    logging.info('***************************************************************************')
-    logging.info('Starting Script')
-    hpCount=0
-    smCount=0
-    totalHpStats = [0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0]
-    totalSmStats = [0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0]
+# Parses the MIBs of every server type in the list. libsmi is not thread safe, so this runs on the main thread before
+# any server is queried; the worker threads then only ever look symbols up.
+def loadServerMibs(servers):
+    for kind in set([server[0] for server in servers]):
+        mib_cache.requireFiles(server_mib_files[kind])
+
+# Queries a single server from the server list. Used directly for serial runs and by the worker pool when
+# running with --workers. The snapshot is None unless the server was prefetched. Returns the server type, hostname, ServerResults and number of seconds it took.
+def pollServer(server):
+    kind,hostname,comm,ver,snapshot,error = server
+    start = time.time()
+    if error is not None:
+        #Did not answer the probe
+        connectFailed(hostname,error)
+        stats = ServerResults(kind)
+    elif kind == "HP":
+        stats = queryHPServer(hostname,comm,ver,snapshot)
+    else:
+        stats = querySmServer(hostname,comm,ver,snapshot)
+    return kind,hostname,stats,(time.time()-start)
 
-    #Prepare stats file
+#Populate exclusions from ZooKeeper
+def refreshExclusions():
     touch(docroot + 'snmp_exclusions')
-    
-    #Populate exclusions from ZooKeeper
     logging.info('ZOOKEEPER\tQuerying ZooKeeper for exclusion list.')
     try:
         populateExclusions('{{ salt['pillar.get']('globals:pillar_branch') }}')
     except Exception as inst:
         msg = 'Exception occurred while querying ZooKeeper. Using existing exclusions file; Exception = "{0}"'.format(inst)
         logging.warning('ZOOKEEPER\tERROR\r{0}'.format(msg))
-    
-    #Load required MIBs
-    load(docroot + "mibs/SNMPv2-MIB")
-    load(docroot + "mibs/CPQHOST.MIB")
-    load(docroot + "mibs/cpqsinfo.mib")
-    load(docroot + "mibs/CPQHLTH.MIB")
-    load(docroot + "mibs/cpqida.mib")
-    load(docroot + "mibs/cpqstdeq.mib")
-    load(docroot + "mibs/cpqnic.mib")
-    load(docroot + "mibs/SUPERMICRO-SMI.my")
-    load(docroot + "mibs/spot-ssm.my")
-    load(docroot + "mibs/SUPERMICRO-HEALTH-MIB.my")
-
-    #Check PagerDuty for open incidents
+
+#Check PagerDuty for open incidents
+def refreshAlarms():
     try:
         getCurrentAlarms()
     except Exception as inst:
         msg = 'Exception occurred while querying PagerDuty for open incidents; Exception = "{0}"'.format(inst)
         logging.warning('PAGER\tERROR\r{0}'.format(msg))
 
+#Query Salt for the server list and build the list of servers to query
+def refreshServers():
     #Exclude invalid hosts
     invalid_hosts = ['localhost','host']
 
@@ -1048,9 +1470,7 @@ def main():
     comm = 'public'
     ver = 2
 
-    script_start = time.time()
     logging.info('SALT\tQuerying Salt for server list.')
-    
     try:
         querySalt('{{ salt['pillar.get']('globals:pillar_branch') }}')
         #querySalt('production')
@@ -1059,31 +1479,190 @@ def main():
         msg = 'Exception occurred while querying Salt. Using existing server file; Exception = "{0}"'.format(inst)
         logging.warning('SALT\t\tERROR\t{0}'.format(msg))
 
-    serverFile = open(docroot+'snmp_servers','r')
-    for line in serverFile:
-        details = line.split(',')
-        hostname = details[0]
-        manufacturer = details[1]
-        if (manufacturer in ["HP","Hewlett-Packard"]) and (hostname not in invalid_hosts):
-            start = time.time()
-            hpCount+=1
-            hpStats = queryHPServer(hostname,comm,ver)
-            end = time.time()
-            print 'HP - {0} - {1} - {2} sec. {3} total sec.'.format(hpCount,hostname,(end-start),(end-script_start))
-            for i in range(len(totalHpStats)):
-                totalHpStats[i]+=hpStats[i]
-        elif manufacturer == "Supermicro":
-            start = time.time()
-            smCount+=1
-            smStats = querySmServer(hostname,comm,ver)
-            end = time.time()
-            print 'SM - {0} - {1} - {2} sec. {3} total sec.'.format(smCount,hostname,(end-start),(end-script_start))
-            for i in range(len(totalSmStats)):
-                totalSmStats[i]+=smStats[i]
-
-
-    logging.info('TOTAL\tSTATS\tHP\t(Checked,OK,Error) || Temp({1},{2},{3}) || Fan({4},{5},{6}) || PSU({7},{8},{9}) || Mem({10},{11},{12}) || CPU({13},{14},{15}) || Disk({16},{17},{18}) || CTRLR({19},{20},{21}) || Accel({22},{23},{24}) || NIC({25},{26},{27}) || Servers({0})'.format(hpCount,*totalHpStats))
-    logging.info('TOTAL\tSTATS\tSM\t(Checked,OK,Error) || Temp({1},{2},{3}) || PSU({4},{5},{6}) || Fan({7},{8},{9}) || Other({10},{11},{12}) || Status({13},{14},{15}) || Memory({16},{17},{18}) || CPU({19},{20},{21}) || RaidAdap({22},{23},{24}) || PhysDisk ({25},{26},{27}) || VirtDisk ({28},{29},{30}) || RaidBattery ({31},{32},{33}) || Servers({0})'.format(smCount,*totalSmStats))
+    servers = []
+    with open(docroot+'snmp_servers','rb') as serverFile:
+        for details in csv.reader(serverFile):
+            if len(details) < 2:
+                #Blank or incomplete line
+                continue
+            hostname = details[0]
+            manufacturer = details[1]
+            if (manufacturer in ["HP","Hewlett-Packard"]) and (hostname not in invalid_hosts):
+                servers.append(("HP",hostname,comm,ver))
+            elif manufacturer == "Supermicro":
+                servers.append(("SM",hostname,comm,ver))
+    return servers
+
+#Query servers. Results are collected here in the main thread, so the totals are only ever updated from one place.
+#With --prefetch, servers are handled in batches: the SNMP data for a batch is collected first, then checked.
+def runChecks(args,servers,pool):
+    script_start = time.time()
+    fleet = {"HP": FleetResults("HP"), "SM": FleetResults("SM")}
+
+    if pool is not None:
+        logging.info('POLLER\tQuerying {0} servers with {1} workers.'.format(len(servers),args.workers))
+
+    try:
+        loadServerMibs(servers)
+    except Exception as inst:
+        msg = 'Exception occurred while loading MIBs; Exception = "{0}"'.format(inst)
+        logging.warning('MIB\tERROR\t{0}'.format(msg))
+
+    #Probe every server at once first. Servers that do not answer get their connect alarm straight away and are not queried.
+    unreachable = {}
+    if args.probe > 0:
+        try:
+            unreachable = probeServers(servers,args.probe)
+        except Exception as inst:
+            msg = 'Exception occurred while probing servers. All servers will be queried; Exception = "{0}"'.format(inst)
+            logging.warning('POLLER\tERROR\t{0}'.format(msg))
+
+    batch_size = args.prefetch if args.prefetch > 0 else max(len(servers),1)
+    for b in range(0,len(servers),batch_size):
+        batch = servers[b:b+batch_size]
+        snapshots = {}
+        if args.prefetch > 0:
+            try:
+                snapshots = prefetchServers([server for server in batch if server[1] not in unreachable],args.prefetch)
+            except Exception as inst:
+                msg = 'Exception occurred while prefetching SNMP data. Servers will be queried directly; Exception = "{0}"'.format(inst)
+                logging.warning('POLLER\tERROR\t{0}'.format(msg))
+        tasks = [server + (snapshots.get(server[1]),unreachable.get(server[1])) for server in batch]
+
+        if pool is not None:
+            results = pool.imap_unordered(pollServer,tasks)
+        else:
+            results = itertools.imap(pollServer,tasks)
+
+        for kind,hostname,stats,elapsed in results:
+            fleet[kind].add(stats)
+            print '{0} - {1} - {2} - {3} sec. {4} total sec.'.format(kind,fleet[kind].servers,hostname,elapsed,(time.time()-script_start))
+
+    host_timing.endRun()
+    try:
+        host_timing.saveTimings(docroot + "snmp_host_timing.json")
+    except Exception as inst:
+        msg = 'Exception occurred while saving SNMP response times; Exception = "{0}"'.format(inst)
+        logging.warning('TIMING\tERROR\t{0}'.format(msg))
+
+    if rollup_enabled:
+        try:
+            saveRollupState(docroot + "snmp_rollup_state.json")
+        except Exception as inst:
+            msg = 'Exception occurred while saving rollup state; Exception = "{0}"'.format(inst)
+            logging.warning('ROLLUP\tERROR\t{0}'.format(msg))
+
+    logging.info('TOTAL\tSTATS\tHP\t(Checked,OK,Error) || Temp({1},{2},{3}) || Fan({4},{5},{6}) || PSU({7},{8},{9}) || Mem({10},{11},{12}) || CPU({13},{14},{15}) || Disk({16},{17},{18}) || CTRLR({19},{20},{21}) || Accel({22},{23},{24}) || NIC({25},{26},{27}) || Servers({0})'.format(fleet["HP"].servers,*fleet["HP"].counts))
+    logging.info('TOTAL\tSTATS\tSM\t(Checked,OK,Error) || Temp({1},{2},{3}) || PSU({4},{5},{6}) || Fan({7},{8},{9}) || Other({10},{11},{12}) || Status({13},{14},{15}) || Memory({16},{17},{18}) || CPU({19},{20},{21}) || RaidAdap({22},{23},{24}) || PhysDisk ({25},{26},{27}) || VirtDisk ({28},{29},{30}) || RaidBattery ({31},{32},{33}) || Servers({0})'.format(fleet["SM"].servers,*fleet["SM"].counts))
+
+# Takes an exclusive lock on the pid file so only one daemon runs at a time. Returns the open file (keep it open to
+# hold the lock), or None if another daemon already holds it.
+def lockPidFile(path):
+    f = open(path,'a+')
+    try:
+        fcntl.flock(f.fileno(),fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        f.close()
+        return None
+    f.seek(0)
+    f.truncate()
+    f.write('{0}\n'.format(os.getpid()))
+    f.flush()
+    return f
+
+# Keeps running, checking every server each --interval seconds. MIBs, the Salt token and the PagerDuty and ZooKeeper
+# sessions stay loaded; exclusions, open incidents and the server list are each refreshed once their TTL expires.
+def runDaemon(args,pool):
+    pidfile = lockPidFile(docroot + 'check_hp.pid')
+    if pidfile is None:
+        logging.info('DAEMON\tAnother check_hp daemon is already running. Exiting.')
+        return
+    logging.info('DAEMON\tStarting daemon. Interval: {0} sec.'.format(args.interval))
+    refreshers = [("exclusions",DAEMON_EXCLUSIONS_TTL,refreshExclusions),
+                  ("alarms",DAEMON_ALARMS_TTL,refreshAlarms),
+                  ("servers",DAEMON_SERVERS_TTL,refreshServers)]
+    refreshed = {}
+    servers = []
+    while True:
+        cycle_start = time.time()
+        for name,ttl,refresh in refreshers:
+            if (name not in refreshed) or (cycle_start - refreshed[name] >= ttl):
+                #A failed refresh keeps what the last one returned and is tried again next cycle
+                try:
+                    result = refresh()
+                except Exception as inst:
+                    msg = 'Exception occurred while refreshing {0}. Keeping the previous {0}; Exception = "{1}"'.format(name,inst)
+                    logging.warning('DAEMON\tERROR\t{0}'.format(msg))
+                    continue
+                if name == "servers":
+                    servers = result
+                refreshed[name] = cycle_start
+        #MIBs cannot be unloaded from libsmi, so a changed MIB file is picked up by exiting. Cron starts a new daemon.
+        if refreshed.get("servers") == cycle_start:
+            try:
+                if mib_cache.mibsChanged():
+                    logging.info('DAEMON\tMIB files have changed. Exiting so the next daemon loads them.')
+                    return
+            except Exception as inst:
+                msg = 'Exception occurred while checking the MIB files for changes; Exception = "{0}"'.format(inst)
+                logging.warning('DAEMON\tERROR\t{0}'.format(msg))
+        try:
+            runChecks(args,servers,pool)
+        except Exception as inst:
+            msg = 'Exception occurred while checking servers; Exception = "{0}"'.format(inst)
+            logging.warning('DAEMON\tERROR\t{0}'.format(msg))
+        elapsed = time.time() - cycle_start
+        logging.info('DAEMON\tCycle complete. {0} sec.'.format(elapsed))
+        time.sleep(max(args.interval - elapsed,0))
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description='Monitor HP and SuperMicro server hardware via SNMP.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of servers to query in parallel (default: 1)')
+    parser.add_argument('--compile-mibs', action='store_true', help='Rebuild the precompiled MIB index and exit')
+    parser.add_argument('--prefetch', type=int, default=0, help='Collect SNMP data for up to this many servers at a time with the asynchronous engine (default: 0, disabled)')
+    parser.add_argument('--probe', type=int, default=200, help='Probe up to this many servers at a time before querying them; servers that do not answer are not queried (default: 200, 0 disables)')
+    parser.add_argument('--rollup', action='store_true', help='Read the HP subsystem rollup conditions first and only check subsystems that are not ok, changed, or have open incidents')
+    parser.add_argument('--daemon', action='store_true', help='Keep running and check every server each --interval seconds')
+    parser.add_argument('--interval', type=int, default=300, help='Seconds between the start of each check in --daemon mode (default: 300)')
+    return parser.parse_args()
+
+# Checks exclusions, loads mibs, checks PD for open incidents, gets device list from Salt, 
+# loops through devices and calls appropriate function based on HP vs SuperMicro.
+def main():
+    global pager_pool_size, rollup_enabled
+    args = parseArgs()
+    pager_pool_size = args.workers
+    rollup_enabled = args.rollup
+    if args.compile_mibs:
+        mib_cache.initMibs(docroot + "mibs/",mib_files,docroot + "snmp_mib_index.json",rebuild=True)
+        return
+
+    logging.info('***************************************************************************')
+    logging.info('Starting Script')
+
+    #Load required MIBs. Uses the precompiled index; the MIB files themselves are parsed by runChecks.
+    mib_cache.initMibs(docroot + "mibs/",mib_files,docroot + "snmp_mib_index.json")
+
+    #Load the response times seen in previous runs, used to set each host's timeout and retries
+    host_timing.loadTimings(docroot + "snmp_host_timing.json")
+    if rollup_enabled:
+        loadRollupState(docroot + "snmp_rollup_state.json")
+
+    pool = None
+    if args.workers > 1:
+        pool = ThreadPool(args.workers)
+
+    if args.daemon:
+        runDaemon(args,pool)
+    else:
+        refreshExclusions()
+        refreshAlarms()
+        servers = refreshServers()
+        runChecks(args,servers,pool)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
 
     logging.info('Script Complete')
 
@@ -8,6 +8,7 @@ import logging
 import subprocess
 import pygerduty
 import os
+import sys
 import datetime
 from collections import defaultdict
 import shutil
@@ -56,18 +57,22 @@ because that would be well over PD's API rate limit.
                         If it is a new issue, a new incident will be created. Else, it will be added to the existing incident.         
 """
 
+#Shared alarm index and exclusion list, installed next to check_hp.py
+sys.path.append('/opt/spot/snmp_monitoring/')
+from alarm_index import AlarmIndex
+from exclusion_file import ExclusionFile
+
 #SET LOGGING INFO
 if not os.path.exists('/var/log/snmp_monitoring/'):
     os.mkdir('/var/log/snmp_monitoring/')
 logging.basicConfig(filename='/var/log/snmp_monitoring/check_npulse.log',format='%(asctime)s: %(levelname)s: %(message)s',level=logging.DEBUG)
 docroot = "/opt/spot/snmp_monitoring/check_npulse/"
-open_alarms = []
+open_alarms = AlarmIndex()
+exclusions = ExclusionFile(docroot+'npulse_exclusions')
 
 #COUNTERS
 totalStats = [0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0]
 deviceCount = 0
-open_alarms = []
-
 def sendToPagerDuty(type,key,desc,det):
     SPOT_API_TOKEN="<Your PagerDuty API token>"
     SERVICE_API_TOKEN="<Your PagerDuty service API token>"
@@ -97,7 +102,7 @@ def getCurrentAlarms():
     SPOT_API_TOKEN="<Your PagerDuty API token>"
     pager = pygerduty.PagerDuty(api_token=SPOT_API_TOKEN)
     for incident in pager.incidents.list(status="triggered,acknowledged"):
-        open_alarms.append(incident.incident_key)
+        open_alarms.add(incident.incident_key)
         logging.info('PAGER\tOPEN INCIDENTS\t{0}'.format(incident.incident_key))
 
 def checkForAlarm(key):
@@ -106,13 +111,7 @@ def checkForAlarm(key):
     return False
 
 def checkForExclusion(key):
-    result = False
-    with open(docroot+'npulse_exclusions','r') as f:
-        for line in f:
-            if line[:-1] == key:
-                result = True
-                return result
-    return result
+    return key in exclusions
 
 def writeStats(host,stats):
     filename = '{0}current_stats_{1}'.format(docroot,host) 
@@ -8,6 +8,7 @@ import logging
 import subprocess
 import pygerduty
 import os
+import sys
 import datetime
 from collections import defaultdict
 
@@ -55,12 +56,18 @@ because that would be well over PD's API rate limit.
                         If it is a new issue, a new incident will be created. Else, it will be added to the existing incident.         
 """
 
+#Shared alarm index and exclusion list, installed next to check_hp.py
+sys.path.append('/opt/spot/snmp_monitoring/')
+from alarm_index import AlarmIndex
+from exclusion_file import ExclusionFile
+
 #SET LOGGING INFO
 if not os.path.exists('/var/log/snmp_monitoring/'):
     os.mkdir('/var/log/snmp_monitoring/')
 logging.basicConfig(filename='/var/log/snmp_monitoring/check_riverbed.log',format='%(asctime)s: %(levelname)s: %(message)s',level=logging.DEBUG)
 docroot = "/opt/spot/snmp_monitoring/check_riverbed/"
-open_alarms = []
+open_alarms = AlarmIndex()
+exclusions = ExclusionFile(docroot+'riverbed_exclusions')
 
 #COUNTERS
 totalStats = [0,0,0]
@@ -71,8 +78,6 @@ deviceCount = 0
 #CARBON_SERVER = 'chivlxstg104'
 CARBON_PORT = 2003
 
-open_alarms = []
-
 def sendToGraphite(path, value):
     timestamp = int(time.time())
     message = '%s %s %d\n' % (path, value, timestamp)
@@ -113,7 +118,7 @@ def getCurrentAlarms():
     SPOT_API_TOKEN="<Your PagerDuty API token>"
     pager = pygerduty.PagerDuty(api_token=SPOT_API_TOKEN)
     for incident in pager.incidents.list(status="triggered,acknowledged"):
-        open_alarms.append(incident.incident_key)
+        open_alarms.add(incident.incident_key)
         logging.info('PAGER\tOPEN INCIDENTS\t{0}'.format(incident.incident_key))
 
 def checkForAlarm(key):
@@ -122,13 +127,7 @@ def checkForAlarm(key):
     return False
 
 def checkForExclusion(key):
-    result = False
-    with open(docroot+'riverbed_exclusions','r') as f:
-        for line in f:
-            if line[:-1] == key:
-                result = True
-                return result
-    return result
+    return key in exclusions
 
 def touch(fname):
     if os.path.exists(fname):
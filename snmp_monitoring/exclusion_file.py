@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+
+import os
+import threading
+
+"""
+========
+OVERVIEW
+========
+
+Exclusion list shared by check_hp.py and the device checks.
+
+Every check reads the incident keys it must never trigger from a text file in its docroot, one key per line. The file
+is checked on every trigger, so ExclusionFile keeps the keys in memory and only reads the file again when it is
+replaced or modified (its mtime, inode or size changed). Checks that query devices from several threads share one
+ExclusionFile, so the file is read again under a lock and never by two threads at once.
+"""
+
+class ExclusionFile(object):
+    """Set of excluded incident keys, read from a file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.keys = set()
+        self.stamp = None
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        info = os.stat(self.path)
+        stamp = (info.st_mtime, info.st_ino, info.st_size)
+        if stamp != self.stamp:
+            with self.lock:
+                if stamp != self.stamp:
+                    with open(self.path, 'r') as f:
+                        self.keys = set(f.read().split('\n'))
+                    self.stamp = stamp
+        return key in self.keys
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+from snimpy.manager import DelegatedSession
+from snimpy import snmp
+import json
+import logging
+import os
+import threading
+import time
+
+"""
+========
+OVERVIEW
+========
+
+Per-host SNMP timeout and retry model used by check_hp.py.
+
+Every SNMP request check_hp sends to a server is timed, and the response times are kept per host as a smoothed
+average and deviation (the same estimator TCP uses for its retransmission timeout). Walks are timed one GETBULK
+request at a time by the asynchronous engine (see snmp_engine.py), where the requests are sent, so each request adds
+its own sample. A walk snimpy sends itself is a series of GETBULK requests that cannot be timed one by one; it is
+counted as a single request, for the loss rate, but not sampled. Responses slower than the timeout they were sent with
+are not sampled: the agent may have been answering a retry, and there is no way to tell which request the answer
+belongs to (Karn's rule). The slowest GETBULK request seen recently is kept separately, since a large table can take
+far longer per request than the GETs that make up most of the samples.
+
+Loss is counted per run: the share of a host's requests that timed out during the run, smoothed across runs. The
+number of runs in a row without a single timeout is kept as well. The model is saved to snmp_host_timing.json after
+every run (endRun folds the run into it first), so it carries over between runs.
+
+Once a host has MIN_SAMPLES responses, its settings are derived from the model instead of the defaults:
+
+    timeout = average + 4 * deviation, never below the slowest walk request, kept between TIMEOUT_MIN and TIMEOUT_MAX
+    retries = 1 once the host has had CLEAN_RUNS runs in a row without a timeout, otherwise the default
+
+Fast, healthy hosts fail fast; slow agents get as much time as they actually need. Hosts without enough history (new
+hosts, or hosts that have never answered) keep the defaults from check_hp.hostSettings.
+"""
+
+TIMEOUT_MIN = 2.0
+TIMEOUT_MAX = 30.0
+MIN_SAMPLES = 5
+LOSS_THRESHOLD = 0.02
+CLEAN_RUNS = 3
+EXPIRE_DAYS = 30
+
+timings = {}
+run_counts = {}   # host -> [requests, timeouts, slowest walk request] for the current run
+timing_lock = threading.Lock()
+
+def loadTimings(path):
+    global timings
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+        cutoff = time.time() - (EXPIRE_DAYS * 86400)
+        timings = dict([(host, entry) for host, entry in data.items() if entry.get("updated", 0) >= cutoff])
+        logging.info('TIMING\tLoaded SNMP response times for {0} hosts from {1}'.format(len(timings), path))
+    except Exception as inst:
+        logging.info('TIMING\tUnable to read SNMP response times from {0}. Using default timeouts; Exception = "{1}"'.format(path, inst))
+        timings = {}
+
+def saveTimings(path):
+    with timing_lock:
+        data = json.dumps(timings)
+    with open(path + '.tmp', 'w') as f:
+        f.write(data)
+    os.rename(path + '.tmp', path)
+
+def getEntry(host):
+    entry = timings.get(host)
+    if entry is None:
+        entry = {"srtt": 0.0, "rttvar": 0.0, "loss": 0.0, "samples": 0, "clean_runs": 0, "slowest": 0.0, "updated": 0}
+        timings[host] = entry
+    # Entries saved before loss was counted per run
+    entry.setdefault("clean_runs", 0)
+    entry.setdefault("slowest", 0.0)
+    return entry
+
+def getRunCounts(host):
+    counts = run_counts.get(host)
+    if counts is None:
+        counts = [0, 0, 0.0]
+        run_counts[host] = counts
+    return counts
+
+# Records the response time (in seconds) of one request sent with the given timeout. A response slower than the
+# timeout may be the answer to a retry, so it is counted but not sampled.
+def recordResponse(host, rtt, timeout_value):
+    with timing_lock:
+        getRunCounts(host)[0] += 1
+        if rtt >= timeout_value:
+            return
+        entry = getEntry(host)
+        if entry["samples"] == 0:
+            entry["srtt"] = rtt
+            entry["rttvar"] = rtt / 2
+        else:
+            entry["rttvar"] = (0.75 * entry["rttvar"]) + (0.25 * abs(entry["srtt"] - rtt))
+            entry["srtt"] = (0.875 * entry["srtt"]) + (0.125 * rtt)
+        entry["samples"] += 1
+        entry["updated"] = time.time()
+
+# Records the response time of one GETBULK request of a walk. The slowest of the run is kept as a floor for the timeout.
+def recordWalk(host, rtt, timeout_value):
+    with timing_lock:
+        counts = getRunCounts(host)
+        counts[2] = max(counts[2], rtt)
+    recordResponse(host, rtt, timeout_value)
+
+# Records a request that was answered but could not be timed
+def recordRequest(host):
+    with timing_lock:
+        getRunCounts(host)[0] += 1
+
+# Records a request that timed out after all of its retries
+def recordTimeout(host):
+    with timing_lock:
+        counts = getRunCounts(host)
+        counts[0] += 1
+        counts[1] += 1
+
+# Folds the requests and timeouts of the current run into the model. Called once at the end of every run.
+def endRun():
+    with timing_lock:
+        for host, (requests, timeouts, slowest) in run_counts.items():
+            if requests == 0:
+                continue
+            entry = getEntry(host)
+            entry["loss"] = (0.7 * entry["loss"]) + (0.3 * float(timeouts) / requests)
+            if timeouts == 0:
+                entry["clean_runs"] += 1
+            else:
+                entry["clean_runs"] = 0
+            entry["slowest"] = max(slowest, 0.9 * entry["slowest"])
+            entry["updated"] = time.time()
+        run_counts.clear()
+
+# Returns the (timeout, retries) to use for a host. The defaults are used until there is enough history.
+def adaptSettings(host, timeout_value, retries_value):
+    entry = timings.get(host)
+    if (entry is None) or (entry["samples"] < MIN_SAMPLES):
+        return timeout_value, retries_value
+    timeout_value = round(min(max(entry["srtt"] + (4 * entry["rttvar"]), entry["slowest"], TIMEOUT_MIN), TIMEOUT_MAX), 1)
+    if (entry["loss"] < LOSS_THRESHOLD) and (entry["clean_runs"] >= CLEAN_RUNS):
+        retries_value = min(retries_value, 1)
+    return timeout_value, retries_value
+
+def isTimeout(inst):
+    return "timeout" in str(inst).lower()
+
+class TimingSession(DelegatedSession):
+    """Snimpy session adapter that records the response time of every GET, and every request that times out."""
+
+    def __init__(self, session, host, timeout_value):
+        DelegatedSession.__init__(self, session)
+        self.host = host
+        self.timeout = timeout_value
+
+    def get(self, *oids):
+        start = time.time()
+        try:
+            result = self._session.get(*oids)
+        except snmp.SNMPException as inst:
+            if isTimeout(inst):
+                recordTimeout(self.host)
+            else:
+                recordResponse(self.host, time.time() - start, self.timeout)
+            raise
+        recordResponse(self.host, time.time() - start, self.timeout)
+        return result
+
+    def walk(self, *oids):
+        try:
+            result = self._session.walk(*oids)
+        except snmp.SNMPException as inst:
+            if isTimeout(inst):
+                recordTimeout(self.host)
+            raise
+        recordRequest(self.host)
+        return result
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+from snimpy import manager
+from snimpy import mib
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+"""
+========
+OVERVIEW
+========
+
+Precompiled MIB index used by check_hp.py.
+
+Snimpy needs every MIB loaded through libsmi before it can query a device, and libsmi parses the full text of each
+file every time. This module keeps a compact JSON index of the MIB symbols we use (name, OID, scalar/column and enum
+values), keyed by the SHA1 of each MIB file:
+
+    1. On startup the index is read and the file hashes are compared. If they match, nothing is parsed.
+    2. Before any server is queried, check_hp parses the MIBs of the server types it is about to query (requireFiles),
+       along with any of our MIBs they import from. MIBs that a run never touches are never parsed.
+    3. If a MIB file changed or the index is missing, every MIB is parsed and the index is rebuilt.
+
+MIBs are only ever parsed on the main thread. libsmi is not thread safe and snimpy goes through it for every lookup,
+so mib_lock alone would only keep two loads apart, not a load and a worker's lookup. A MIB that was not loaded before
+the workers started raises an error in the worker instead of being parsed there.
+
+OIDs for the asynchronous prefetch, and the enum values used by the check rules, come straight from the index,
+without loading anything.
+The index can be built ahead of time with "check_hp.py --compile-mibs".
+"""
+
+mib_dir = ""
+mib_files = []
+mib_index = {"hashes": {}, "requires": {}, "symbols": {}}
+mibs_loaded = set()
+mib_lock = threading.RLock()
+
+def fileHash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+# Returns the module names listed in the IMPORTS section of a MIB file
+def getImports(path):
+    with open(path, 'r') as f:
+        text = f.read()
+    text = re.sub(r'--[^\n]*', '', text)
+    match = re.search(r'\bIMPORTS\b(.*?);', text, re.S)
+    if match is None:
+        return []
+    return re.findall(r'\bFROM\s+([A-Za-z][A-Za-z0-9-]*)', match.group(1))
+
+# Parses a single MIB file with libsmi and registers it with snimpy. Returns the module name.
+def loadFile(name):
+    if threading.current_thread().name != 'MainThread':
+        raise RuntimeError('{0} was not loaded before the worker threads started'.format(name))
+    module = mib.load(mib_dir + name)
+    if module not in manager.loaded:
+        manager.loaded.append(module)
+    mibs_loaded.add(name)
+    return module
+
+# Parses every MIB file in order and writes a new index.
+def compileIndex(indexFile):
+    global mib_index
+    start = time.time()
+    with mib_lock:
+        modules = {}
+        symbols = {}
+        hashes = {}
+        for name in mib_files:
+            module = loadFile(name)
+            modules[module] = name
+            hashes[name] = fileHash(mib_dir + name)
+            for node in mib.getScalars(module) + mib.getColumns(module):
+                enum = node.enum
+                if enum is not None:
+                    enum = dict([(str(k), v) for k, v in enum.items()])
+                symbols[str(node)] = {"file": name,
+                                      "module": module,
+                                      "oid": list(node.oid),
+                                      "kind": "scalar" if isinstance(node, mib.Scalar) else "column",
+                                      "enum": enum}
+        requires = {}
+        for name in mib_files:
+            requires[name] = [modules[m] for m in getImports(mib_dir + name) if (m in modules) and (modules[m] != name)]
+
+        mib_index = {"hashes": hashes, "requires": requires, "symbols": symbols}
+        with open(indexFile + '.tmp', 'w') as f:
+            json.dump(mib_index, f)
+        os.rename(indexFile + '.tmp', indexFile)
+    logging.info('MIB\tCompiled MIB index {0}. MIBs: {1}; Symbols: {2}; {3} sec.'.format(indexFile, len(mib_files), len(symbols), (time.time() - start)))
+
+# Sets the MIB files to use and loads the index. Rebuilds the index if any of the files changed, or if asked to.
+def initMibs(directory, files, indexFile, rebuild=False):
+    global mib_dir, mib_files, mib_index
+    mib_dir = directory
+    mib_files = list(files)
+    if rebuild:
+        return compileIndex(indexFile)
+    start = time.time()
+    hashes = dict([(name, fileHash(mib_dir + name)) for name in mib_files])
+    try:
+        with open(indexFile, 'r') as f:
+            index = json.load(f)
+        if index["hashes"] == hashes:
+            mib_index = index
+            logging.info('MIB\tLoaded MIB index {0}. Symbols: {1}; {2} sec.'.format(indexFile, len(index["symbols"]), (time.time() - start)))
+            return
+        logging.info('MIB\tMIB files have changed since {0} was built.'.format(indexFile))
+    except Exception as inst:
+        logging.info('MIB\tUnable to read MIB index {0}; Exception = "{1}"'.format(indexFile, inst))
+    compileIndex(indexFile)
+
+# True if any MIB file has changed since the index in use was loaded or built
+def mibsChanged():
+    hashes = dict([(name, fileHash(mib_dir + name)) for name in mib_files])
+    return hashes != mib_index["hashes"]
+
+# Parses a MIB file, and any of our MIB files it imports from, if it has not been parsed yet.
+def requireFile(name):
+    if name in mibs_loaded:
+        return
+    with mib_lock:
+        if name in mibs_loaded:
+            return
+        try:
+            for dependency in mib_index["requires"].get(name, []):
+                requireFile(dependency)
+            loadFile(name)
+        except mib.SMIException as inst:
+            logging.warning('MIB\tERROR\tUnable to load {0} on its own, loading all MIBs; Exception = "{1}"'.format(name, inst))
+            requireAll()
+
+def requireFiles(names):
+    for name in names:
+        requireFile(name)
+
+def requireAll():
+    with mib_lock:
+        for name in mib_files:
+            if name not in mibs_loaded:
+                loadFile(name)
+
+# Makes sure the MIB defining a symbol has been parsed. Unknown symbols load everything so snimpy can report them.
+def requireSymbol(symbol):
+    entry = mib_index["symbols"].get(symbol)
+    if entry is None:
+        requireAll()
+    else:
+        requireFile(entry["file"])
+
+# Returns the OID tuple for a symbol, from the index when possible
+def resolveOid(symbol):
+    entry = mib_index["symbols"].get(symbol)
+    if entry is not None:
+        return tuple(entry["oid"])
+    requireSymbol(symbol)
+    for m in manager.loaded:
+        try:
+            return mib.get(m, symbol).oid
+        except mib.SMIException:
+            pass
+    raise AttributeError("{0} is not an attribute".format(symbol))
+
+# Returns the enum values of a symbol as a dictionary of label -> integer value, from the index when possible.
+# Symbols that are not enumerations return an empty dictionary.
+def resolveEnum(symbol):
+    entry = mib_index["symbols"].get(symbol)
+    if entry is not None:
+        return dict([(label, int(value)) for value, label in (entry["enum"] or {}).items()])
+    requireSymbol(symbol)
+    for m in manager.loaded:
+        try:
+            enum = mib.get(m, symbol).enum
+        except mib.SMIException:
+            continue
+        return dict([(str(label), int(value)) for value, label in (enum or {}).items()])
+    raise AttributeError("{0} is not an attribute".format(symbol))
+
+class Manager(manager.Manager):
+    """Snimpy Manager that parses the MIB defining an object the first time the object is used."""
+
+    def _locate(self, attribute):
+        requireSymbol(attribute)
+        return manager.Manager._locate(self, attribute)
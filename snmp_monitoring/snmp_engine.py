@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+
+from pysnmp.entity.rfc3413.oneliner import cmdgen
+from pysnmp.proto import errind
+from pysnmp.proto.rfc1905 import noSuchInstance
+from pyasn1.type import univ
+from snimpy.manager import DelegatedSession
+from snimpy import snmp
+import logging
+import time
+
+"""
+========
+OVERVIEW
+========
+
+Asynchronous SNMP collection engine used by check_hp.py.
+
+Snimpy issues one blocking request per value it reads, so a single check_hp process can only ever wait on one server
+at a time. This module uses the asynchronous pysnmp command generator (which snimpy already depends on) to collect
+data from many servers at once from a single dispatcher loop:
+
+    1. Each server gets a single GET for its probe OIDs (the same values check_hp uses to test the connection and the agent).
+    2. If the probes answered, every column in the server's plan is walked with GETBULK, one column at a time per server.
+    3. Up to 'window' servers are kept in flight. As soon as one server is complete, the next one is started.
+
+The results are stored in a Snapshot per server. SnapshotSession is a snimpy session adapter that answers GET and walk
+requests from that snapshot, so the existing query* functions run on top of it unchanged. Anything that is not in the
+snapshot is passed through to the normal snimpy session. If the server did not respond while it was being collected,
+the same timeout error is raised for anything that was not collected instead of waiting on the server again.
+
+probeHosts uses the same loop to send a single sysUpTime GET to a whole list of devices at once. check_hp.py and the
+Cisco, Arista, Brocade and blade checks use it to find the devices that are not answering before checking the rest,
+so a device that is down no longer holds up the run for its full timeout and retries; the device checks all go
+through probeDevices, which logs the result the same way for each of them. getHosts is the same single GET for any
+OIDs; the Cisco check uses it to detect the platform of every device before it queries them.
+
+walkRawTable, walkTable and walkTableByIndex fetch several columns of the same table in a single snimpy GETBULK walk.
+They are shared by check_hp.py and the Cisco check.
+"""
+
+SYS_UPTIME = (1, 3, 6, 1, 2, 1, 1, 3, 0)
+
+class Snapshot(object):
+    """Raw SNMP values collected for a single server."""
+
+    def __init__(self, host):
+        self.host = host
+        self.values = {}   # oid -> raw pysnmp value
+        self.columns = {}  # column oid -> list of row oids, in the order the agent returned them
+        self.error = None  # set when the server stopped responding during collection
+        self.requests = 0
+        self.sent = 0      # time the request in flight was sent
+        self.answered = False  # set once the agent has answered the probe
+        self.failure = None    # why the probe was not answered
+        self.rtts = []     # response time of every GET that was answered
+        self.walk_rtts = []  # response time of every GETBULK that was answered
+
+    # Returns the raw value for an OID, None if the OID was not collected.
+    def lookup(self, oid):
+        if oid in self.values:
+            return self.values[oid]
+        for column in self.columns:
+            if len(oid) > len(column) and oid[:len(column)] == column:
+                # The whole column was walked and this row was not in it
+                return noSuchInstance
+        if self.error is not None:
+            raise snmp.SNMPException(self.error)
+        return None
+
+class SnapshotSession(DelegatedSession):
+    """Snimpy session adapter that serves requests from a Snapshot."""
+
+    def __init__(self, session, snapshot):
+        DelegatedSession.__init__(self, session)
+        self.snapshot = snapshot
+
+    def get(self, *oids):
+        results = []
+        for oid in oids:
+            value = self.snapshot.lookup(oid)
+            if value is None:
+                return self._session.get(*oids)
+            results.append((oid, value))
+        return tuple([(oid, self._session._convert(raw)) for oid, raw in results])
+
+    def walk(self, *oids):
+        columns = self.snapshot.columns
+        if len([oid for oid in oids if oid in columns]) == len(oids):
+            values = self.snapshot.values
+            return tuple([(oid, self._session._convert(values[oid])) for column in oids for oid in columns[column]])
+        if self.snapshot.error is not None:
+            raise snmp.SNMPException(self.snapshot.error)
+        return self._session.walk(*oids)
+
+class Collector(object):
+    """Runs the asynchronous collection for a list of servers."""
+
+    def __init__(self, window=100, bulk=40):
+        self.generator = cmdgen.AsynCommandGenerator()
+        self.window = window
+        self.bulk = bulk
+        self.pending = []
+        self.snapshots = {}
+
+    # targets is a list of (hostname, community, version, timeout, retries, probes, columns) tuples. Probes and columns
+    # are lists of OID tuples. Returns a dictionary of hostname -> Snapshot.
+    def collect(self, targets):
+        self.pending = list(reversed(targets))
+        for i in range(min(self.window, len(self.pending))):
+            self.startNext()
+        if not self.snapshots:
+            # Nothing was sent (no targets, or none could be started), so there is no dispatcher to run
+            return self.snapshots
+        self.generator.snmpEngine.transportDispatcher.runDispatcher()
+        return self.snapshots
+
+    def startNext(self):
+        while self.pending:
+            hostname, comm, ver, timeout_value, retries_value, probes, columns = self.pending.pop()
+            snapshot = Snapshot(hostname)
+            self.snapshots[hostname] = snapshot
+            try:
+                host, port = hostname.partition(":")[::2]
+                auth = cmdgen.CommunityData(comm, comm, ver - 1)
+                transport = cmdgen.UdpTransportTarget((host, int(port or 161)), timeout=timeout_value, retries=retries_value)
+                job = [auth, transport, snapshot, list(columns)]
+                snapshot.requests += 1
+                snapshot.sent = time.time()
+                self.generator.asyncGetCmd(auth, transport, list(probes), (self.probeDone, job))
+                return
+            except Exception as inst:
+                # Leave the snapshot empty. The normal snimpy session will report the same error.
+                logging.warning('{0}\tERROR\tUnable to start SNMP collection; Exception = "{1}"'.format(hostname, inst))
+                del self.snapshots[hostname]
+
+    def probeDone(self, sendRequestHandle, errorIndication, errorStatus, errorIndex, varBinds, job):
+        auth, transport, snapshot, columns = job
+        if errorIndication:
+            if isinstance(errorIndication, errind.RequestTimedOut):
+                snapshot.error = str(errorIndication)
+            snapshot.failure = str(errorIndication)
+            return self.hostDone()
+        snapshot.answered = True
+        snapshot.rtts.append(time.time() - snapshot.sent)
+        if errorStatus:
+            return self.hostDone()
+        for name, value in varBinds:
+            snapshot.values[tuple(name)] = value
+            if isinstance(value, univ.Null):
+                # Agent is up but does not answer the probe. Nothing else is worth collecting.
+                return self.hostDone()
+        self.walkNext(job)
+
+    def walkNext(self, job):
+        auth, transport, snapshot, columns = job
+        if not columns:
+            return self.hostDone()
+        column = columns.pop(0)
+        snapshot.requests += 1
+        snapshot.sent = time.time()
+        self.generator.asyncBulkCmd(auth, transport, 0, self.bulk, [column], (self.walkDone, (job, column, [])))
+
+    def walkDone(self, sendRequestHandle, errorIndication, errorStatus, errorIndex, varBindTable, context):
+        job, column, rows = context
+        auth, transport, snapshot, columns = job
+        if errorIndication:
+            if isinstance(errorIndication, errind.RequestTimedOut):
+                snapshot.error = str(errorIndication)
+                return self.hostDone()
+            return self.walkNext(job)
+        snapshot.walk_rtts.append(time.time() - snapshot.sent)
+        if errorStatus:
+            return self.walkNext(job)
+        prefix = univ.ObjectIdentifier(column)
+        for row in varBindTable:
+            for name, value in row:
+                if isinstance(value, univ.Null) or not prefix.isPrefixOf(name):
+                    return self.columnDone(job, column, rows)
+                oid = tuple(name)
+                if rows and oid <= rows[-1]:
+                    # Agent is not returning increasing OIDs
+                    return self.columnDone(job, column, rows)
+                snapshot.values[oid] = value
+                rows.append(oid)
+        if not varBindTable:
+            return self.columnDone(job, column, rows)
+        snapshot.requests += 1
+        snapshot.sent = time.time()
+        return True
+
+    def columnDone(self, job, column, rows):
+        auth, transport, snapshot, columns = job
+        snapshot.columns[column] = rows
+        if rows:
+            return self.walkNext(job)
+        # Snimpy follows an empty walk with a GET of the column itself to tell an empty table from an unknown one
+        snapshot.requests += 1
+        snapshot.sent = time.time()
+        self.generator.asyncGetCmd(auth, transport, [column], (self.emptyColumnDone, job))
+
+    def emptyColumnDone(self, sendRequestHandle, errorIndication, errorStatus, errorIndex, varBinds, job):
+        auth, transport, snapshot, columns = job
+        if errorIndication and isinstance(errorIndication, errind.RequestTimedOut):
+            snapshot.error = str(errorIndication)
+            return self.hostDone()
+        if not errorIndication:
+            snapshot.rtts.append(time.time() - snapshot.sent)
+        if not errorIndication and not errorStatus:
+            for name, value in varBinds:
+                snapshot.values[tuple(name)] = value
+        self.walkNext(job)
+
+    def hostDone(self):
+        self.startNext()
+
+# Collects probes and columns from all targets, keeping up to 'window' servers in flight.
+def prefetch(targets, window=100, bulk=40):
+    return Collector(window, bulk).collect(targets)
+
+# Sends a single GET for the same OIDs to every target, keeping up to 'window' in flight. targets is a list of (hostname,
+# community, version, timeout, retries) tuples. Returns a dictionary of hostname -> (error, values), where error is
+# None if the host answered, or the reason it did not, and values is a dictionary of oid -> raw pysnmp value.
+def getHosts(targets, oids, window=200):
+    snapshots = Collector(window).collect([tuple(target) + (list(oids), []) for target in targets])
+    results = {}
+    for target in targets:
+        snapshot = snapshots.get(target[0])
+        if snapshot is None:
+            results[target[0]] = ('Unable to send SNMP request', {})
+        elif snapshot.answered:
+            results[target[0]] = (None, snapshot.values)
+        else:
+            results[target[0]] = (snapshot.failure or 'No SNMP response received', {})
+    return results
+
+# Sends a single sysUpTime GET to every target, keeping up to 'window' in flight. targets is a list of (hostname,
+# community, version, timeout, retries) tuples. Returns a dictionary of hostname -> None if the host answered, or the
+# reason it did not.
+def probeHosts(targets, window=200):
+    return dict([(hostname, error) for hostname, (error, values) in getHosts(targets, [SYS_UPTIME], window).items()])
+
+# Probes a list of devices that share the same settings with getHosts. comm is the community string, or a function
+# that returns the community of a hostname. Returns a dictionary of hostname -> error for the devices that did not
+# answer. If the probe itself fails, every device is reported as answering so they are all queried as before.
+# The probe is a sysUpTime GET unless other OIDs are given; if 'answers' is a dictionary, the raw values each device
+# returned are added to it (hostname -> {oid: value}).
+def probeDevices(hostnames, comm, ver, timeout_value, retries_value, oids=(SYS_UPTIME,), answers=None):
+    try:
+        if callable(comm):
+            targets = [(hostname, comm(hostname), ver, timeout_value, retries_value) for hostname in hostnames]
+        else:
+            targets = [(hostname, comm, ver, timeout_value, retries_value) for hostname in hostnames]
+        results = getHosts(targets, oids)
+    except Exception as inst:
+        msg = 'Exception occurred while probing devices. All devices will be queried; Exception = "{0}"'.format(inst)
+        logging.warning('PROBE\tERROR\t{0}'.format(msg))
+        return {}
+    if answers is not None:
+        for hostname, (error, values) in results.items():
+            answers[hostname] = values
+    unreachable = dict([(hostname, error) for hostname, (error, values) in results.items() if error is not None])
+    logging.info('PROBE\tProbed {0} devices. Not responding: {1}'.format(len(hostnames), len(unreachable)))
+    return unreachable
+
+# Walks several columns of the same table in a single GETBULK walk, without converting the values. The first column
+# drives the rows, just like looping over device.<column> does. Returns the snimpy columns, and a list of (index, values)
+# pairs with the plain values from the walk in the same order as the names. A value missing from the walk is None.
+def walkRawTable(device, names):
+    columns = [getattr(device, name).proxy for name in names]
+    prefixes = [column.oid for column in columns]
+    cells = {}
+    for oid, value in device._session.walk(*prefixes):
+        for i in range(len(prefixes)):
+            if (len(oid) > len(prefixes[i])) and (oid[:len(prefixes[i])] == prefixes[i]):
+                cells[(i, oid[len(prefixes[i]):])] = value
+                break
+
+    rows = []
+    for suffix in sorted([x[1] for x in cells if x[0] == 0]):
+        #Turn the OID suffix into an index, the same way snimpy does when looping over a column
+        index = []
+        rest = suffix
+        for x in columns[0].table.index:
+            l, o = x.type.fromOid(x, tuple(rest))
+            index.append(x.type(x, o))
+            rest = rest[l:]
+        if len(index) == 1:
+            index = index[0]
+        else:
+            index = tuple(index)
+        rows.append((index, [cells.get((i, suffix)) for i in range(len(columns))]))
+
+    if len(rows) == 0:
+        #Let snimpy decide whether the table is empty or does not exist
+        for index in getattr(device, names[0]):
+            pass
+    return columns, rows
+
+# Fetches several columns of the same table in a single GETBULK walk. Returns a list of (index, row) pairs, where row is
+# a dictionary of column name -> value. Any value missing from the walk is requested individually, so a missing value
+# fails the same way a direct lookup would.
+def walkTable(device, names):
+    columns, rows = walkRawTable(device, names)
+    table = []
+    for index, values in rows:
+        row = {}
+        for i in range(len(columns)):
+            if values[i] is not None:
+                row[names[i]] = columns[i].type(columns[i], values[i])
+            else:
+                row[names[i]] = getattr(device, names[i])[index]
+        table.append((index, row))
+    return table
+
+# Same as walkTable, but returns a dictionary keyed by the plain integer index (a tuple of integers for tables with
+# more than one index), so rows of different tables can be joined
+def walkTableByIndex(device, names):
+    table = {}
+    for index, row in walkTable(device, names):
+        if isinstance(index, tuple):
+            index = tuple([int(x) for x in index])
+        else:
+            index = int(index)
+        table[index] = row
+    return table